@@ -17,62 +17,558 @@
 # this program.  If not, see <http://www.gnu.org/licenses/>.
 
 import argparse
-import matplotlib.pyplot as plt
-from . import geoip
-from . import getdata
-from . import plot
-from . import tor
-from . import worldmap
+import contextlib
+import datetime
+import json
+import sys
+from . import options
+from . import stats
+
+# The modules depending on Matplotlib, Paramiko, NumPy or pygeoip are
+# imported by the subcommands using them, so that the other subcommands and
+# --help start quickly.
+
+
+def add_source_arguments(parser):
+    """Add the arguments selecting the hosts to fetch data from to `parser`.
+
+    :param parser: ArgumentParser object
+    """
+    parser.add_argument('--stream', action='store_true',
+                        help="parse logs while they are downloaded instead "
+                        "of spooling them to temporary files")
+    parser.add_argument('--remote-filter', type=str, dest='prefilter',
+                        choices=['gzip', 'zstd', 'none'],
+                        metavar='COMPRESSION',
+                        help="filter the logs on the servers with grep and "
+                        "transfer only the candidate lines, compressed with "
+                        "gzip, zstd or none")
+    parser.add_argument('--hosts-file', type=str,
+                        help="file listing hostnames to analyze, one per line")
+    parser.add_argument('--jobs', type=int, default=16,
+                        help="maximum number of hosts to fetch concurrently")
+    parser.add_argument('hostnames', type=str, nargs='*', metavar='hostname',
+                        help="hostname of remote server to analyze")
+
+
+def add_query_arguments(parser):
+    """Add the arguments filtering the stored attempts to `parser`.
+
+    :param parser: ArgumentParser object
+    """
+    parser.add_argument('--offline', action='store_true',
+                        help="only use stored attempts instead of fetching "
+                        "new ones first")
+    parser.add_argument('--since', type=datetime.datetime.fromisoformat,
+                        help="only use attempts at or after this time "
+                        "(YYYY-MM-DD[ HH:MM[:SS]]); hosts fetched for the "
+                        "first time are only fetched from then on")
+    parser.add_argument('--until', type=datetime.datetime.fromisoformat,
+                        help="only use attempts before this time "
+                        "(YYYY-MM-DD[ HH:MM[:SS]]); hosts fetched for the "
+                        "first time are only fetched up to then")
+    parser.add_argument('--user', type=str, action='append', dest='usernames',
+                        metavar='USERNAME',
+                        help="only use attempts with this username "
+                        "(may be repeated)")
+
+
+def add_local_arguments(parser):
+    """Add the arguments selecting local logs to analyze to `parser`.
+
+    :param parser: ArgumentParser object
+    """
+    parser.add_argument('--log', type=str, action='append', dest='logs',
+                        metavar='FILE',
+                        help="analyze this local log instead of the stored "
+                        "attempts of hosts; .gz files are decompressed and - "
+                        "reads standard input (may be repeated)")
+
+
+def add_lookup_arguments(parser):
+    """Add the arguments configuring the GeoIP lookups to `parser`.
+
+    :param parser: ArgumentParser object
+    """
+    parser.add_argument('--geoip-mode', type=str, default='standard',
+                        choices=options.GEOIP_MODES,
+                        help="how to access the GeoIP databases: read from "
+                        "the files, memory-mapped, or loaded into memory "
+                        "(default: standard)")
+    parser.add_argument('--bulk', action='store_true',
+                        help="resolve all addresses at once with the "
+                        "precomputed GeoIP index")
+
+
+def add_output_arguments(parser):
+    """Add the arguments selecting where figures are rendered to `parser`.
+
+    :param parser: ArgumentParser object
+    """
+    parser.add_argument('-o', '--output', type=str, metavar='PATH',
+                        help="render the figure to this file instead of "
+                        "showing it; the extension selects the format "
+                        "(e.g. png, svg, pdf)")
+    parser.add_argument('--per-host', action='store_true',
+                        help="render a figure of each host; {host} in the "
+                        "--output path is replaced by the hostname")
+    parser.add_argument('--processes', type=int,
+                        help="maximum number of figures to render in "
+                        "parallel with --per-host (default: number of CPUs)")
+
+
+def add_follow_arguments(parser):
+    """Add the arguments for following the logs live to `parser`.
+
+    :param parser: ArgumentParser object
+    """
+    parser.add_argument('--follow', action='store_true',
+                        help="keep following the logs and add new attempts "
+                        "to the figure as they are logged")
+    parser.add_argument('--refresh', type=float, default=5, metavar='SECONDS',
+                        help="interval between updates of the figure with "
+                        "--follow (default: 5)")
+
+
+def add_stats_arguments(parser):
+    """Add the arguments reporting where the time of a run goes to `parser`.
+
+    :param parser: ArgumentParser object
+    """
+    parser.add_argument('--stats', type=str, choices=['text', 'json'],
+                        help="report the time spent and work done in each "
+                        "stage of the run, as a table or as JSON")
+    parser.add_argument('--stats-file', type=str, metavar='PATH',
+                        help="write the --stats report to this file instead "
+                        "of standard error")
+    parser.add_argument('--profile', type=str, metavar='PATH',
+                        help="profile the run with cProfile and write the "
+                        "profile to this file, to be read with pstats")
+    parser.add_argument('--profile-stage', type=str, choices=stats.STAGES,
+                        metavar='STAGE',
+                        help="only profile this stage of the run: one of {}"
+                        .format(', '.join(stats.STAGES)))
+
+
+@contextlib.contextmanager
+def collect_stats(parser, args):
+    """Collect the metrics and profile of the run requested by `args`.
+
+    The report and the profile are written when the block exits, even if it
+    fails or is interrupted.
+
+    :param parser: ArgumentParser object that parsed `args`
+    :param args: parsed arguments
+    """
+    if args.profile_stage is not None and args.profile is None:
+        parser.error("--profile-stage requires --profile")
+    if args.stats is None and args.profile is None:
+        yield
+        return
+    stats.collector.enable(profile=args.profile is not None,
+                           profile_stage=args.profile_stage)
+    try:
+        yield
+    finally:
+        if args.profile is not None:
+            stats.collector.dump_profile(args.profile)
+        if args.stats is not None:
+            summary = stats.collector.summary()
+            if args.stats == 'json':
+                report = json.dumps(summary, indent=2)
+            else:
+                report = stats.format_summary(summary)
+            if args.stats_file is None:
+                print(report, file=sys.stderr)
+            else:
+                with open(args.stats_file, 'w') as f:
+                    print(report, file=f)
+
+
+def check_output_arguments(parser, args):
+    """Check the arguments added by `add_output_arguments`.
+
+    When rendering to files, switches to a non-interactive backend.
+
+    :param parser: ArgumentParser object that parsed `args`
+    :param args: parsed arguments
+    """
+    if args.per_host and (args.output is None or '{host}' not in args.output):
+        parser.error("--per-host requires an --output path containing {host}")
+    if args.follow and args.per_host:
+        parser.error("--follow cannot be combined with --per-host")
+    if args.logs and args.per_host:
+        parser.error("--log cannot be combined with --per-host")
+    if args.output is not None:
+        import matplotlib.pyplot as plt
+        plt.switch_backend('Agg')
+
+
+def show_figure(args):
+    """Show the current figure, or save it to the --output path.
+
+    :param args: parsed arguments
+    """
+    import matplotlib.pyplot as plt
+    if args.output is None:
+        plt.show()
+    else:
+        with stats.stage('render'):
+            plt.savefig(args.output)
+
+
+def make_enricher(args, *, tor_lookup=False):
+    """Create the Enricher configured by `args`.
+
+    :param args: parsed arguments
+    :param tor_lookup: look up whether addresses are Tor exit nodes
+    :return: Enricher object
+    """
+    from . import enrich
+    from . import geoindex
+    from . import geoip
+    return enrich.Enricher(
+        geoip.GeoIPMultiversion(mode=args.geoip_mode),
+        index=geoindex.GeoIPIndex() if args.bulk else None,
+        tor_lookup=tor_lookup)
+
+
+def get_hostnames(args):
+    """Return the list of hostnames selected by `args`.
+
+    :param args: parsed arguments
+    :return: list of hostnames
+    """
+    from . import getdata
+    hostnames = list(args.hostnames)
+    if args.hosts_file is not None:
+        hostnames.extend(getdata.read_inventory(args.hosts_file))
+    return hostnames
+
+
+def update_store(parser, args, attempt_store):
+    """Fetch the new attempts of the hosts selected by `args` into the store.
+
+    :param parser: ArgumentParser object that parsed `args`
+    :param args: parsed arguments
+    :param attempt_store: AttemptStore object
+    """
+    from . import getdata
+    hostnames = get_hostnames(args)
+    if not hostnames:
+        parser.error("no hostnames given")
+    getdata.update_store(attempt_store, hostnames, since=args.since,
+                         until=args.until, stream=args.stream,
+                         prefilter=args.prefilter, max_workers=args.jobs)
+
+
+def get_attempts(parser, args, attempt_store):
+    """Return the stored attempts selected by `args`, fetching new ones first.
+
+    Without hostnames, the attempts of all stored hosts are used if
+    `args.offline` is set.  If local logs are given, their attempts are used
+    instead, with the path of the log in place of the hostname.
+
+    :param parser: ArgumentParser object that parsed `args`
+    :param args: parsed arguments
+    :param attempt_store: AttemptStore object
+    :return: AttemptBatch object with hostnames
+    """
+    from . import columns
+    if args.logs:
+        return read_local_logs(args.logs).filter(
+            since=args.since, until=args.until, usernames=args.usernames)
+    if not args.offline:
+        update_store(parser, args, attempt_store)
+    hostnames = get_hostnames(args)
+    return columns.AttemptBatch.concatenate(stats.timed(
+        'query', attempt_store.query_batches(
+            hostnames=hostnames or None, since=args.since, until=args.until,
+            usernames=args.usernames)))
+
+
+def read_local_logs(paths):
+    """Read the attempts in the local logs at `paths`.
+
+    :param paths: iterable of paths, as accepted by `getdata.open_local_log`
+    :return: AttemptBatch object, with the paths as hostnames
+    """
+    from . import columns
+    from . import getdata
+    return columns.AttemptBatch.concatenate(
+        batch.with_hostname(path) for path in paths
+        for batch in getdata.parse_local_log_batches(path))
+
+
+def filter_attempts(args, attempts):
+    """Return the attempts matching the query arguments of `args`.
+
+    :param args: parsed arguments
+    :param attempts: AttemptBatch object
+    :return: AttemptBatch object
+    """
+    return attempts.filter(since=args.since, until=args.until,
+                           usernames=args.usernames)
+
+
+def follow_attempts(parser, args, add):
+    """Keep adding the attempts logged from now on to the current figure.
+
+    Every --refresh seconds, the attempts logged on the hosts selected by
+    `args` since the last refresh that match the query arguments are passed
+    to `add`, and the figure is redrawn, or saved again with --output.  This
+    goes on until the figure is closed or the program is interrupted.
+
+    :param parser: ArgumentParser object that parsed `args`
+    :param args: parsed arguments
+    :param add: function taking an AttemptBatch object of the new attempts
+        and updating the figure
+    """
+    import matplotlib.pyplot as plt
+    import time
+    from . import columns
+    from . import getdata
+    hostnames = get_hostnames(args)
+    if not hostnames:
+        parser.error("--follow requires hostnames")
+    fig = plt.gcf()
+
+    def refresh():
+        # Return whether there were new attempts
+        attempts = filter_attempts(
+            args, columns.AttemptBatch.from_attempts(follower.poll()))
+        if len(attempts):
+            with stats.stage('plot'):
+                add(attempts)
+            fig.canvas.draw_idle()
+        return bool(len(attempts))
+
+    with getdata.AttemptFollower(hostnames) as follower:
+        if args.output is None:
+            timer = fig.canvas.new_timer(interval=int(args.refresh * 1000))
+            # Matplotlib removes timer callbacks that return a falsy value
+            timer.add_callback(lambda: refresh() or True)
+            timer.start()
+            plt.show()
+        else:
+            with stats.stage('render'):
+                fig.savefig(args.output)
+            while True:
+                time.sleep(args.refresh)
+                if refresh():
+                    with stats.stage('render'):
+                        fig.savefig(args.output)
+
+
+def parse_bar_keys(string):
+    """Parse the property argument of the bar subcommand.
+
+    :param string: argument
+    :return: tuple of key names, as returned by `aggregate.parse_keys`
+    """
+    from . import aggregate
+    try:
+        return aggregate.parse_keys(string)
+    except ValueError:
+        raise argparse.ArgumentTypeError(
+            "invalid property: {} (choose from {})".format(
+                string, ', '.join(options.KEYS)))
+
+
+def render_per_host(parser, args, attempt_store, render, resources, **kwargs):
+    """Render a figure of each host selected by `args` to its own file.
+
+    Without hostnames, all stored hosts are rendered if `args.offline` is
+    set.
+
+    :param parser: ArgumentParser object that parsed `args`
+    :param args: parsed arguments
+    :param attempt_store: AttemptStore object
+    :param render: function rendering a figure, as `batch.render_map`
+    :param resources: Resources tuple from `batch.load_resources`
+    :param kwargs: extra keyword args to pass to `render`
+    """
+    from . import batch
+    if not args.offline:
+        update_store(parser, args, attempt_store)
+    hostnames = get_hostnames(args) or attempt_store.hostnames()
+    with stats.stage('render'):
+        batch.render_hosts(
+            render, hostnames, args.output, resources=resources,
+            query={'since': args.since, 'until': args.until,
+                   'usernames': args.usernames},
+            max_workers=args.processes, **kwargs)
 
 
 def main():
     parser = argparse.ArgumentParser(
         description="Plot failed SSH attempts on a map.")
+    add_stats_arguments(parser)
     subparsers = parser.add_subparsers(dest='action', help="action to perform")
 
     # Subparser update
     parser_update = subparsers.add_parser(
         'update', description="Update the database cache.")
 
+    # Subparser fetch
+    parser_fetch = subparsers.add_parser(
+        'fetch', description="Fetch new attempts into the local store.")
+    parser_fetch.add_argument('--since', type=datetime.datetime.fromisoformat,
+                              help="on the first fetch from a host, skip the "
+                              "attempts before this time (YYYY-MM-DD[ "
+                              "HH:MM[:SS]]), locating it by bisecting the log "
+                              "so that only the rest is transferred")
+    parser_fetch.add_argument('--until', type=datetime.datetime.fromisoformat,
+                              help="on the first fetch from a host, stop at "
+                              "this time; the next fetch carries on from there")
+    add_source_arguments(parser_fetch)
+
     # Subparser map
     parser_map = subparsers.add_parser(
         'map', description="Plot data on a world map.")
     parser_map.add_argument('--hl_tor', action='store_true',
                             help="highlight Tor exit nodes")
+    parser_map.add_argument('--render', type=str, default='points',
+                            choices=options.RENDER_MODES,
+                            help="how to render the locations: a dot per "
+                            "location, a marker per location sized by its "
+                            "number of attempts, or a hexbin or 2-D "
+                            "histogram density layer (default: points)")
+    parser_map.add_argument('--bins', type=int, default=100,
+                            help="number of bins across the map for the "
+                            "hexbin and density renderings")
+    parser_map.add_argument('--no-map-cache', action='store_false',
+                            dest='map_cache',
+                            help="draw the map background from scratch "
+                            "instead of using the cached image")
     parser_map.add_argument('property', type=str, choices=['coords'],
                             help="property to map")
-    parser_map.add_argument('hostname', type=str,
-                            help="hostname of remote server to analyze")
+    add_source_arguments(parser_map)
+    add_query_arguments(parser_map)
+    add_local_arguments(parser_map)
+    add_lookup_arguments(parser_map)
+    add_output_arguments(parser_map)
+    add_follow_arguments(parser_map)
 
     # Subparser bar
     parser_bar = subparsers.add_parser(
         'bar', description="Show bar plot of data.")
-    parser_bar.add_argument('property', type=str,
-                            choices=['username', 'country'],
-                            help="property to plot")
-    parser_bar.add_argument('hostname', type=str,
-                            help="hostname of remote server to analyze")
+    parser_bar.add_argument('property', type=parse_bar_keys,
+                            help="property to plot, one of {}, or several "
+                            "joined by commas to count their combinations; "
+                            "with time, the attempts per time bucket are "
+                            "plotted as stacked bars"
+                            .format(', '.join(options.KEYS)))
+    parser_bar.add_argument('--bucket', type=str, default='day',
+                            choices=list(options.BUCKETS),
+                            help="width of the time buckets (default: day)")
+    parser_bar.add_argument('--top', type=int, metavar='N',
+                            help="show only the N most frequent values, or "
+                            "with time the N most frequent series (default: "
+                            "all values, {} series)".format(options.SERIES_TOP))
+    add_source_arguments(parser_bar)
+    add_query_arguments(parser_bar)
+    add_local_arguments(parser_bar)
+    add_lookup_arguments(parser_bar)
+    add_output_arguments(parser_bar)
+    add_follow_arguments(parser_bar)
 
     args = parser.parse_args()
+    if args.action in ('map', 'bar'):
+        check_output_arguments(parser, args)
+    if args.action == 'map' and args.follow and args.render == 'hexbin':
+        # Hexbins are redrawn from all the locations on every update
+        parser.error("--follow cannot be combined with --render hexbin")
+    with collect_stats(parser, args):
+        run_action(parser, args)
 
+
+def run_action(parser, args):
+    """Perform the action selected by `args`.
+
+    :param parser: ArgumentParser object that parsed `args`
+    :param args: parsed arguments
+    """
     if args.action == 'update':
-        geoipmv = geoip.GeoIPMultiversion()
-        geoipmv.update_cache()
+        from . import download
+        from . import geoindex
+        from . import geoip
+        from . import tor
+        geoipmv = geoip.GeoIPMultiversion(mode='memory')
         tordb = tor.TorExitNodeDatabase()
-        tordb.update_cache()
+        try:
+            updated = download.download_all(geoipmv.cache_sources() +
+                                            tordb.cache_sources())
+            error = None
+        except download.DownloadError as e:
+            # Still index the databases that were downloaded
+            updated = e.updated
+            error = e
+        index = geoindex.GeoIPIndex()
+        if geoipmv.check_cache() and (
+                not index.check_cache() or
+                any(source.path in updated
+                    for source in geoipmv.cache_sources())):
+            index.build(geoipmv)
+        if error is not None:
+            parser.exit(1, "{}: error: {}\n".format(parser.prog, error))
+    elif args.action == 'fetch':
+        from . import store
+        with store.AttemptStore() as attempt_store:
+            update_store(parser, args, attempt_store)
     elif args.action == 'map':
-        basemap = worldmap.setup_map()
-        if args.property == 'coords':
-            worldmap.plot_attempt_locations(
-                basemap, getdata.get_data(args.hostname),
-                highlight_tor=args.hl_tor)
-        plt.show()
+        from . import batch
+        from . import store
+        from . import worldmap
+        with store.AttemptStore() as attempt_store:
+            enricher = make_enricher(args, tor_lookup=True)
+            if args.per_host:
+                basemap = background = None
+                if args.map_cache:
+                    basemap, background = worldmap.load_map(worldmap.map_params())
+                resources = batch.load_resources(
+                    enricher, basemap=basemap, background=background)
+                render_per_host(parser, args, attempt_store, batch.render_map,
+                                resources, highlight_tor=args.hl_tor,
+                                mode=args.render, bins=args.bins)
+                return
+            attempts = get_attempts(parser, args, attempt_store)
+            basemap = worldmap.setup_map(use_cache=args.map_cache)
+            if args.property == 'coords':
+                layer = worldmap.LocationLayer(
+                    basemap, enricher, highlight_tor=args.hl_tor,
+                    mode=args.render, bins=args.bins)
+                with stats.stage('plot'):
+                    layer.add(attempts)
+        if args.follow:
+            follow_attempts(parser, args, layer.add)
+        else:
+            show_figure(args)
     elif args.action == 'bar':
-        fig = plt.figure()
-        ax = fig.add_subplot(1,1,1)
-        plot.bar_plot(ax, args.property, getdata.get_data(args.hostname))
-        fig.tight_layout()
-        plt.show()
+        import matplotlib.pyplot as plt
+        from . import batch
+        from . import plot
+        from . import store
+        with store.AttemptStore() as attempt_store:
+            enricher = make_enricher(args)
+            if args.per_host:
+                resources = batch.load_resources(enricher)
+                render_per_host(parser, args, attempt_store, batch.render_bar,
+                                resources, prop=args.property,
+                                bucket=args.bucket, top=args.top)
+                return
+            attempts = get_attempts(parser, args, attempt_store)
+            fig = plt.figure()
+            ax = fig.add_subplot(1,1,1)
+            bar_plot = plot.LiveBarPlot(ax, args.property, enricher=enricher,
+                                        bucket=args.bucket, top=args.top)
+            with stats.stage('plot'):
+                bar_plot.add(attempts)
+                fig.tight_layout()
+        if args.follow:
+            follow_attempts(parser, args, bar_plot.add)
+        else:
+            show_figure(args)
 
 
 if __name__ == '__main__':
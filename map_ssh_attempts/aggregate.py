@@ -0,0 +1,349 @@
+# Copyright (C) 2014  Jim Turner
+
+# This file is part of map_ssh_attempts.
+
+# map_ssh_attempts is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by the Free
+# Software Foundation, either version 2 of the License, or (at your option) any
+# later version.
+
+# This program is distributed in the hope that it will be useful, but WITHOUT ANY
+# WARRANTY; without even the implied warranty of MERCHANTABILITY or FITNESS FOR A
+# PARTICULAR PURPOSE.  See the GNU General Public License for more details.
+
+# You should have received a copy of the GNU General Public License along with
+# this program.  If not, see <http://www.gnu.org/licenses/>.
+
+import numpy as np
+from . import columns
+from . import enrich
+from . import stats
+from .options import BUCKETS, KEYS
+
+
+# Offsets of the starts of the time buckets from the epoch, so that weeks
+# start on Monday
+BUCKET_OFFSETS = {'week': 3 * 86400}
+
+# Fields of the enrich.Location tuples giving the values of location keys
+LOCATION_FIELDS = {'country': 'country_name',
+                   'city': 'city'}
+
+# Largest number of combinations of key values counted with a dense array
+# rather than by sorting, as a multiple of the number of attempts
+DENSE_FACTOR = 4
+
+
+class Aggregation(object):
+
+    def __init__(self, keys, labels, codes, counts):
+        """Create the numbers of attempts in groups of equal key values.
+
+        Each key has a table of its distinct values, and the groups refer to
+        them by index.
+
+        :param keys: tuple of the names of the keys, from `KEYS`
+        :param labels: list of the lists of the distinct values of each key
+        :param codes: list of the int64 arrays of the indices of the values
+            of each key of the groups
+        :param counts: int64 array of the numbers of attempts in the groups
+        """
+        self.keys = keys
+        self.labels = labels
+        self.codes = codes
+        self.counts = counts
+
+    def __len__(self):
+        return len(self.counts)
+
+    def __iter__(self):
+        """Generate (tuple of key values, number of attempts) tuples."""
+        values = [_object_array(labels)[codes].tolist()
+                  for labels, codes in zip(self.labels, self.codes)]
+        return zip(zip(*values), self.counts.tolist())
+
+    def select(self, rows):
+        """Return the aggregation of the groups at `rows`.
+
+        :param rows: index array or bool array of the groups to keep
+        :return: Aggregation object
+        """
+        return Aggregation(self.keys, self.labels,
+                           [codes[rows] for codes in self.codes],
+                           self.counts[rows])
+
+    def top(self, n=None):
+        """Return the `n` largest groups, largest first.
+
+        Groups of equal size keep their order.
+
+        :param n: number of groups, or None for all of them
+        :return: Aggregation object
+        """
+        order = np.argsort(-self.counts, kind='stable')
+        return self.select(order[:n])
+
+    def totals(self, keys):
+        """Return the numbers of attempts grouped by some of the keys only.
+
+        :param keys: names of the keys to keep
+        :return: Aggregation object
+        """
+        keys = parse_keys(keys)
+        positions = [self.keys.index(key) for key in keys]
+        labels = [self.labels[i] for i in positions]
+        codes, counts = group([self.codes[i] for i in positions],
+                              [len(table) for table in labels],
+                              self.counts)[:2]
+        return Aggregation(keys, labels, codes, counts)
+
+    def merge(self, other):
+        """Return the sum of this aggregation and `other`.
+
+        :param other: Aggregation object with the same keys
+        :return: Aggregation object
+        """
+        labels = []
+        codes = []
+        for i in range(len(self.keys)):
+            table, ids = columns.merge_names(
+                [(self.labels[i], self.codes[i]),
+                 (other.labels[i], other.codes[i])])
+            labels.append(table)
+            codes.append(ids.astype(np.int64))
+        codes, counts = group(codes, [len(table) for table in labels],
+                              np.concatenate([self.counts, other.counts]))[:2]
+        return Aggregation(self.keys, labels, codes, counts)
+
+    def to_dict(self):
+        """Return a dict mapping key values to numbers of attempts.
+
+        The key values are tuples, or single values for a single key.
+        """
+        if len(self.keys) == 1:
+            return {values[0]: count for values, count in self}
+        return dict(iter(self))
+
+    def series(self, key, *, top=None):
+        """Split the counts by `key` into series of the values of the other
+        keys.
+
+        This gives the data of a chart over `key`, such as the attempts per
+        hour for each country.
+
+        :param key: name of the key along the series
+        :param top: number of series of the most frequent values to keep,
+            or None for all of them; the rest are summed into a last series
+        :return: tuple of (list of the values of `key`, list of the tuples
+            of the values of the other keys of each series, with None for the
+            rest, int64 array of the numbers of attempts of each series at
+            each value of `key`)
+        """
+        position = self.keys.index(key)
+        x_labels = self.labels[position]
+        x_codes = self.codes[position]
+        others = [i for i in range(len(self.keys)) if i != position]
+        series_codes, series_counts, group_series = group(
+            [self.codes[i] for i in others],
+            [len(self.labels[i]) for i in others], self.counts)
+        order = np.argsort(-series_counts, kind='stable')
+        shown = order[:top]
+        rest = len(shown) < len(order)
+        # Rows of the series in the matrix, with the rest in the last one
+        ranks = np.full(len(order), len(shown), dtype=np.int64)
+        ranks[shown] = np.arange(len(shown))
+        rows = len(shown) + rest
+        matrix = np.bincount(
+            ranks[group_series] * len(x_labels) + x_codes, self.counts,
+            minlength=rows * len(x_labels)).astype(np.int64).reshape(
+                rows, len(x_labels))
+        names = [tuple(self.labels[i][series_codes[j][row]]
+                       for j, i in enumerate(others))
+                 for row in shown.tolist()]
+        if rest:
+            names.append(None)
+        return x_labels, names, matrix
+
+
+def parse_keys(keys):
+    """Parse the keys to group attempts by.
+
+    :param keys: name of a key, names joined by commas, or iterable of names
+    :return: tuple of distinct key names
+    """
+    if isinstance(keys, str):
+        keys = keys.split(',')
+    keys = tuple(key.strip() for key in keys)
+    if not keys or len(set(keys)) != len(keys):
+        raise ValueError("Unknown `keys` value: {}".format(','.join(keys)))
+    for key in keys:
+        if key not in KEYS:
+            raise ValueError("Unknown `keys` value: {}".format(key))
+    return keys
+
+
+def aggregate(attempts, keys, *, enricher=None, bucket='day'):
+    """Count the attempts with each combination of values of `keys`.
+
+    Each key is reduced to an array of indices into the table of its distinct
+    values, looking each distinct address up once, and the combinations are
+    counted in one pass over the arrays, so no Python code runs per attempt.
+    Keys are:
+
+    * ``'username'``: the username tried
+    * ``'country'``: the country of the source address, None if unknown
+    * ``'city'``: the city of the source address, None if unknown
+    * ``'ip'``: the source address
+    * ``'host'``: the host that logged the attempt
+    * ``'time'``: the start of the time bucket of the attempt
+
+    :param attempts: AttemptBatch object, or iterable of Attempt or
+        HostAttempt tuples
+    :param keys: names of the keys (see `parse_keys`)
+    :param enricher: Enricher object to look addresses up
+    :param bucket: width of the time buckets; one of `BUCKETS`
+    :return: Aggregation object
+    """
+    keys = parse_keys(keys)
+    if bucket not in BUCKETS:
+        raise ValueError("Unknown `bucket` value: {}".format(bucket))
+    if not isinstance(attempts, columns.AttemptBatch):
+        attempts = columns.AttemptBatch.from_attempts(attempts)
+    if {'country', 'city'} & set(keys) and enricher is None:
+        enricher = enrich.Enricher()
+    addresses = None
+    labels = []
+    codes = []
+    with stats.stage('aggregate'):
+        for key in keys:
+            if key in ('ip', 'country', 'city') and addresses is None:
+                addresses, address_ids = attempts.address_ids()
+            if key == 'username':
+                table, ids = attempts.usernames, attempts.username_ids
+            elif key == 'host':
+                if attempts.hostnames is not None:
+                    table, ids = attempts.hostnames, attempts.host_ids
+                elif not len(attempts):
+                    # Empty batches are built without hostnames
+                    table, ids = [], attempts.username_ids
+                else:
+                    raise ValueError("The attempts have no hostnames")
+            elif key == 'ip':
+                table, ids = addresses, address_ids
+            elif key == 'time':
+                table, ids = time_buckets(attempts.timestamps, bucket)
+            else:
+                locations = enricher.locate_addresses(addresses,
+                                                      city=key == 'city')
+                table, address_values = intern_values(
+                    [getattr(location, LOCATION_FIELDS[key])
+                     for location in locations])
+                ids = address_values[address_ids]
+            labels.append(list(table))
+            codes.append(np.asarray(ids, dtype=np.int64))
+        codes, counts = group(codes, [len(table) for table in labels])[:2]
+    stats.count('aggregate', attempts=len(attempts), groups=len(counts))
+    return Aggregation(keys, labels, codes, counts)
+
+
+def time_buckets(timestamps, bucket):
+    """Number the time buckets of `timestamps`.
+
+    :param timestamps: int64 array of times, as returned by
+        `columns.to_timestamp`
+    :param bucket: width of the buckets; one of `BUCKETS`
+    :return: tuple of (list of the datetimes of the starts of the buckets,
+        int64 array of the indices of the buckets of `timestamps` in it)
+    """
+    width = BUCKETS[bucket]
+    if width is None:
+        starts = timestamps.astype('datetime64[s]').astype('datetime64[M]')
+        starts = starts.astype('datetime64[s]').astype(np.int64)
+    else:
+        offset = BUCKET_OFFSETS.get(bucket, 0)
+        starts = (timestamps + offset) // width * width - offset
+    unique, inverse = np.unique(starts, return_inverse=True)
+    return ([columns.from_timestamp(start) for start in unique.tolist()],
+            inverse.ravel())
+
+
+def intern_values(values):
+    """Number the distinct values of `values`.
+
+    :param values: list of hashable values
+    :return: tuple of (list of the distinct values, int64 array of the
+        indices of `values` in it)
+    """
+    index = {}
+    ids = np.fromiter((index.setdefault(value, len(index))
+                       for value in values), dtype=np.int64, count=len(values))
+    return list(index), ids
+
+
+def group(codes, sizes, weights=None):
+    """Count the distinct combinations of parallel arrays of indices.
+
+    :param codes: list of int64 arrays of indices, one per key
+    :param sizes: list of the numbers of distinct values of each key
+    :param weights: int64 array of the numbers to count for each position,
+        or None to count each once
+    :return: tuple of (list of int64 arrays of the indices of the
+        combinations, in the order of `codes`, int64 array of their counts,
+        int64 array of the combination of each position)
+    """
+    if weights is not None:
+        length = len(weights)
+    else:
+        length = len(codes[0]) if codes else 0
+    total = 1
+    for size in sizes:
+        total *= size
+    if total <= max(DENSE_FACTOR * length, 1 << 16):
+        # Few possible combinations: count them all in a dense array
+        combined = _combine(codes, sizes, length)
+        counts = np.bincount(combined, weights, minlength=total)
+        present = np.flatnonzero(counts)
+        inverse = np.searchsorted(present, combined)
+        combinations = [np.asarray(ids, dtype=np.int64) for ids
+                        in np.unravel_index(present, sizes)] if codes else []
+        return combinations, counts[present].astype(np.int64), inverse
+    if total < 1 << 62:
+        combined = _combine(codes, sizes, length)
+        unique, first, inverse = np.unique(combined, return_index=True,
+                                           return_inverse=True)
+    else:
+        unique, first, inverse = np.unique(np.stack(codes, axis=1), axis=0,
+                                           return_index=True,
+                                           return_inverse=True)
+    inverse = inverse.ravel()
+    counts = np.bincount(inverse, weights, minlength=len(unique))
+    return ([ids[first] for ids in codes], counts.astype(np.int64),
+            inverse)
+
+
+def _combine(codes, sizes, length):
+    """Combine parallel arrays of indices into one, in mixed radix."""
+    combined = np.zeros(length, dtype=np.int64)
+    for ids, size in zip(codes, sizes):
+        combined *= size
+        combined += ids
+    return combined
+
+
+def _object_array(values):
+    """Return list `values` as an object array."""
+    array = np.empty(len(values), dtype=object)
+    array[:] = values
+    return array
+
+
+def format_label(values):
+    """Format a tuple of key values for display.
+
+    :param values: tuple of key values, or None for the rest of the values
+    :return: string
+    """
+    if values is None:
+        return 'Other'
+    return ' / '.join('Unknown' if value is None else str(value)
+                      for value in values)
@@ -0,0 +1,160 @@
+# Copyright (C) 2014  Jim Turner
+
+# This file is part of map_ssh_attempts.
+
+# map_ssh_attempts is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by the Free
+# Software Foundation, either version 2 of the License, or (at your option) any
+# later version.
+
+# This program is distributed in the hope that it will be useful, but WITHOUT ANY
+# WARRANTY; without even the implied warranty of MERCHANTABILITY or FITNESS FOR A
+# PARTICULAR PURPOSE.  See the GNU General Public License for more details.
+
+# You should have received a copy of the GNU General Public License along with
+# this program.  If not, see <http://www.gnu.org/licenses/>.
+
+import collections
+import concurrent.futures
+import matplotlib.pyplot as plt
+import multiprocessing
+from . import columns
+from . import enrich
+from . import geoip
+from . import plot
+from . import store
+from . import worldmap
+
+
+Resources = collections.namedtuple('Resources', ('enricher', 'basemap', 'background'))
+
+# Resources shared with the worker processes of `render_hosts`
+_resources = None
+
+
+def load_resources(enricher, *, basemap=None, background=None):
+    """Load everything needed for rendering up front.
+
+    The GeoIP databases, GeoIP index and Tor exit node list used by
+    `enricher` are loaded, so that worker processes forked afterwards share
+    them instead of each loading their own copy.  GeoIP databases set to be
+    read from their files are memory-mapped instead, through a new Enricher
+    object, since forked workers would share the offset of the files and
+    read each other's records.
+
+    :param enricher: Enricher object to look addresses up
+    :param basemap: Basemap object loaded by `worldmap.load_map`, if maps are
+        rendered from the cached background
+    :param background: background image loaded by `worldmap.load_map`
+    :return: Resources tuple
+    """
+    if enricher.geoipmv.mode == 'standard':
+        enricher = enrich.Enricher(
+            geoip.GeoIPMultiversion(enricher.geoipmv.cache_dir, mode='mmap'),
+            enricher.tordb, index=enricher.index,
+            tor_lookup=enricher.tordb is not None, maxsize=enricher.maxsize)
+    enricher.geoipmv.load_dbs()
+    if enricher.tordb is not None:
+        enricher.tordb.load_dbs()
+    if enricher.index is not None:
+        enricher.index.load()
+    return Resources(enricher, basemap, background)
+
+
+def render_map(attempts, path, *, resources, highlight_tor=False,
+               mode='points', bins=100):
+    """Render a world map of the attempt locations to file `path`.
+
+    :param attempts: iterable of Attempt tuples
+    :param path: path of the image file; its extension selects the format
+    :param resources: Resources tuple (with a Tor-enabled enricher)
+    :param highlight_tor: highlight Tor exit nodes in a different color
+    :param mode: how to render the locations; one of `options.RENDER_MODES`
+    :param bins: number of bins across the map
+    """
+    fig = plt.figure()
+    try:
+        if resources.basemap is None:
+            basemap = worldmap.setup_map(use_cache=False)
+        else:
+            basemap = worldmap.show_map(resources.basemap, resources.background)
+        worldmap.plot_attempt_locations(
+            basemap, attempts, highlight_tor=highlight_tor,
+            enricher=resources.enricher, mode=mode, bins=bins)
+        fig.savefig(path)
+    finally:
+        plt.close(fig)
+
+
+def render_bar(attempts, path, *, resources, prop, bucket='day', top=None):
+    """Render a bar plot of property `prop` of the attempts to file `path`.
+
+    :param attempts: iterable of Attempt tuples
+    :param path: path of the image file; its extension selects the format
+    :param resources: Resources tuple
+    :param prop: key or keys to plot (see `aggregate.parse_keys`)
+    :param bucket: width of the time buckets; one of `aggregate.BUCKETS`
+    :param top: number of bars, or of series of a chart over time, to show
+    """
+    fig = plt.figure()
+    try:
+        ax = fig.add_subplot(1,1,1)
+        plot.bar_plot(ax, prop, attempts, enricher=resources.enricher,
+                      bucket=bucket, top=top)
+        fig.tight_layout()
+        fig.savefig(path)
+    finally:
+        plt.close(fig)
+
+
+def render_hosts(render, hostnames, output, *, resources, query=None,
+                 max_workers=None, cache_dir='~/.cache/map_ssh_attempts',
+                 **kwargs):
+    """Render a figure of the stored attempts of each host to its own file.
+
+    The figures are rendered in parallel by forked worker processes, which
+    share `resources` with this process.  Where processes cannot be forked,
+    the figures are rendered one after the other in this process.
+
+    :param render: function rendering the figure, as `render_map` or
+        `render_bar`
+    :param hostnames: iterable of hosts
+    :param output: path of the image files, with ``{host}`` in place of the
+        hostname
+    :param resources: Resources tuple from `load_resources`
+    :param query: dict of extra keyword args for `AttemptStore.query_batches`
+    :param max_workers: maximum number of worker processes, or None for the
+        number of CPUs
+    :param cache_dir: directory of the attempt store
+    :param kwargs: extra keyword args to pass to `render`
+    :return: list of the paths written
+    """
+    global _resources
+    _resources = resources
+    query = query if query is not None else {}
+    jobs = [(hostname, output.format(host=hostname)) for hostname in hostnames]
+    if 'fork' not in multiprocessing.get_all_start_methods():
+        for hostname, path in jobs:
+            _render_host(render, hostname, path, cache_dir, query, kwargs)
+            print("Rendered {}".format(path))
+        return [path for hostname, path in jobs]
+    paths = []
+    with concurrent.futures.ProcessPoolExecutor(
+            max_workers, mp_context=multiprocessing.get_context('fork')) as executor:
+        futures = {executor.submit(_render_host, render, hostname, path,
+                                   cache_dir, query, kwargs): path
+                   for hostname, path in jobs}
+        for future in concurrent.futures.as_completed(futures):
+            future.result()
+            print("Rendered {}".format(futures[future]))
+            paths.append(futures[future])
+    return paths
+
+
+def _render_host(render, hostname, path, cache_dir, query, kwargs):
+    # Each process opens its own connection to the store, since connections
+    # cannot be shared across processes.
+    with store.AttemptStore(cache_dir) as attempt_store:
+        attempts = columns.AttemptBatch.concatenate(
+            attempt_store.query_batches(hostnames=[hostname], **query))
+        render(attempts, path, resources=_resources, **kwargs)
@@ -0,0 +1,361 @@
+# Copyright (C) 2014  Jim Turner
+
+# This file is part of map_ssh_attempts.
+
+# map_ssh_attempts is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by the Free
+# Software Foundation, either version 2 of the License, or (at your option) any
+# later version.
+
+# This program is distributed in the hope that it will be useful, but WITHOUT ANY
+# WARRANTY; without even the implied warranty of MERCHANTABILITY or FITNESS FOR A
+# PARTICULAR PURPOSE.  See the GNU General Public License for more details.
+
+# You should have received a copy of the GNU General Public License along with
+# this program.  If not, see <http://www.gnu.org/licenses/>.
+
+import array
+import collections
+import datetime
+import ipaddress
+import numpy as np
+
+
+Attempt = collections.namedtuple('Attempt', ('datetime', 'username', 'ip_address'))
+
+HostAttempt = collections.namedtuple(
+    'HostAttempt', ('hostname', 'datetime', 'username', 'ip_address'))
+
+EPOCH = datetime.datetime(1970, 1, 1)
+
+# Number of attempts in the batches generated while parsing and querying
+BATCH_SIZE = 1 << 16
+
+
+def to_timestamp(dt):
+    """Convert naive datetime `dt` to an integer number of seconds.
+
+    Log timestamps carry no time zone, so they are counted from the epoch as
+    if they were UTC, and only compared with each other.
+
+    :param dt: naive datetime object
+    :return: int
+    """
+    return int((dt - EPOCH).total_seconds())
+
+
+def from_timestamp(timestamp):
+    """Convert a number of seconds from `to_timestamp` back to a datetime.
+
+    :param timestamp: int
+    :return: naive datetime object
+    """
+    return EPOCH + datetime.timedelta(seconds=timestamp)
+
+
+class AttemptBatch(object):
+
+    def __init__(self, timestamps, username_ids, usernames, is_ipv6, ipv4,
+                 ipv6, host_ids=None, hostnames=None):
+        """Create a batch of attempts stored column by column.
+
+        Usernames and hostnames are stored once each, and the attempts refer
+        to them by index.  Addresses are stored as integers, with the IPv4
+        and IPv6 addresses in separate arrays.  Iterating over the batch
+        generates its attempts as Attempt tuples, or HostAttempt tuples if
+        it has hostnames.
+
+        :param timestamps: int64 array of the times of the attempts, as
+            returned by `to_timestamp`
+        :param username_ids: int32 array of the indices of the usernames of
+            the attempts in `usernames`
+        :param usernames: list of distinct usernames
+        :param is_ipv6: bool array telling which attempts come from IPv6
+            addresses
+        :param ipv4: uint32 array of the IPv4 addresses, in the order of the
+            attempts from IPv4 addresses
+        :param ipv6: 'S16' array of the packed IPv6 addresses, in the order
+            of the attempts from IPv6 addresses
+        :param host_ids: int32 array of the indices of the hostnames of the
+            attempts in `hostnames`
+        :param hostnames: list of distinct hostnames
+        """
+        self.timestamps = timestamps
+        self.username_ids = username_ids
+        self.usernames = usernames
+        self.is_ipv6 = is_ipv6
+        self.ipv4 = ipv4
+        self.ipv6 = ipv6
+        self.host_ids = host_ids
+        self.hostnames = hostnames
+
+    @classmethod
+    def empty(cls):
+        """Return a batch of no attempts."""
+        return BatchBuilder().build()
+
+    @classmethod
+    def from_attempts(cls, attempts):
+        """Store Attempt or HostAttempt tuples in a batch.
+
+        :param attempts: iterable of Attempt or HostAttempt tuples
+        :return: AttemptBatch object
+        """
+        builder = BatchBuilder()
+        for attempt in attempts:
+            builder.append(to_timestamp(attempt.datetime), attempt.username,
+                           attempt.ip_address,
+                           getattr(attempt, 'hostname', None))
+        return builder.build()
+
+    @classmethod
+    def concatenate(cls, batches):
+        """Join `batches` into one batch.
+
+        :param batches: iterable of AttemptBatch objects, all with or all
+            without hostnames
+        :return: AttemptBatch object
+        """
+        batches = list(batches)
+        if not batches:
+            return cls.empty()
+        if len(batches) == 1:
+            return batches[0]
+        usernames, username_ids = merge_names(
+            [(batch.usernames, batch.username_ids) for batch in batches])
+        if batches[0].hostnames is None:
+            hostnames = host_ids = None
+        else:
+            hostnames, host_ids = merge_names(
+                [(batch.hostnames, batch.host_ids) for batch in batches])
+        return cls(np.concatenate([batch.timestamps for batch in batches]),
+                   username_ids, usernames,
+                   np.concatenate([batch.is_ipv6 for batch in batches]),
+                   np.concatenate([batch.ipv4 for batch in batches]),
+                   np.concatenate([batch.ipv6 for batch in batches]),
+                   host_ids, hostnames)
+
+    def __len__(self):
+        return len(self.timestamps)
+
+    def __iter__(self):
+        columns = [self.datetimes(), self.attempt_usernames(), self.addresses()]
+        if self.hostnames is None:
+            return map(Attempt, *columns)
+        return map(HostAttempt, self.attempt_hostnames(), *columns)
+
+    def datetimes(self):
+        """Return the list of the times of the attempts as datetime objects."""
+        return self.timestamps.astype('datetime64[s]').tolist()
+
+    def attempt_usernames(self):
+        """Return the list of the usernames of the attempts."""
+        return _lookup_names(self.usernames, self.username_ids)
+
+    def attempt_hostnames(self):
+        """Return the list of the hostnames of the attempts."""
+        return _lookup_names(self.hostnames, self.host_ids)
+
+    def addresses(self):
+        """Return the list of the addresses of the attempts as address objects.
+
+        Each distinct address is converted once.
+        """
+        addresses = np.empty(len(self), dtype=object)
+        for version, values, rows in ((4, self.ipv4, ~self.is_ipv6),
+                                      (6, self.ipv6, self.is_ipv6)):
+            unique, inverse = np.unique(values, return_inverse=True)
+            addresses[rows] = _address_objects(version, unique)[
+                inverse.ravel()]
+        return addresses.tolist()
+
+    def address_ids(self):
+        """Number the distinct addresses of the attempts.
+
+        :return: tuple of (list of the distinct addresses as address
+            objects, int64 array of the indices of the addresses of the
+            attempts in it)
+        """
+        addresses = []
+        ids = np.empty(len(self), dtype=np.int64)
+        for version, values, rows in ((4, self.ipv4, ~self.is_ipv6),
+                                      (6, self.ipv6, self.is_ipv6)):
+            unique, inverse = np.unique(values, return_inverse=True)
+            ids[rows] = inverse.ravel() + len(addresses)
+            addresses.extend(_address_objects(version, unique).tolist())
+        return addresses, ids
+
+    def address_counts(self):
+        """Count the attempts from each distinct address.
+
+        :return: tuple of (list of address objects, int64 array of the
+            numbers of attempts from them)
+        """
+        addresses = []
+        counts = []
+        for version, values in ((4, self.ipv4), (6, self.ipv6)):
+            unique, count = np.unique(values, return_counts=True)
+            addresses.extend(_address_objects(version, unique).tolist())
+            counts.append(count.astype(np.int64))
+        return addresses, np.concatenate(counts)
+
+    def with_hostname(self, hostname):
+        """Return the batch of the same attempts, all logged on `hostname`.
+
+        :param hostname: host the attempts were logged on
+        :return: AttemptBatch object
+        """
+        return AttemptBatch(
+            self.timestamps, self.username_ids, self.usernames, self.is_ipv6,
+            self.ipv4, self.ipv6, np.zeros(len(self), dtype=np.int32),
+            [hostname])
+
+    def select(self, mask):
+        """Return the batch of the attempts where `mask` is True.
+
+        :param mask: bool array parallel to the attempts
+        :return: AttemptBatch object
+        """
+        return AttemptBatch(
+            self.timestamps[mask], self.username_ids[mask], self.usernames,
+            self.is_ipv6[mask], self.ipv4[mask[~self.is_ipv6]],
+            self.ipv6[mask[self.is_ipv6]],
+            self.host_ids[mask] if self.host_ids is not None else None,
+            self.hostnames)
+
+    def filter(self, *, since=None, until=None, usernames=None):
+        """Return the batch of the attempts matching the filters.
+
+        Filters that are None are not applied.
+
+        :param since: datetime of the earliest attempt to include
+        :param until: datetime after the latest attempt to include
+        :param usernames: iterable of usernames to include
+        :return: AttemptBatch object
+        """
+        mask = np.ones(len(self), dtype=bool)
+        if since is not None:
+            mask &= self.timestamps >= to_timestamp(since)
+        if until is not None:
+            mask &= self.timestamps < to_timestamp(until)
+        if usernames is not None:
+            usernames = set(usernames)
+            mask &= np.array([username in usernames
+                              for username in self.usernames],
+                             dtype=bool)[self.username_ids]
+        return self.select(mask)
+
+
+class BatchBuilder(object):
+
+    def __init__(self):
+        """Create an object collecting attempts one by one into a batch."""
+        self.timestamps = array.array('q')
+        self.username_ids = array.array('i')
+        self.usernames = []
+        self.username_index = {}
+        self.is_ipv6 = array.array('b')
+        self.ipv4 = array.array('I')
+        self.ipv6 = []
+        self.host_ids = array.array('i')
+        self.hostnames = []
+        self.hostname_index = {}
+
+    def __len__(self):
+        return len(self.timestamps)
+
+    def append(self, timestamp, username, address, hostname=None):
+        """Add an attempt to the batch.
+
+        :param timestamp: time of the attempt, as returned by `to_timestamp`
+        :param username: username of the attempt, as str or as UTF-8 bytes
+        :param address: IPv4Address or IPv6Address object
+        :param hostname: host the attempt was logged on, if any; either all
+            or no attempts of a batch have one
+        """
+        self.timestamps.append(timestamp)
+        username_id = self.username_index.get(username)
+        if username_id is None:
+            username_id = self._intern_username(username)
+        self.username_ids.append(username_id)
+        if address.version == 4:
+            self.is_ipv6.append(False)
+            self.ipv4.append(int(address))
+        else:
+            self.is_ipv6.append(True)
+            self.ipv6.append(address.packed)
+        if hostname is not None:
+            host_id = self.hostname_index.get(hostname)
+            if host_id is None:
+                host_id = self.hostname_index[hostname] = len(self.hostnames)
+                self.hostnames.append(hostname)
+            self.host_ids.append(host_id)
+
+    def _intern_username(self, username):
+        # Bytes and str spellings of a username share its index
+        name = username.decode('UTF-8') if isinstance(username, bytes) else username
+        username_id = self.username_index.get(name)
+        if username_id is None:
+            username_id = len(self.usernames)
+            self.usernames.append(name)
+            self.username_index[name] = username_id
+        self.username_index[username] = username_id
+        return username_id
+
+    def build(self):
+        """Return the batch of the attempts added so far.
+
+        :return: AttemptBatch object
+        """
+        with_hosts = len(self.host_ids) > 0
+        return AttemptBatch(
+            np.array(self.timestamps, dtype=np.int64),
+            np.array(self.username_ids, dtype=np.int32),
+            list(self.usernames),
+            np.array(self.is_ipv6, dtype=bool),
+            np.array(self.ipv4, dtype=np.uint32),
+            np.array(self.ipv6, dtype='S16'),
+            np.array(self.host_ids, dtype=np.int32) if with_hosts else None,
+            list(self.hostnames) if with_hosts else None)
+
+
+def _address_objects(version, values):
+    """Convert an array of `AttemptBatch` addresses of IP `version` to an
+    object array of address objects."""
+    objects = np.empty(len(values), dtype=object)
+    if version == 4:
+        objects[:] = [ipaddress.IPv4Address(value)
+                      for value in values.tolist()]
+    else:
+        # Bytes arrays drop trailing zero bytes
+        objects[:] = [ipaddress.IPv6Address(value.ljust(16, b'\0'))
+                      for value in values.tolist()]
+    return objects
+
+
+def merge_names(tables):
+    """Merge several tables of distinct names, such as those of batches.
+
+    :param tables: list of (list of names, array of indices) tuples
+    :return: tuple of (list of names, int32 array of the concatenated
+        indices into it)
+    """
+    names = []
+    index = {}
+    ids = []
+    for table, table_ids in tables:
+        mapping = np.empty(len(table), dtype=np.int32)
+        for i, name in enumerate(table):
+            if name not in index:
+                index[name] = len(names)
+                names.append(name)
+            mapping[i] = index[name]
+        ids.append(mapping[table_ids])
+    return names, np.concatenate(ids)
+
+
+def _lookup_names(names, ids):
+    """Return the list of the names at indices `ids` of list `names`."""
+    table = np.empty(len(names), dtype=object)
+    table[:] = names
+    return table[ids].tolist()
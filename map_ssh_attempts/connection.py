@@ -0,0 +1,128 @@
+# Copyright (C) 2014  Jim Turner
+
+# This file is part of map_ssh_attempts.
+
+# map_ssh_attempts is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by the Free
+# Software Foundation, either version 2 of the License, or (at your option) any
+# later version.
+
+# This program is distributed in the hope that it will be useful, but WITHOUT ANY
+# WARRANTY; without even the implied warranty of MERCHANTABILITY or FITNESS FOR A
+# PARTICULAR PURPOSE.  See the GNU General Public License for more details.
+
+# You should have received a copy of the GNU General Public License along with
+# this program.  If not, see <http://www.gnu.org/licenses/>.
+
+import collections
+import paramiko.client
+import threading
+from . import stats
+
+
+def connect(hostname, *args, **kwargs):
+    """Open an SSH connection to `hostname`.
+
+    :param hostname: the server to connect to
+    :param args: extra args to pass to SSHClient.connect()
+    :param kwargs: extra keyword args to pass to SSHClient.connect()
+    :return: connected SSHClient object
+    """
+    client = paramiko.client.SSHClient()
+    client.load_system_host_keys()
+    kwargs['compress'] = kwargs.get('compress', True)
+    with stats.stage('connect'):
+        client.connect(hostname, *args, **kwargs)
+    return client
+
+
+class SSHConnectionPool(object):
+
+    def __init__(self, *args, **kwargs):
+        """Create a pool of SSH connections and SFTP sessions, one per host.
+
+        Connections are opened on first use and reused until `close` is
+        called.  A host's session must only be used by one thread at a time;
+        different hosts may be used concurrently.
+
+        :param args: extra args to pass to SSHClient.connect()
+        :param kwargs: extra keyword args to pass to SSHClient.connect()
+        """
+        self.args = args
+        self.kwargs = kwargs
+        self.clients = {}
+        self.sftps = {}
+        self.lock = threading.Lock()
+        self.host_locks = collections.defaultdict(threading.Lock)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+    def client(self, hostname):
+        """Return the SSHClient connected to `hostname`, connecting if needed.
+
+        :param hostname: the server to connect to
+        :return: connected SSHClient object
+        """
+        with self.lock:
+            host_lock = self.host_locks[hostname]
+        # Connect outside of the pool-wide lock so that a slow host does not
+        # hold up connections to the other hosts.
+        with host_lock:
+            client = self.clients.get(hostname)
+            if client is None or not _is_active(client):
+                client = connect(hostname, *self.args, **dict(self.kwargs))
+                self.clients[hostname] = client
+                self.sftps.pop(hostname, None)
+            return client
+
+    def open_sftp(self, hostname):
+        """Return the SFTP session of `hostname`, opening it if needed.
+
+        :param hostname: the server to connect to
+        :return: SFTPClient object
+        """
+        client = self.client(hostname)
+        with self.host_locks[hostname]:
+            sftp = self.sftps.get(hostname)
+            if sftp is None:
+                sftp = client.open_sftp()
+                self.sftps[hostname] = sftp
+            return sftp
+
+    def add(self, hostname, client):
+        """Use the already connected `client` as the connection to `hostname`.
+
+        :param hostname: the server `client` is connected to
+        :param client: connected SSHClient object
+        """
+        self.discard(hostname)
+        with self.host_locks[hostname]:
+            self.clients[hostname] = client
+
+    def discard(self, hostname):
+        """Close and forget the connection to `hostname`, if any.
+
+        :param hostname: the server whose connection should be closed
+        """
+        with self.host_locks[hostname]:
+            sftp = self.sftps.pop(hostname, None)
+            client = self.clients.pop(hostname, None)
+        if sftp is not None:
+            sftp.close()
+        if client is not None:
+            client.close()
+
+    def close(self):
+        """Close all connections in the pool."""
+        for hostname in list(self.clients):
+            self.discard(hostname)
+
+
+def _is_active(client):
+    """Check if the transport of SSHClient `client` is still usable."""
+    transport = client.get_transport()
+    return transport is not None and transport.is_active()
@@ -0,0 +1,165 @@
+# Copyright (C) 2014  Jim Turner
+
+# This file is part of map_ssh_attempts.
+
+# map_ssh_attempts is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by the Free
+# Software Foundation, either version 2 of the License, or (at your option) any
+# later version.
+
+# This program is distributed in the hope that it will be useful, but WITHOUT ANY
+# WARRANTY; without even the implied warranty of MERCHANTABILITY or FITNESS FOR A
+# PARTICULAR PURPOSE.  See the GNU General Public License for more details.
+
+# You should have received a copy of the GNU General Public License along with
+# this program.  If not, see <http://www.gnu.org/licenses/>.
+
+import collections
+import concurrent.futures
+import contextlib
+import gzip
+import json
+import os
+import os.path
+import shutil
+import tempfile
+import urllib.error
+import urllib.request
+
+
+Source = collections.namedtuple('Source', ('url', 'path', 'gzipped'))
+
+# Size of the blocks in which downloads are copied to disk
+BLOCK_SIZE = 1 << 20
+
+# Permissions of the files written by `atomic_write`, as for open(); the umask
+# can only be read by setting it, which is done here before any thread runs
+UMASK = os.umask(0)
+os.umask(UMASK)
+FILE_MODE = 0o666 & ~UMASK
+
+
+class DownloadError(IOError):
+
+    def __init__(self, failed, updated):
+        """Create the error raised when some downloads of `download_all`
+        failed.
+
+        :param failed: dict mapping the paths of the failed sources to their
+            exceptions
+        :param updated: set of the paths that were updated
+        """
+        super().__init__("unable to download {}".format('; '.join(
+            '{}: {}'.format(os.path.basename(path), error)
+            for path, error in sorted(failed.items()))))
+        self.failed = failed
+        self.updated = updated
+
+
+def download(source):
+    """Download `source` to its path if it has changed since the last download.
+
+    The ETag and Last-Modified headers of the last download are kept next
+    to the file and sent back as a conditional request.  The data is
+    decompressed (if `source.gzipped`) while it is written to a temporary
+    file, which then replaces the file, so readers never see a partial file.
+
+    :param source: Source tuple
+    :return: if the file was updated
+    """
+    directory = os.path.dirname(source.path)
+    if not os.path.isdir(directory):
+        if os.path.lexists(directory):
+            raise NotADirectoryError('Download location exists but is not a directory.')
+        else:
+            os.makedirs(directory)
+    meta_path = source.path + '.meta'
+    headers = {}
+    if os.path.isfile(source.path):
+        try:
+            with open(meta_path, 'r') as f:
+                meta = json.load(f)
+        except FileNotFoundError:
+            meta = {}
+        if meta.get('etag'):
+            headers['If-None-Match'] = meta['etag']
+        if meta.get('last_modified'):
+            headers['If-Modified-Since'] = meta['last_modified']
+    request = urllib.request.Request(source.url, headers=headers)
+    try:
+        response = urllib.request.urlopen(request)
+    except urllib.error.HTTPError as e:
+        if e.code == 304:
+            return False
+        raise
+    with response:
+        meta = {'etag': response.headers.get('ETag'),
+                'last_modified': response.headers.get('Last-Modified')}
+        with atomic_write(source.path) as f:
+            if source.gzipped:
+                with gzip.GzipFile(fileobj=response, mode='rb') as data:
+                    shutil.copyfileobj(data, f, BLOCK_SIZE)
+            else:
+                shutil.copyfileobj(response, f, BLOCK_SIZE)
+    with atomic_write(meta_path, 'w') as f:
+        json.dump(meta, f)
+    return True
+
+
+def download_all(sources, *, max_workers=8):
+    """Download all `sources` in parallel, as by `download`.
+
+    A failed download does not stop the others.  Once they are all done,
+    DownloadError is raised if any failed, with the paths that were updated
+    nevertheless, so that the caller can still use them.
+
+    :param sources: iterable of Source tuples
+    :param max_workers: maximum number of simultaneous downloads
+    :return: set of the paths that were updated
+    """
+    updated = set()
+    failed = {}
+    with concurrent.futures.ThreadPoolExecutor(max_workers) as executor:
+        futures = {executor.submit(download, source): source
+                   for source in sources}
+        for future in concurrent.futures.as_completed(futures):
+            path = futures[future].path
+            name = os.path.basename(path)
+            try:
+                changed = future.result()
+            except Exception as e:
+                print("Warning: unable to download {}: {}".format(name, e))
+                failed[path] = e
+                continue
+            if changed:
+                print("Updated {}".format(name))
+                updated.add(path)
+            else:
+                print("{} is up to date".format(name))
+    if failed:
+        raise DownloadError(failed, updated)
+    return updated
+
+
+@contextlib.contextmanager
+def atomic_write(path, mode='wb'):
+    """Open a temporary file that replaces `path` when closed without error.
+
+    The file gets the permissions of a file created by open(), rather than
+    the private ones of temporary files.
+
+    :param path: path of the file to write
+    :param mode: mode to open the temporary file in
+    :return: context manager of a file object
+    """
+    fd, temp_path = tempfile.mkstemp(dir=os.path.dirname(path),
+                                     prefix='.' + os.path.basename(path),
+                                     suffix='.part')
+    try:
+        with os.fdopen(fd, mode) as f:
+            yield f
+        os.chmod(temp_path, FILE_MODE)
+        os.replace(temp_path, path)
+    except BaseException:
+        os.unlink(temp_path)
+        raise
@@ -0,0 +1,131 @@
+# Copyright (C) 2014  Jim Turner
+
+# This file is part of map_ssh_attempts.
+
+# map_ssh_attempts is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by the Free
+# Software Foundation, either version 2 of the License, or (at your option) any
+# later version.
+
+# This program is distributed in the hope that it will be useful, but WITHOUT ANY
+# WARRANTY; without even the implied warranty of MERCHANTABILITY or FITNESS FOR A
+# PARTICULAR PURPOSE.  See the GNU General Public License for more details.
+
+# You should have received a copy of the GNU General Public License along with
+# this program.  If not, see <http://www.gnu.org/licenses/>.
+
+import collections
+import functools
+from . import columns
+from . import geoindex
+from . import geoip
+from . import stats
+from . import tor
+
+
+Location = collections.namedtuple(
+    'Location', ('coordinate', 'country_name', 'is_tor', 'city'),
+    defaults=(None,))
+
+
+class Enricher(object):
+
+    def __init__(self, geoipmv=None, tordb=None, *, index=None,
+                 tor_lookup=False, maxsize=1 << 16):
+        """Create an object looking up GeoIP and Tor information of addresses.
+
+        Lookups are memoized in an LRU cache of `maxsize` addresses, since
+        most attempts come from a small set of addresses.  If `index` is
+        given, `locate_counts` instead resolves all unique addresses in one
+        batch through the index.
+
+        :param geoipmv: GeoIPMultiversion object to use
+        :param tordb: TorExitNodeDatabase object to use
+        :param index: GeoIPIndex object to use for batch lookups
+        :param tor_lookup: look up whether addresses are Tor exit nodes;
+            otherwise `is_tor` of locations is None
+        :param maxsize: maximum number of addresses to cache
+        """
+        self.geoipmv = geoipmv if geoipmv is not None else geoip.GeoIPMultiversion()
+        if tor_lookup and tordb is None:
+            tordb = tor.TorExitNodeDatabase()
+        self.tordb = tordb if tor_lookup else None
+        self.index = index
+        self.maxsize = maxsize
+        self.locate = functools.lru_cache(maxsize)(self._locate)
+
+    def _locate(self, addr):
+        record = self.geoipmv.record_by_addr(addr)
+        if record:
+            coordinate = geoip.Coordinate(record['longitude'], record['latitude'])
+            country_name = record.get('country_name')
+            city = record.get('city') or None
+        else:
+            coordinate = None
+            country_name = None
+            city = None
+        is_tor = None
+        if self.tordb is not None:
+            is_tor = self.tordb.is_tor_exit_node(addr)
+        return Location(coordinate, country_name, is_tor, city)
+
+    def cache_info(self):
+        """Return the hits, misses, maxsize and currsize of the lookup cache."""
+        return self.locate.cache_info()
+
+    def locate_counts(self, attempts):
+        """Look up the unique addresses of `attempts` once each.
+
+        :param attempts: iterable of Attempt tuples, or AttemptBatch object
+        :return: list of (address, Location, number of attempts) tuples
+        """
+        if isinstance(attempts, columns.AttemptBatch):
+            addrs, numbers = attempts.address_counts()
+            numbers = numbers.tolist()
+        else:
+            counts = collections.Counter(attempt.ip_address
+                                         for attempt in attempts)
+            addrs = list(counts)
+            numbers = list(counts.values())
+        return list(zip(addrs, self.locate_addresses(addrs), numbers))
+
+    def locate_addresses(self, addrs, *, city=False):
+        """Look up distinct addresses.
+
+        :param addrs: list of distinct IPv4Address or IPv6Address objects
+        :param city: the cities of the locations are needed; the GeoIP index
+            has none, so they are then looked up in the databases
+        :return: list of Location tuples parallel to `addrs`
+        """
+        with stats.stage('lookup'):
+            if self.index is None or city:
+                hits = self.cache_info().hits
+                locations = [self.locate(addr) for addr in addrs]
+                hits = self.cache_info().hits - hits
+            else:
+                locations = self._locate_bulk(addrs)
+                hits = 0
+        stats.count('lookup', lookups=len(addrs), cache_hits=hits)
+        if self.tordb is not None:
+            stats.count('lookup', tor_lookups=len(addrs) - hits)
+        return locations
+
+    def _locate_bulk(self, addrs):
+        found, longitudes, latitudes, country_codes = (
+            self.index.lookup_addresses(addrs))
+        if self.tordb is not None:
+            tor_flags = self.tordb.are_tor_exit_nodes(addrs)
+        located = []
+        for i in range(len(addrs)):
+            if found[i]:
+                coordinate = geoip.Coordinate(float(longitudes[i]),
+                                              float(latitudes[i]))
+                country_name = geoindex.country_name(bytes(country_codes[i]))
+            else:
+                coordinate = None
+                country_name = None
+            is_tor = None
+            if self.tordb is not None:
+                is_tor = bool(tor_flags[i])
+            located.append(Location(coordinate, country_name, is_tor))
+        return located
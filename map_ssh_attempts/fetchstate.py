@@ -0,0 +1,135 @@
+# Copyright (C) 2014  Jim Turner
+
+# This file is part of map_ssh_attempts.
+
+# map_ssh_attempts is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by the Free
+# Software Foundation, either version 2 of the License, or (at your option) any
+# later version.
+
+# This program is distributed in the hope that it will be useful, but WITHOUT ANY
+# WARRANTY; without even the implied warranty of MERCHANTABILITY or FITNESS FOR A
+# PARTICULAR PURPOSE.  See the GNU General Public License for more details.
+
+# You should have received a copy of the GNU General Public License along with
+# this program.  If not, see <http://www.gnu.org/licenses/>.
+
+import hashlib
+import json
+import os
+import os.path
+import tempfile
+
+
+class FetchState(object):
+
+    # Number of bytes at the start and end of the fetched data that are hashed
+    # to recognize the file again after it has been rotated.
+    chunk_size = 4096
+
+    def __init__(self, hostname, cache_dir='~/.cache/map_ssh_attempts'):
+        """Create an object remembering how much of a host's log was fetched.
+
+        :param hostname: the server the state belongs to
+        :param cache_dir: directory in which to place the state files
+        """
+        self.hostname = hostname
+        self.cache_dir = os.path.expanduser(cache_dir)
+        self.offset = 0
+        self.size = None
+        self.mtime = None
+        self.head_hash = None
+        self.tail_hash = None
+
+    @property
+    def path(self):
+        """Path of the file in which the state is saved."""
+        return os.path.join(self.cache_dir, 'fetch_state',
+                            '{}.json'.format(self.hostname))
+
+    def check_fetched(self):
+        """Check if any data has been fetched from the host before."""
+        return self.head_hash is not None
+
+    def load(self):
+        """Load state from the cache, if it exists."""
+        try:
+            with open(self.path, 'r') as f:
+                saved = json.load(f)
+        except FileNotFoundError:
+            return
+        self.restore(saved)
+
+    def restore(self, saved):
+        """Restore the state recorded by `to_dict`.
+
+        :param saved: dict as returned by `to_dict`
+        """
+        self.offset = saved['offset']
+        self.size = saved['size']
+        self.mtime = saved['mtime']
+        self.head_hash = saved['head_hash']
+        self.tail_hash = saved['tail_hash']
+
+    def to_dict(self):
+        """Return the state as a dict that can be serialized as JSON."""
+        return {'offset': self.offset,
+                'size': self.size,
+                'mtime': self.mtime,
+                'head_hash': self.head_hash,
+                'tail_hash': self.tail_hash}
+
+    def save(self):
+        """Save state to the cache."""
+        directory = os.path.dirname(self.path)
+        if not os.path.isdir(directory):
+            if os.path.lexists(directory):
+                raise NotADirectoryError('State location exists but is not a directory.')
+            else:
+                os.makedirs(directory)
+        saved = self.to_dict()
+        # Write to a temporary file first so that an interrupted save never
+        # leaves a truncated state file behind.
+        fd, temp_path = tempfile.mkstemp(dir=directory, suffix='.tmp')
+        with os.fdopen(fd, 'w') as f:
+            json.dump(saved, f)
+        os.replace(temp_path, self.path)
+
+    def matches(self, f):
+        """Check if file-like object `f` is the file the state was recorded from.
+
+        The file matches if its first bytes are the same and the bytes just
+        before `offset` are the same as when it was last fetched.
+
+        :param f: seekable binary file-like object
+        :return: if `f` is the previously fetched file
+        """
+        if not self.check_fetched():
+            return False
+        f.seek(0)
+        head = f.read(min(self.offset, self.chunk_size))
+        if hash_chunk(head) != self.head_hash:
+            return False
+        f.seek(max(0, self.offset - self.chunk_size))
+        tail = f.read(min(self.offset, self.chunk_size))
+        return hash_chunk(tail) == self.tail_hash
+
+    def advance(self, f, offset, attributes):
+        """Record that file-like object `f` has been fetched up to `offset`.
+
+        :param f: seekable binary file-like object
+        :param offset: number of bytes of `f` that have been fetched
+        :param attributes: stat result (e.g. SFTPAttributes) of `f`
+        """
+        f.seek(0)
+        self.head_hash = hash_chunk(f.read(min(offset, self.chunk_size)))
+        f.seek(max(0, offset - self.chunk_size))
+        self.tail_hash = hash_chunk(f.read(min(offset, self.chunk_size)))
+        self.offset = offset
+        self.size = attributes.st_size
+        self.mtime = attributes.st_mtime
+
+
+def hash_chunk(chunk):
+    """Return the hex digest identifying `chunk` of bytes."""
+    return hashlib.sha1(chunk).hexdigest()
@@ -0,0 +1,323 @@
+# Copyright (C) 2014  Jim Turner
+
+# This file is part of map_ssh_attempts.
+
+# map_ssh_attempts is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by the Free
+# Software Foundation, either version 2 of the License, or (at your option) any
+# later version.
+
+# This program is distributed in the hope that it will be useful, but WITHOUT ANY
+# WARRANTY; without even the implied warranty of MERCHANTABILITY or FITNESS FOR A
+# PARTICULAR PURPOSE.  See the GNU General Public License for more details.
+
+# You should have received a copy of the GNU General Public License along with
+# this program.  If not, see <http://www.gnu.org/licenses/>.
+
+import collections
+import ipaddress
+import numpy as np
+import os
+import os.path
+import pygeoip.const
+import shutil
+import tempfile
+from . import download
+from . import geoip
+from . import stats
+
+
+BulkLocations = collections.namedtuple(
+    'BulkLocations', ('found', 'longitude', 'latitude', 'country_code'))
+
+# Number of address bits, and number of leading address bits indexed, for
+# each IP version.  IPv6 networks are indexed down to /64, which is as fine as
+# GeoLite data gets in practice.
+ADDRESS_BITS = {4: 32, 6: 128}
+INDEX_BITS = {4: 32, 6: 64}
+
+ADDRESS_CLASSES = {4: ipaddress.IPv4Address, 6: ipaddress.IPv6Address}
+
+
+class GeoIPIndex(object):
+
+    index_dir = 'geoip_index'
+    # File naming the directory of the current build of the index
+    manifest_name = 'current'
+    range_arrays = ('starts', 'ends', 'locations')
+    location_arrays = ('longitudes', 'latitudes', 'country_codes')
+
+    def __init__(self, cache_dir='~/.cache/map_ssh_attempts'):
+        """Create an object to look up the locations of many addresses at once.
+
+        The index consists of the sorted address ranges of the GeoIP
+        databases, with parallel arrays of coordinates and country codes.
+        It is built from the databases by `build` and saved as ``.npy`` files,
+        which are memory-mapped when loaded.
+
+        Each build is saved in a directory of its own, and a manifest names
+        the current one, so that the files loaded together always come from
+        the same build, even while the index is being rebuilt.
+
+        :param cache_dir: directory in which to place the index
+        """
+        self.cache_dir = os.path.expanduser(cache_dir)
+        self.arrays = {}
+
+    @property
+    def manifest_path(self):
+        """Path of the file naming the current build."""
+        return os.path.join(self.cache_dir, GeoIPIndex.index_dir,
+                            GeoIPIndex.manifest_name)
+
+    def current_build(self):
+        """Return the name of the current build, or None if there is none."""
+        try:
+            with open(self.manifest_path, 'r') as f:
+                return f.read().strip() or None
+        except FileNotFoundError:
+            return None
+
+    def array_path(self, version, name, build=None):
+        """Return the path of array `name` of IP `version`.
+
+        :param version: IP version
+        :param name: name of the array
+        :param build: name of the build; defaults to the current one
+        """
+        if build is None:
+            build = self.current_build()
+        return os.path.join(self.cache_dir, GeoIPIndex.index_dir, build,
+                            'v{}_{}.npy'.format(version, name))
+
+    def check_cache(self):
+        """Check if the index files exist in cache."""
+        build = self.current_build()
+        if build is None:
+            return False
+        for version in geoip.GeoIPMultiversion.versions:
+            for name in GeoIPIndex.range_arrays + GeoIPIndex.location_arrays:
+                if not os.path.isfile(self.array_path(version, name, build)):
+                    return False
+        else:
+            return True
+
+    def build(self, geoipmv):
+        """Build the index from the databases of `geoipmv` and save it.
+
+        The new build replaces the current one once it is complete.  The
+        build it replaces is kept, since it may still be being loaded, and
+        older ones are removed.
+
+        :param geoipmv: GeoIPMultiversion object with up-to-date databases
+        """
+        directory = os.path.join(self.cache_dir, GeoIPIndex.index_dir)
+        if not os.path.isdir(directory):
+            os.makedirs(directory)
+        previous = self.current_build()
+        build = os.path.basename(tempfile.mkdtemp(prefix='build-',
+                                                  dir=directory))
+        try:
+            for version in geoip.GeoIPMultiversion.versions:
+                name = geoip.GeoIPMultiversion.db_names[version]
+                print("Indexing {}... ".format(name), end='')
+                arrays = build_arrays(
+                    geoipmv.db(version),
+                    os.path.join(geoipmv.cache_dir, name),
+                    version)
+                for array_name, array in arrays.items():
+                    np.save(self.array_path(version, array_name, build), array)
+                print("100%")
+            with download.atomic_write(self.manifest_path, 'w') as f:
+                f.write(build)
+        except BaseException:
+            shutil.rmtree(os.path.join(directory, build))
+            raise
+        for entry in os.listdir(directory):
+            path = os.path.join(directory, entry)
+            if entry not in (build, previous) and os.path.isdir(path):
+                shutil.rmtree(path, ignore_errors=True)
+            elif entry.endswith('.npy'):
+                # Left by versions saving the files of the index in place
+                os.unlink(path)
+        self.arrays = {}
+
+    def load(self):
+        """Memory-map the index files, building the index if necessary."""
+        if not self.check_cache():
+            self.build(geoip.GeoIPMultiversion(mode='memory'))
+        build = self.current_build()
+        self.arrays = {}
+        with stats.stage('load_index'):
+            for version in geoip.GeoIPMultiversion.versions:
+                self.arrays[version] = {
+                    name: np.load(self.array_path(version, name, build),
+                                  mmap_mode='r')
+                    for name in (GeoIPIndex.range_arrays +
+                                 GeoIPIndex.location_arrays)}
+
+    def check_loaded(self):
+        """Check if the index has been loaded."""
+        return bool(self.arrays)
+
+    def lookup(self, version, ips):
+        """Look up the locations of an array of integer addresses.
+
+        :param version: IP version of the addresses
+        :param ips: array of addresses as integers, or for IPv6 their leading
+            64 bits (see `address_ints`)
+        :return: BulkLocations of arrays parallel to `ips`; coordinates are
+            NaN and country codes empty where `found` is False
+        """
+        if not self.check_loaded():
+            self.load()
+        arrays = self.arrays[version]
+        ips = np.asarray(ips, dtype=np.uint64)
+        ranges = np.searchsorted(arrays['starts'], ips, side='right') - 1
+        found = ranges >= 0
+        ranges = np.maximum(ranges, 0)
+        found &= ips <= arrays['ends'][ranges]
+        locations = arrays['locations'][ranges]
+        longitude = np.where(found, arrays['longitudes'][locations], np.nan)
+        latitude = np.where(found, arrays['latitudes'][locations], np.nan)
+        country_code = np.where(found, arrays['country_codes'][locations], b'')
+        return BulkLocations(found, longitude, latitude, country_code)
+
+    def lookup_addresses(self, addrs):
+        """Look up the locations of a sequence of address objects.
+
+        :param addrs: sequence of IPv4Address or IPv6Address objects
+        :return: BulkLocations of arrays parallel to `addrs`
+        """
+        found = np.zeros(len(addrs), dtype=bool)
+        longitude = np.full(len(addrs), np.nan)
+        latitude = np.full(len(addrs), np.nan)
+        country_code = np.zeros(len(addrs), dtype='S2')
+        for version in geoip.GeoIPMultiversion.versions:
+            positions = np.array([i for i, addr in enumerate(addrs)
+                                  if addr.version == version], dtype=np.intp)
+            if not len(positions):
+                continue
+            result = self.lookup(
+                version, address_ints([addrs[i] for i in positions], version))
+            found[positions] = result.found
+            longitude[positions] = result.longitude
+            latitude[positions] = result.latitude
+            country_code[positions] = result.country_code
+        return BulkLocations(found, longitude, latitude, country_code)
+
+
+def address_ints(addrs, version):
+    """Convert address objects of IP `version` to an array for `lookup`.
+
+    :param addrs: iterable of IPv4Address or IPv6Address objects
+    :param version: IP version of the addresses
+    :return: uint64 array
+    """
+    shift = ADDRESS_BITS[version] - INDEX_BITS[version]
+    return np.fromiter((int(addr) >> shift for addr in addrs), dtype=np.uint64)
+
+
+def build_arrays(db, path, version):
+    """Walk the search tree of GeoIP City database `db` and build the index.
+
+    The tree is read from the database file at `path` and walked one level
+    at a time with NumPy.  Every leaf becomes an address range; leaves below
+    the indexed depth are folded into the range of their ancestor, using the
+    location of its lowest addresses.
+
+    :param db: pygeoip.GeoIP object of the database
+    :param path: path of the database file
+    :param version: IP version of the database
+    :return: dict of arrays, named as in `GeoIPIndex`
+    """
+    # The layout of the tree is not exposed by pygeoip, but the segment count
+    # and record length it determined are needed to walk it.
+    segments = getattr(db, '_databaseSegments', None)
+    record_length = getattr(db, '_recordLength', None)
+    if not isinstance(segments, int) or not isinstance(record_length, int):
+        raise geoip.GeoIPError(
+            "Unable to read the search tree of {}: this version of pygeoip "
+            "does not expose its layout".format(path))
+    raw = np.fromfile(path, dtype=np.uint8, count=segments * 2 * record_length)
+    raw = raw.reshape(segments, 2, record_length).astype(np.uint64)
+    tree = np.zeros((segments, 2), dtype=np.uint64)
+    for j in range(record_length):
+        tree |= raw[:, :, j] << np.uint64(8 * j)
+    del raw
+
+    bits = INDEX_BITS[version]
+    starts = []
+    ends = []
+    values = []
+    nodes = np.zeros(1, dtype=np.uint64)
+    prefixes = np.zeros(1, dtype=np.uint64)
+    for depth in range(1, bits + 1):
+        children = tree[nodes.astype(np.intp)].ravel()
+        prefixes = ((prefixes << np.uint64(1))[:, np.newaxis]
+                    + np.array([0, 1], dtype=np.uint64)).ravel()
+        leaf = children >= segments
+        shift = np.uint64(bits - depth)
+        starts.append(prefixes[leaf] << shift)
+        ends.append(((prefixes[leaf] + np.uint64(1)) << shift) - np.uint64(1))
+        values.append(children[leaf])
+        nodes = children[~leaf]
+        prefixes = prefixes[~leaf]
+        if not len(nodes):
+            break
+    else:
+        # Fold deeper subtrees into their leftmost leaf
+        while True:
+            inner = nodes < segments
+            if not inner.any():
+                break
+            nodes[inner] = tree[nodes[inner].astype(np.intp), 0]
+        starts.append(prefixes)
+        ends.append(prefixes)
+        values.append(nodes)
+    starts = np.concatenate(starts)
+    ends = np.concatenate(ends)
+    values = np.concatenate(values)
+
+    # Drop the ranges without records, and sort the rest
+    has_record = values != segments
+    order = np.argsort(starts[has_record], kind='stable')
+    starts = starts[has_record][order]
+    ends = ends[has_record][order]
+    values = values[has_record][order]
+
+    # Read each distinct record once, through an address in its first range
+    records, first, locations = np.unique(values, return_index=True,
+                                          return_inverse=True)
+    shift = ADDRESS_BITS[version] - bits
+    longitudes = np.full(len(records), np.nan)
+    latitudes = np.full(len(records), np.nan)
+    country_codes = np.zeros(len(records), dtype='S2')
+    for i, start in enumerate(starts[first]):
+        addr = ADDRESS_CLASSES[version](int(start) << shift)
+        record = db.record_by_addr(str(addr))
+        if record:
+            longitudes[i] = record['longitude']
+            latitudes[i] = record['latitude']
+            country_codes[i] = (record.get('country_code') or '').encode('ascii')
+    return {'starts': starts,
+            'ends': ends,
+            'locations': locations.astype(np.int32),
+            'longitudes': longitudes,
+            'latitudes': latitudes,
+            'country_codes': country_codes}
+
+
+_country_names = None
+
+
+def country_name(code):
+    """Return the name of the country with (bytes) `code`, or None."""
+    global _country_names
+    if _country_names is None:
+        _country_names = {
+            country_code.encode('ascii'): country_name
+            for country_code, country_name in zip(pygeoip.const.COUNTRY_CODES,
+                                                  pygeoip.const.COUNTRY_NAMES)
+            if country_code}
+    return _country_names.get(code)
@@ -15,12 +15,12 @@
 # this program.  If not, see <http://www.gnu.org/licenses/>.
 
 from pygeoip import GeoIPError
-import gzip
 import collections
 import os
 import os.path
 import pygeoip
-import urllib.request
+from . import download
+from . import stats
 
 
 Coordinate = collections.namedtuple('Coordinate', ('longitude', 'latitude'))
@@ -33,69 +33,103 @@ class GeoIPMultiversion(object):
                 6: 'GeoLiteCityv6.dat'}
     db_sources = {4: 'http://geolite.maxmind.com/download/geoip/database/GeoLiteCity.dat.gz',
                   6: 'http://geolite.maxmind.com/download/geoip/database/GeoLiteCityv6-beta/GeoLiteCityv6.dat.gz'}
-
-    def __init__(self, cache_dir='~/.cache/map_ssh_attempts'):
+    # How the database files are accessed: read from the file on each lookup,
+    # memory-mapped, or read into memory completely when loaded
+    load_modes = {'standard': pygeoip.STANDARD,
+                  'mmap': pygeoip.MMAP_CACHE,
+                  'memory': pygeoip.MEMORY_CACHE}
+
+    def __init__(self, cache_dir='~/.cache/map_ssh_attempts', *,
+                 mode='standard'):
         """Create an object to lookup GeoIP information regardless of IP version.
 
+        The database of each IP version is loaded the first time an address
+        of that version is looked up.
+
         :param cache_dir: directory in which to place the GeoIP databases
+        :param mode: how to access the databases; one of `load_modes`
         """
+        if mode not in GeoIPMultiversion.load_modes:
+            raise ValueError("Unknown `mode` value: {}".format(mode))
         self.cache_dir = os.path.expanduser(cache_dir)
+        self.mode = mode
         self.dbs = {}
 
+    def cache_sources(self):
+        """Return the list of download Sources of the GeoIP databases."""
+        return [download.Source(GeoIPMultiversion.db_sources[version],
+                                os.path.join(self.cache_dir,
+                                             GeoIPMultiversion.db_names[version]),
+                                True)
+                for version in GeoIPMultiversion.versions]
+
     def update_cache(self):
-        """Update GeoIP database cache."""
-        if not os.path.isdir(self.cache_dir):
-            if os.path.lexists(self.cache_dir):
-                raise NotADirectoryError('Download location exists but is not a directory.')
-            else:
-                os.makedirs(self.cache_dir)
-        for version in GeoIPMultiversion.versions:
-            name = GeoIPMultiversion.db_names[version]
-            url = GeoIPMultiversion.db_sources[version]
-            with open(os.path.join(self.cache_dir, name), 'wb') as f:
-                print("Updating {}... ".format(name), end='')
-                db_gz = urllib.request.urlopen(url).read()
-                db = gzip.decompress(db_gz)
-                f.write(db)
-                print("100%")
-
-    def check_cache(self):
-        """Check if GeoIP database files exist in cache."""
-        for version in GeoIPMultiversion.versions:
+        """Update GeoIP database cache.
+
+        :return: if any database was updated
+        """
+        return bool(download.download_all(self.cache_sources()))
+
+    def check_cache(self, versions=None):
+        """Check if GeoIP database files exist in cache.
+
+        :param versions: IP versions to check; defaults to all
+        """
+        if versions is None:
+            versions = GeoIPMultiversion.versions
+        for version in versions:
             name = GeoIPMultiversion.db_names[version]
             if not os.path.isfile(os.path.join(self.cache_dir, name)):
                 return False
         else:
             return True
 
+    def load_db(self, version):
+        """Load the GeoIP object of IP `version` from its database file."""
+        if not self.check_cache([version]):
+            self.update_cache()
+        name = GeoIPMultiversion.db_names[version]
+        print("Loading {}... ".format(name), end='')
+        with stats.stage('load_geoip'):
+            # pygeoip otherwise reuses any object loaded from the same file,
+            # whatever its mode
+            self.dbs[version] = pygeoip.GeoIP(
+                os.path.join(self.cache_dir, name),
+                GeoIPMultiversion.load_modes[self.mode], cache=False)
+        print("100%")
+
     def load_dbs(self):
         """Load GeoIP objects from database files."""
-        if not self.check_cache():
-            self.update_cache()
         self.dbs = {}
         for version in GeoIPMultiversion.versions:
-            name = GeoIPMultiversion.db_names[version]
-            print("Loading {}... ".format(name), end='')
-            self.dbs[version] = pygeoip.GeoIP(os.path.join(self.cache_dir, name))
-            print("100%")
+            self.load_db(version)
 
-    def check_loaded(self):
-        """Check if GeoIP databases have been loaded."""
-        for version in GeoIPMultiversion.versions:
+    def check_loaded(self, versions=None):
+        """Check if GeoIP databases have been loaded.
+
+        :param versions: IP versions to check; defaults to all
+        """
+        if versions is None:
+            versions = GeoIPMultiversion.versions
+        for version in versions:
             if not version in self.dbs:
                 return False
         else:
             return True
 
+    def db(self, version):
+        """Return the GeoIP object of IP `version`, loading it if necessary."""
+        if not self.check_loaded([version]):
+            self.load_db(version)
+        return self.dbs[version]
+
     def coord_by_addr(self, addr):
         """Given an IPv4Address or IPv6Address, return a location Coordinate.
 
         :param addr: IPv4Address or IPv6Address object with address of host
         :return: Coordinate object
         """
-        if not self.check_loaded():
-            self.load_dbs()
-        record = self.dbs[addr.version].record_by_addr(str(addr))
+        record = self.db(addr.version).record_by_addr(str(addr))
         if record:
             return Coordinate(record['longitude'], record['latitude'])
         else:
@@ -104,9 +138,7 @@ class GeoIPMultiversion(object):
     def __getattr__(self, name):
         if name.endswith('_by_addr'):
             def f(addr):
-                if not self.check_loaded():
-                    self.load_dbs()
-                return getattr(self.dbs[addr.version], name)(str(addr))
+                return getattr(self.db(addr.version), name)(str(addr))
             return f
         else:
             raise AttributeError("'GeoIPMultiversion' has no attribute '{}'".format(name))
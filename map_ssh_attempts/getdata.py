@@ -15,96 +15,1514 @@
 # this program.  If not, see <http://www.gnu.org/licenses/>.
 
 import collections
+import concurrent.futures
+import contextlib
 import datetime
+import functools
+import gzip
+import io
 import ipaddress
-import paramiko.client
+import itertools
+import os
+import os.path
+import queue
 import re
+import shlex
+import socket
+import sys
 import tempfile
+import threading
+import zlib
+from . import columns
+from . import connection
+from . import fetchstate
+from . import stats
+from .columns import Attempt, HostAttempt
 
 
-Attempt = collections.namedtuple('Attempt', ('datetime', 'username', 'ip_address'))
+LogSegment = collections.namedtuple('LogSegment', ('path', 'offset', 'end'),
+                                    defaults=(None,))
 
+AUTH_LOG = '/var/log/auth.log'
 
-def get_data(hostname):
-    """Perform all operations necessary to get, parse, and yield attempts.
+# Size of the blocks in which remote files are copied
+BLOCK_SIZE = 1 << 20
+
+# Size of the SFTP read requests, the number of bytes requested at once while
+# streaming, and the number of blocks buffered ahead of the consumer
+PREFETCH_REQUEST_SIZE = 32768
+PREFETCH_WINDOW = 1 << 22
+PREFETCH_QUEUE = 256
+
+# Seconds to wait for new data before checking whether to stop following
+FOLLOW_POLL = 1.0
+
+# How far log timestamps may be ahead of the local clock, because of the time
+# zone or the clock of the server, and still be taken to be from this year
+CLOCK_SKEW = datetime.timedelta(days=1)
+
+# Extended regular expression selecting the lines that may report attempts,
+# run by grep on the server.  It matches every line `LineParser` parses.
+CANDIDATE_PATTERN = r'sshd\[.*(Invalid user |not allowed)'
+
+# Commands compressing the filtered lines on the server, by compression name
+COMPRESS_COMMANDS = {'gzip': 'gzip -1 -c',
+                     'zstd': 'zstd -1 -c -q',
+                     'none': None}
+
+
+def get_new_data(hostname, *, state=None, since=None, until=None,
+                 stream=False, prefilter=None, pool=None, progress=True):
+    """Get and parse the attempts logged since the last fetch from `hostname`.
+
+    The fetch state is advanced but not saved, so the caller can save it
+    along with the attempts (see `AttemptStore.add`).
+
+    On the first fetch from `hostname`, only the part of the logs between
+    `since` and `until` is fetched, and the next fetch carries on from its
+    end.  The attempts logged before `since` are then never fetched.
 
     :param hostname: the server to connect to
-    :return: generator of tuples of the form (datetime, username, ip_address)
+    :param state: FetchState object of `hostname`; by default, the state is
+        loaded from its file
+    :param since: datetime from which to fetch on the first fetch
+    :param until: datetime up to which to fetch on the first fetch
+    :param stream: parse the log while it is downloaded
+    :param prefilter: compression of the filtered transfer, or None to
+        transfer the whole log (see `filter_auth_log`)
+    :param pool: SSHConnectionPool to take the connection from
+    :param progress: print the progress of the download
+    :return: tuple of (AttemptBatch object, FetchState object)
     """
-    return parse_log(open_auth_log(hostname))
+    open_log = _log_opener(stream, prefilter)
+    if state is None:
+        state = fetchstate.FetchState(hostname)
+        state.load()
+    first_fetch = not state.check_fetched()
+    attempts = columns.AttemptBatch.concatenate(parse_log_batches(
+        open_log(hostname, state=state, since=since, until=until, pool=pool,
+                 progress=progress)))
+    if first_fetch:
+        attempts = attempts.filter(since=since, until=until)
+    return attempts, state
 
 
-def print_download_progress(done, todo):
-    """Print the progress of a download.
+def update_store(store, hostnames, *, since=None, until=None, stream=False,
+                 prefilter=None, max_workers=16, timeout=30):
+    """Fetch the new attempts of `hostnames` and add them to `store`.
 
-    :param done: portion completed
-    :param todo: total amount that needs to be done
+    The fetch states of the hosts are kept in `store`, and each is saved
+    with the attempts it covers.
+
+    :param store: AttemptStore object
+    :param hostnames: list of servers to connect to
+    :param since: datetime from which to fetch the hosts fetched for the
+        first time (see `get_new_data`)
+    :param until: datetime up to which to fetch the hosts fetched for the
+        first time
+    :param stream: parse the logs while they are downloaded
+    :param prefilter: compression of the filtered transfer, or None to
+        transfer whole logs (see `filter_auth_log`)
+    :param max_workers: maximum number of hosts fetched at the same time
+    :param timeout: timeout in seconds for connecting to a host
+    :return: number of attempts added
     """
-    print('Downloading auth.log... {:.0%}'.format(done/todo), end='\r')
+    # The store is only used from this thread
+    states = {hostname: store.load_fetch_state(hostname)
+              for hostname in hostnames}
+    if len(hostnames) == 1:
+        results = [(hostnames[0], get_new_data(
+            hostnames[0], state=states[hostnames[0]], since=since,
+            until=until, stream=stream, prefilter=prefilter))]
+    else:
+        results = for_each_host(
+            hostnames,
+            lambda hostname, pool: get_new_data(
+                hostname, state=states[hostname], since=since, until=until,
+                stream=stream, prefilter=prefilter, pool=pool,
+                progress=False),
+            max_workers=max_workers, timeout=timeout)
+    added = 0
+    for hostname, (attempts, state) in results:
+        with stats.stage('store'):
+            count = store.add(hostname, attempts, state=state)
+        print("Stored {} new attempts from {}".format(count, hostname))
+        added += count
+    return added
 
 
-def open_auth_log(hostname, *args, **kwargs):
+def for_each_host(hostnames, fetch, *, max_workers=16, timeout=30):
+    """Call `fetch` for each of `hostnames` concurrently.
+
+    Each host is handled by a worker thread, with connections taken from a
+    shared SSHConnectionPool.  Results are generated as soon as a host is
+    done, so slow hosts do not hold up the others.  Hosts that fail are
+    reported and skipped.
+
+    :param hostnames: iterable of servers to connect to
+    :param fetch: function taking a hostname and an SSHConnectionPool
+    :param max_workers: maximum number of hosts handled at the same time
+    :param timeout: timeout in seconds for connecting to a host
+    :return: generator of (hostname, result) tuples
+    """
+    with connection.SSHConnectionPool(timeout=timeout,
+                                      banner_timeout=timeout,
+                                      auth_timeout=timeout) as pool:
+        with concurrent.futures.ThreadPoolExecutor(max_workers) as executor:
+            futures = {executor.submit(fetch, hostname, pool): hostname
+                       for hostname in hostnames}
+            for future in concurrent.futures.as_completed(futures):
+                hostname = futures[future]
+                try:
+                    result = future.result()
+                except Exception as e:
+                    print("Warning: unable to get data from {}: {}".format(
+                        hostname, e))
+                    pool.discard(hostname)
+                    continue
+                yield hostname, result
+
+
+def read_inventory(path):
+    """Read the hostnames listed in inventory file `path`.
+
+    The file lists one hostname per line.  Blank lines and text following a
+    ``#`` are ignored.
+
+    :param path: path of the inventory file
+    :return: list of hostnames
+    """
+    hostnames = []
+    with open(path, 'r') as f:
+        for line in f:
+            hostname = line.split('#', 1)[0].strip()
+            if hostname:
+                hostnames.append(hostname)
+    return hostnames
+
+
+def _log_opener(stream, prefilter):
+    """Return the function opening remote logs as selected by `get_new_data`."""
+    if prefilter is not None:
+        return functools.partial(filter_auth_log, compression=prefilter)
+    return stream_auth_log if stream else open_auth_log
+
+
+def open_auth_log(hostname, *args, state=None, since=None, until=None,
+                  pool=None, progress=True, **kwargs):
     """Open a readonly file-like object that reads /etc/log/auth.log on `hostname`.
 
+    If `state` is given, only the data appended since the fetch recorded in
+    `state` is downloaded, including the unseen parts of rotated logs, and
+    `state` is advanced accordingly.  (It is not saved.)
+
+    Otherwise, or if `state` records no fetch, `since` and `until` restrict
+    the download to the lines logged in that time window, which are located
+    by bisecting the logs (see `plan_window`).
+
     :param hostname: the server to connect to
     :param args: extra args to pass to SSHClient.connect()
+    :param state: FetchState object of `hostname`
+    :param since: datetime of the earliest lines to download
+    :param until: datetime after the latest lines to download
+    :param pool: SSHConnectionPool to take the connection from instead of
+        connecting with `args` and `kwargs`
+    :param progress: print the progress of the download
     :param kwargs: extra keyword args to pass to SSHClient.connect()
     :return: TemporaryFile object with log file contents
     """
     # Initiate connection
-    client = paramiko.client.SSHClient()
-    client.load_system_host_keys()
-    kwargs['compress'] = kwargs.get('compress', True)
-    client.connect(hostname, *args, **kwargs)
+    if pool is None:
+        client = connection.connect(hostname, *args, **kwargs)
+        sftp = client.open_sftp()
+    else:
+        sftp = pool.open_sftp(hostname)
 
     # Copy file
     temp = tempfile.TemporaryFile()
-    sftp = client.open_sftp()
-    sftp.getfo('/var/log/auth.log', temp, print_download_progress)
-    sftp.close()
-    print()
+    with stats.stage('download'):
+        for block in read_log_blocks(sftp, state, since=since, until=until,
+                                     progress=progress):
+            temp.write(block)
+    if pool is None:
+        sftp.close()
+    if progress:
+        print()
 
     # Seek back to beginning of file for reading
     temp.seek(0)
     return temp
 
 
-def parse_datetime(string, fmt=None):
+def stream_auth_log(hostname, *args, state=None, since=None, until=None,
+                    pool=None, progress=True, **kwargs):
+    """Open a readonly iterable of the lines of /var/log/auth.log on `hostname`.
+
+    Unlike `open_auth_log`, the log is not spooled to a local file.  It is
+    read in large, prefetched blocks while its lines are being consumed, so
+    parsing overlaps the transfer and memory use is bounded.
+
+    If `state` is given, only the data appended since the fetch recorded in
+    `state` is read, and `state` is advanced once the lines are exhausted.
+    (It is not saved.)  The data read is restricted by `since` and `until`
+    as by `open_auth_log`.
+
+    :param hostname: the server to connect to
+    :param args: extra args to pass to SSHClient.connect()
+    :param state: FetchState object of `hostname`
+    :param since: datetime of the earliest lines to read
+    :param until: datetime after the latest lines to read
+    :param pool: SSHConnectionPool to take the connection from instead of
+        connecting with `args` and `kwargs`
+    :param progress: print the progress of the download
+    :param kwargs: extra keyword args to pass to SSHClient.connect()
+    :return: LogStream object
+    """
+    if pool is None:
+        client = connection.connect(hostname, *args, **kwargs)
+        sftp = client.open_sftp()
+
+        def close():
+            sftp.close()
+            client.close()
+    else:
+        sftp = pool.open_sftp(hostname)
+        close = None
+    blocks = read_log_blocks(sftp, state, since=since, until=until,
+                             progress=progress)
+    return LogStream(blocks, close, progress=progress)
+
+
+def filter_auth_log(hostname, *args, state=None, since=None, until=None,
+                    pool=None, compression='gzip', progress=True, **kwargs):
+    """Open a readonly iterable of the candidate lines of auth.log on `hostname`.
+
+    Like `stream_auth_log`, but the log is filtered on the server: only the
+    lines that may report attempts (see `CANDIDATE_PATTERN`) are
+    transferred, compressed with `compression`, which is one of:
+
+    * ``'gzip'``: gzip, which every server has
+    * ``'zstd'``: Zstandard, which needs ``zstd`` on the server and the
+      ``zstandard`` module here
+    * ``'none'``: no compression
+
+    The log is still located and `state` advanced through SFTP, so this
+    needs both SFTP and a shell with ``tail``, ``head`` and ``grep`` on the
+    server.
+
+    :param hostname: the server to connect to
+    :param args: extra args to pass to SSHClient.connect()
+    :param state: FetchState object of `hostname`
+    :param since: datetime of the earliest lines to read (see
+        `open_auth_log`)
+    :param until: datetime after the latest lines to read
+    :param pool: SSHConnectionPool to take the connection from instead of
+        connecting with `args` and `kwargs`
+    :param compression: compression of the transferred lines
+    :param progress: print the progress of the download
+    :param kwargs: extra keyword args to pass to SSHClient.connect()
+    :return: LogStream object
+    """
+    if compression not in COMPRESS_COMMANDS:
+        raise ValueError("Unknown `compression` value: {}".format(compression))
+    if compression == 'zstd':
+        # Fail before connecting if the optional module is missing
+        import zstandard
+    if pool is None:
+        client = connection.connect(hostname, *args, **kwargs)
+        sftp = client.open_sftp()
+
+        def close():
+            sftp.close()
+            client.close()
+    else:
+        client = pool.client(hostname)
+        sftp = pool.open_sftp(hostname)
+        close = None
+    blocks = read_filtered_blocks(client, sftp, state, since=since,
+                                  until=until, compression=compression,
+                                  progress=progress)
+    return LogStream(blocks, close, progress=progress)
+
+
+class LogStream(object):
+
+    def __init__(self, blocks, close=None, *, progress=False):
+        """Create an iterable of the lines in an iterable of blocks of bytes.
+
+        :param blocks: iterable of blocks of bytes
+        :param close: function to call when the stream is closed
+        :param progress: print a newline when the stream is closed, to end
+            the progress output
+        """
+        self.blocks = stats.timed('download', blocks)
+        self._close = close
+        self.progress = progress
+        self.closed = False
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+    def __iter__(self):
+        pending = b''
+        for block in self.blocks:
+            lines = (pending + block).split(b'\n')
+            pending = lines.pop()
+            yield from lines
+        if pending:
+            yield pending
+
+    def close(self):
+        """Stop reading and release the connection."""
+        if self.closed:
+            return
+        self.closed = True
+        if hasattr(self.blocks, 'close'):
+            self.blocks.close()
+        if self._close is not None:
+            self._close()
+        if self.progress:
+            print()
+
+
+def follow_log(client, path=AUTH_LOG, *, stop=None):
+    """Generate the blocks of data appended to remote log `path` from now on.
+
+    ``tail -F`` is run on the server over an SSH channel that stays open, so
+    data is received as soon as it is logged, and `path` keeps being followed
+    when the log is rotated.
+
+    :param client: connected SSHClient object
+    :param path: path of the log on the remote server
+    :param stop: threading.Event object; following stops once it is set
+    :return: generator of blocks of bytes
+    """
+    channel = client.get_transport().open_session()
+    try:
+        channel.settimeout(FOLLOW_POLL)
+        channel.exec_command('tail -n 0 -F {}'.format(shlex.quote(path)))
+        while stop is None or not stop.is_set():
+            try:
+                block = channel.recv(BLOCK_SIZE)
+            except socket.timeout:
+                continue
+            if not block:
+                try:
+                    error = channel.recv_stderr(BLOCK_SIZE)
+                except socket.timeout:
+                    error = b''
+                raise IOError("tail exited with status {}: {}".format(
+                    channel.recv_exit_status(),
+                    error.decode('UTF-8', 'replace').strip()))
+            yield block
+    finally:
+        channel.close()
+
+
+class AttemptFollower(object):
+
+    def __init__(self, hostnames, *, timeout=30):
+        """Follow the logs of `hostnames` and collect attempts as they occur.
+
+        Each host is followed by a background thread, as by `follow_log`,
+        which parses the new lines and queues their attempts until they are
+        taken by `poll`.  Hosts that fail are reported and dropped.
+
+        :param hostnames: iterable of servers to connect to
+        :param timeout: timeout in seconds for connecting to a host
+        """
+        self.pool = connection.SSHConnectionPool(timeout=timeout,
+                                                 banner_timeout=timeout,
+                                                 auth_timeout=timeout)
+        self.attempts = queue.Queue()
+        self.stop = threading.Event()
+        self.threads = [threading.Thread(target=self._follow, args=(hostname,),
+                                         daemon=True)
+                        for hostname in hostnames]
+        for thread in self.threads:
+            thread.start()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+    def _follow(self, hostname):
+        try:
+            blocks = follow_log(self.pool.client(hostname), stop=self.stop)
+            parse_line = LineParser(datetime.datetime.now().year)
+            for line in LogStream(blocks):
+                # Log timestamps carry no year, so it is taken from the clock
+                # and updated when the year changes while following.
+                if parse_line.year != datetime.datetime.now().year:
+                    parse_line = LineParser(datetime.datetime.now().year)
+                attempt = parse_line(line)
+                if attempt is not None:
+                    self.attempts.put(HostAttempt(hostname, *attempt))
+        except Exception as e:
+            if not self.stop.is_set():
+                print("Warning: stopped following {}: {}".format(hostname, e))
+
+    def poll(self):
+        """Return the attempts collected since the last call, oldest first.
+
+        :return: list of HostAttempt tuples
+        """
+        attempts = []
+        while True:
+            try:
+                attempts.append(self.attempts.get_nowait())
+            except queue.Empty:
+                return attempts
+
+    def close(self):
+        """Stop following and close the connections."""
+        self.stop.set()
+        for thread in self.threads:
+            thread.join()
+        self.pool.close()
+
+
+def read_log_blocks(sftp, state=None, path=AUTH_LOG, *, since=None,
+                    until=None, progress=True):
+    """Generate blocks of the data of `path` not yet recorded in `state`.
+
+    If `state` is None, all of `path` is read.  Otherwise, only the data
+    appended since the recorded fetch is read, including the unseen parts of
+    rotated logs, and `state` is advanced after the last block.  If nothing
+    has been fetched yet, `since` and `until` restrict the data read to the
+    lines logged in that time window (see `plan_window`).
+
+    The live log is only read up to its last complete line, since the rest
+    of the line may still be being written.
+
+    :param sftp: SFTPClient object
+    :param state: FetchState object
+    :param path: path of the log on the remote server
+    :param since: datetime of the earliest lines to read
+    :param until: datetime after the latest lines to read
+    :param progress: print the progress of the download
+    :return: generator of blocks of bytes
+    """
+    segments = plan_segments(sftp, state, path, since=since, until=until)
+    for segment in segments[:-1]:
+        yield from read_remote_log(
+            sftp, segment.path, segment.offset,
+            print_copy_progress(segment.path) if progress else None,
+            end=segment.end)
+    last = segments[-1]
+    attributes = sftp.stat(last.path)
+    offset = last.offset
+    blocks = read_remote_log(
+        sftp, last.path, offset,
+        print_copy_progress(last.path) if progress else None, end=last.end)
+    for block in complete_lines(blocks):
+        offset += len(block)
+        yield block
+    if state is not None:
+        with open_remote_log(sftp, last.path) as f:
+            state.advance(f, offset, attributes)
+
+
+def read_filtered_blocks(client, sftp, state=None, path=AUTH_LOG, *,
+                         since=None, until=None, compression='gzip',
+                         progress=True):
+    """Generate blocks of the candidate lines of `path` not yet recorded in
+    `state`, filtered on the server.
+
+    The logs are selected as by `read_log_blocks`, and the live log is
+    filtered up to its last complete line when the filtering starts.
+
+    :param client: connected SSHClient object
+    :param sftp: SFTPClient object of `client`
+    :param state: FetchState object
+    :param path: path of the log on the remote server
+    :param since: datetime of the earliest lines to read
+    :param until: datetime after the latest lines to read
+    :param compression: compression of the transferred lines (see
+        `filter_auth_log`)
+    :param progress: print the progress of the download
+    :return: generator of blocks of bytes
+    """
+    segments = plan_segments(sftp, state, path, since=since, until=until)
+    for segment in segments[:-1]:
+        length = None
+        if segment.end is not None:
+            length = segment.end - segment.offset
+        yield from decompress_blocks(run_remote_command(
+            client,
+            filter_command(segment.path, segment.offset, length,
+                           compression=compression),
+            print_copy_progress(segment.path) if progress else None),
+            compression)
+    last = segments[-1]
+    attributes = sftp.stat(last.path)
+    offset = last.offset
+    if last.end is not None:
+        end = last.end
+    elif last.path.endswith('.gz'):
+        end = None
+    else:
+        with sftp.open(last.path, 'rb') as f:
+            end = last_line_end(f, offset, attributes.st_size)
+    yield from decompress_blocks(run_remote_command(
+        client,
+        filter_command(last.path, offset,
+                       end - offset if end is not None else None,
+                       compression=compression),
+        print_copy_progress(last.path) if progress else None),
+        compression)
+    if state is not None:
+        with open_remote_log(sftp, last.path) as f:
+            if end is None:
+                # The whole compressed log was filtered
+                end = sum(len(block) for block
+                          in iter(functools.partial(f.read, BLOCK_SIZE), b''))
+            state.advance(f, end, attributes)
+
+
+def filter_command(path, offset=0, length=None, *, compression='gzip'):
+    """Return the shell command printing the candidate lines of a remote log.
+
+    :param path: path of the log on the remote server
+    :param offset: position to start filtering from (in the decompressed
+        data, for compressed logs)
+    :param length: number of bytes to filter, or None to filter to the end
+    :param compression: compression of the output (see `filter_auth_log`)
+    :return: command string
+    """
+    if path.endswith('.gz'):
+        command = 'gzip -dc {} | tail -c +{}'.format(shlex.quote(path),
+                                                      offset + 1)
+    else:
+        command = 'tail -c +{} {}'.format(offset + 1, shlex.quote(path))
+    if length is not None:
+        command += ' | head -c {}'.format(length)
+    # grep exits with status 1 when no line matches, as in quiet intervals
+    command += ' | {{ LC_ALL=C grep -a -E {} || [ $? -eq 1 ]; }}'.format(
+        shlex.quote(CANDIDATE_PATTERN))
+    if COMPRESS_COMMANDS[compression] is not None:
+        command += ' | ' + COMPRESS_COMMANDS[compression]
+    return command
+
+
+def run_remote_command(client, command, callback=None):
+    """Generate the blocks of the output of `command` run on the server.
+
+    :param client: connected SSHClient object
+    :param command: shell command to run
+    :param callback: function called with the number of bytes received so far
+    :return: generator of blocks of bytes
+    """
+    channel = client.get_transport().open_session()
+    done = 0
+    try:
+        channel.exec_command(command)
+        while True:
+            block = channel.recv(BLOCK_SIZE)
+            if not block:
+                break
+            done += len(block)
+            if callback is not None:
+                callback(done)
+            yield block
+        status = channel.recv_exit_status()
+        error = channel.recv_stderr(BLOCK_SIZE)
+        if status != 0 or error:
+            raise IOError("`{}` failed with status {}: {}".format(
+                command, status, error.decode('UTF-8', 'replace').strip()))
+    finally:
+        channel.close()
+        stats.count('download', bytes=done)
+
+
+def last_line_end(f, start, end):
+    """Return the position after the last newline of `f` within a range.
+
+    :param f: seekable binary file-like object
+    :param start: start of the range
+    :param end: end of the range
+    :return: position after the last newline, or `start` if there is none
+    """
+    while end > start:
+        begin = max(start, end - PREFETCH_REQUEST_SIZE)
+        f.seek(begin)
+        data = f.read(end - begin)
+        newline = data.rfind(b'\n')
+        if newline >= 0:
+            return begin + newline + 1
+        end = begin
+    return start
+
+
+def plan_fetch(sftp, state, path=AUTH_LOG):
+    """Determine which parts of the remote logs have not been fetched yet.
+
+    SFTP does not expose inode numbers, so a log is recognized by the hashes
+    of its first bytes and of the bytes before the fetched offset.  If the
+    live log is no longer the file that was fetched, the rotated logs are
+    searched for it, and everything logged after it is fetched too.
+
+    :param sftp: SFTPClient object
+    :param state: FetchState object
+    :param path: path of the live log on the remote server
+    :return: list of LogSegment objects, oldest first, ending with `path`
+    """
+    if not state.check_fetched():
+        return [LogSegment(path, 0)]
+    with open_remote_log(sftp, path) as f:
+        if state.matches(f):
+            return [LogSegment(path, state.offset)]
+    newer = []
+    for rotated in rotated_log_paths(sftp, path):
+        with open_remote_log(sftp, rotated) as f:
+            if state.matches(f):
+                segments = [LogSegment(rotated, state.offset)]
+                segments.extend(LogSegment(p, 0) for p in reversed(newer))
+                segments.append(LogSegment(path, 0))
+                return segments
+        newer.append(rotated)
+    print("Warning: previously fetched log not found on {}; fetching {} "
+          "from the beginning".format(state.hostname, path))
+    return [LogSegment(path, 0)]
+
+
+def plan_segments(sftp, state=None, path=AUTH_LOG, *, since=None, until=None):
+    """Determine which parts of the remote logs to read.
+
+    These are the parts not fetched yet if `state` records a fetch (see
+    `plan_fetch`), and otherwise the parts logged between `since` and
+    `until` (see `plan_window`), or the whole live log if neither is given.
+
+    :param sftp: SFTPClient object
+    :param state: FetchState object
+    :param path: path of the live log on the remote server
+    :param since: datetime of the earliest lines to read
+    :param until: datetime after the latest lines to read
+    :return: list of LogSegment objects, oldest first
+    """
+    if state is not None and state.check_fetched():
+        return plan_fetch(sftp, state, path)
+    if since is None and until is None:
+        return [LogSegment(path, 0)]
+    return plan_window(sftp, since, until, path)
+
+
+def plan_window(sftp, since=None, until=None, path=AUTH_LOG):
+    """Determine which parts of the remote logs hold the lines logged between
+    `since` and `until`.
+
+    Syslog lines are in time order, so the boundaries of the window are
+    found by bisecting the logs, reading a line at each probed offset.  If
+    the live log starts after `since`, the rotated logs are searched too,
+    newest first, until one starts at or before `since`.  Compressed logs
+    cannot be bisected, as seeking backwards in them decompresses them again
+    from the start, so their lines are scanned once instead (see
+    `scan_window`).
+
+    Timestamps carry no year, and are taken to be from the latest year in
+    which they are not after tomorrow (see `parse_datetime`), so that the
+    times are still in order across the turn of the year.
+
+    :param sftp: SFTPClient object
+    :param since: datetime of the earliest lines to read, or None to start
+        at the beginning of the live log
+    :param until: datetime after the latest lines to read, or None to read
+        to the end of the live log
+    :param path: path of the live log on the remote server
+    :return: list of LogSegment objects, oldest first; if no log has lines
+        in the window, an empty segment of the live log
+    """
+    parse_line = LineParser()
+    since = columns.to_timestamp(since) if since is not None else None
+    until = columns.to_timestamp(until) if until is not None else None
+    paths = [path]
+    if since is not None:
+        paths = itertools.chain(paths, rotated_log_paths(sftp, path))
+    segments = []
+    for log_path in paths:
+        with open_remote_log(sftp, log_path) as f:
+            if log_path.endswith('.gz'):
+                size = None
+            else:
+                size = sftp.stat(log_path).st_size
+                if log_path == path:
+                    size = last_line_end(f, 0, size)
+            first = probe_line(f, 0, 0, size, parse_line)[2]
+            if first is None:
+                # Empty, or no line has a timestamp
+                continue
+            if until is None or first < until:
+                start = 0
+                end = None
+                if size is None:
+                    if (since is not None and first < since or
+                            until is not None):
+                        start, end = scan_window(f, since, until, parse_line)
+                else:
+                    if since is not None and first < since:
+                        start = find_time_offset(f, since, 0, size, parse_line)
+                    if until is not None:
+                        end = find_time_offset(f, until, start, size,
+                                               parse_line)
+                segments.append(LogSegment(log_path, start, end))
+            if since is None or first <= since:
+                break
+    if not segments:
+        return [LogSegment(path, 0, 0)]
+    segments.reverse()
+    return segments
+
+
+def find_time_offset(f, when, start, end, parse_line):
+    """Return the offset of the first line of `f` logged at or after `when`.
+
+    The lines between `start` and `end` must be in time order.  Lines
+    without a timestamp are skipped when probing.
+
+    :param f: seekable binary file-like object
+    :param when: time as returned by `columns.to_timestamp`
+    :param start: offset of the start of a line
+    :param end: offset of the end of a line
+    :param parse_line: LineParser object reading the timestamps
+    :return: offset of the start of the line, or `end` if there is none
+    """
+    low = start
+    high = end
+    while low < high:
+        line_start, line_end, timestamp = probe_line(
+            f, (low + high) // 2, low, high, parse_line)
+        if line_start >= high:
+            # No line starts in the upper half
+            line_start, line_end, timestamp = probe_line(f, low, low, high,
+                                                         parse_line)
+        if timestamp is not None and timestamp < when:
+            low = line_end
+        else:
+            high = line_start
+    return low
+
+
+def scan_window(f, since, until, parse_line):
+    """Return the offsets of the lines of `f` logged between `since` and
+    `until`, reading its lines in order.
+
+    This is `find_time_offset` for files that are only read efficiently in
+    order, such as compressed logs.  Lines without a timestamp are taken to
+    be logged with the next line that has one.
+
+    :param f: binary file-like object, at its start
+    :param since: time as returned by `columns.to_timestamp`, or None
+    :param until: time as returned by `columns.to_timestamp`, or None
+    :param parse_line: LineParser object reading the timestamps
+    :return: tuple of (offset of the start of the first line logged at or
+        after `since`, offset of the start of the first line logged at or
+        after `until`, or None if there is none); the first is the end of
+        the last line with a timestamp if no line is logged at or after
+        `since`
+    """
+    start = 0 if since is None else None
+    # Start of the lines taken to be logged with the next timestamp
+    pending = 0
+    for offset, line in read_lines(f, 0):
+        timestamp = parse_line.line_timestamp(line)
+        if timestamp is not None:
+            if start is None and timestamp >= since:
+                start = pending
+            if until is not None and timestamp >= until:
+                return (start if start is not None else pending), pending
+            pending = offset + len(line) + 1
+    return (start if start is not None else pending), None
+
+
+def probe_line(f, position, start, end, parse_line):
+    """Read the first line of `f` starting at or after `position` that has a
+    timestamp.
+
+    :param f: seekable binary file-like object
+    :param position: offset to probe
+    :param start: offset of the start of a line, at or before `position`
+    :param end: offset of the end of a line to stop reading at, or None to
+        read to the end of `f`
+    :param parse_line: LineParser object reading the timestamps
+    :return: tuple of (offset of the first line starting at or after
+        `position`, offset of the end of the line with a timestamp,
+        timestamp); the last two are None if no line has a timestamp, and
+        the first is `end` if no line starts
+    """
+    if position > start:
+        # Start in the previous line, which is then skipped, in case
+        # `position` is the start of a line
+        lines = read_lines(f, position - 1, end)
+        next(lines, None)
+    else:
+        lines = read_lines(f, position, end)
+    first = None
+    for offset, line in lines:
+        if first is None:
+            first = offset
+        timestamp = parse_line.line_timestamp(line)
+        if timestamp is not None:
+            line_end = offset + len(line) + 1
+            if end is not None:
+                line_end = min(line_end, end)
+            return first, line_end, timestamp
+    return (first if first is not None else end), None, None
+
+
+def read_lines(f, offset, end=None):
+    """Generate the lines of `f` from `offset` to `end`.
+
+    :param f: seekable binary file-like object
+    :param offset: position to start reading from
+    :param end: position to stop reading at, or None to read to the end
+    :return: generator of (offset, line) tuples, without the newlines
+    """
+    f.seek(offset)
+    position = offset
+    pending = b''
+    while end is None or position < end:
+        size = PREFETCH_REQUEST_SIZE
+        if end is not None:
+            size = min(size, end - position)
+        block = f.read(size)
+        if not block:
+            break
+        position += len(block)
+        lines = (pending + block).split(b'\n')
+        pending = lines.pop()
+        for line in lines:
+            yield offset, line
+            offset += len(line) + 1
+    if pending:
+        yield offset, pending
+
+
+def rotated_log_paths(sftp, path=AUTH_LOG):
+    """Generate the paths of the rotated versions of `path`, newest first.
+
+    These are ``path.1``, ``path.2.gz``, ``path.3.gz``, etc., as created by
+    logrotate with delayed compression.  Both the compressed and the
+    uncompressed name are accepted for each number.
+
+    :param sftp: SFTPClient object
+    :param path: path of the live log on the remote server
+    :return: generator of paths
+    """
+    number = 1
+    while True:
+        for candidate in ('{}.{}'.format(path, number),
+                          '{}.{}.gz'.format(path, number)):
+            try:
+                sftp.stat(candidate)
+            except IOError:
+                continue
+            yield candidate
+            break
+        else:
+            return
+        number += 1
+
+
+@contextlib.contextmanager
+def open_remote_log(sftp, path):
+    """Open a remote log for random access, decompressing it if necessary.
+
+    :param sftp: SFTPClient object
+    :param path: path of the log on the remote server
+    :return: context manager of a seekable binary file-like object
+    """
+    with sftp.open(path, 'rb') as f:
+        if path.endswith('.gz'):
+            with gzip.GzipFile(fileobj=f, mode='rb') as g:
+                yield g
+        else:
+            yield f
+
+
+def read_remote_log(sftp, path, offset=0, callback=None, *, end=None):
+    """Generate the blocks of a remote log from `offset` to its end.
+
+    Compressed logs are decompressed, and `offset` refers to the
+    decompressed data.
+
+    :param sftp: SFTPClient object
+    :param path: path of the log on the remote server
+    :param offset: position to start reading from
+    :param callback: function called with the number of bytes read so far
+    :param end: position to stop reading at, or None to read to the end,
+        including the data appended meanwhile to an uncompressed log
+    :return: generator of blocks of bytes
+    """
+    with sftp.open(path, 'rb') as f:
+        size = f.stat().st_size
+        if path.endswith('.gz'):
+            blocks = gunzip_blocks(prefetch_blocks(f, 0, size), offset)
+            if end is not None:
+                blocks = limit_blocks(blocks, end - offset)
+        elif end is not None:
+            blocks = prefetch_blocks(f, offset, end, appended=False)
+        else:
+            blocks = prefetch_blocks(f, offset, size)
+        done = 0
+        for block in blocks:
+            done += len(block)
+            if callback is not None:
+                callback(done)
+            yield block
+
+
+def prefetch_blocks(f, offset, size, *, appended=True):
+    """Generate the blocks of SFTPFile `f` from `offset` to its end.
+
+    A background thread requests the data in windows of `PREFETCH_WINDOW`
+    bytes, keeping many requests in flight while staying at most
+    `PREFETCH_QUEUE` blocks ahead of the consumer.  Data appended after
+    `size` is read without prefetching.
+
+    :param f: SFTPFile object
+    :param offset: position to start reading from
+    :param size: size of the file when reading starts
+    :param appended: also read the data after `size`; otherwise, reading
+        stops there
+    :return: generator of blocks of bytes
+    """
+    blocks = queue.Queue(PREFETCH_QUEUE)
+    stop = threading.Event()
+
+    def put(item):
+        while not stop.is_set():
+            try:
+                blocks.put(item, timeout=0.1)
+                return True
+            except queue.Full:
+                pass
+        return False
+
+    def read():
+        try:
+            position = offset
+            while position < size:
+                end = min(position + PREFETCH_WINDOW, size)
+                chunks = [(start, min(PREFETCH_REQUEST_SIZE, end - start))
+                          for start in range(position, end,
+                                             PREFETCH_REQUEST_SIZE)]
+                for block in f.readv(chunks):
+                    if not put(block):
+                        return
+                position = end
+            f.seek(position)
+            while appended:
+                block = f.read(BLOCK_SIZE)
+                if not block:
+                    break
+                if not put(block):
+                    return
+            put(None)
+        except Exception as e:
+            put(e)
+
+    reader = threading.Thread(target=read, daemon=True)
+    reader.start()
+    done = 0
+    try:
+        while True:
+            item = blocks.get()
+            if item is None:
+                return
+            elif isinstance(item, Exception):
+                raise item
+            done += len(item)
+            yield item
+    finally:
+        stop.set()
+        reader.join()
+        stats.count('download', bytes=done)
+
+
+def gunzip_blocks(blocks, offset=0):
+    """Decompress gzipped `blocks`, skipping the first `offset` bytes.
+
+    :param blocks: iterable of blocks of gzipped bytes
+    :param offset: number of decompressed bytes to skip
+    :return: generator of blocks of decompressed bytes
+    """
+    decompressor = zlib.decompressobj(16 + zlib.MAX_WBITS)
+    for block in blocks:
+        while block:
+            data = decompressor.decompress(block)
+            # Concatenated gzip members start a new stream
+            block = decompressor.unused_data
+            if block:
+                data += decompressor.flush()
+                decompressor = zlib.decompressobj(16 + zlib.MAX_WBITS)
+            if offset >= len(data):
+                offset -= len(data)
+                continue
+            yield data[offset:]
+            offset = 0
+    data = decompressor.flush()[offset:]
+    if data:
+        yield data
+
+
+def limit_blocks(blocks, length):
+    """Generate the first `length` bytes of `blocks`.
+
+    :param blocks: iterable of blocks of bytes
+    :param length: number of bytes
+    :return: generator of blocks of bytes
+    """
+    for block in blocks:
+        if len(block) >= length:
+            if length:
+                yield block[:length]
+            return
+        length -= len(block)
+        yield block
+
+
+def decompress_blocks(blocks, compression):
+    """Decompress `blocks` compressed with `compression`.
+
+    :param blocks: iterable of blocks of compressed bytes
+    :param compression: compression name (see `filter_auth_log`)
+    :return: iterable of blocks of decompressed bytes
+    """
+    if compression == 'gzip':
+        return gunzip_blocks(blocks)
+    elif compression == 'zstd':
+        return unzstd_blocks(blocks)
+    elif compression == 'none':
+        return blocks
+    else:
+        raise ValueError("Unknown `compression` value: {}".format(compression))
+
+
+def unzstd_blocks(blocks):
+    """Decompress Zstandard-compressed `blocks`.
+
+    :param blocks: iterable of blocks of compressed bytes
+    :return: generator of blocks of decompressed bytes
+    """
+    import zstandard
+    decompressor = zstandard.ZstdDecompressor().decompressobj()
+    for block in blocks:
+        data = decompressor.decompress(block)
+        if data:
+            yield data
+
+
+def complete_lines(blocks):
+    """Generate the blocks of `blocks` up to the last newline.
+
+    Blocks are split at their last newline, with the rest carried over to
+    the next block.  Data after the last newline is dropped.
+
+    :param blocks: iterable of blocks of bytes
+    :return: generator of blocks of bytes ending in a newline
+    """
+    pending = b''
+    for block in blocks:
+        block = pending + block
+        end = block.rfind(b'\n') + 1
+        block, pending = block[:end], block[end:]
+        if block:
+            yield block
+
+
+def print_copy_progress(path):
+    """Return a callback printing the number of bytes copied from `path`.
+
+    :param path: path of the file being copied
+    :return: function taking the number of bytes copied so far
+    """
+    def callback(copied):
+        print('Downloading {}... {} bytes'.format(
+            os.path.basename(path), copied), end='\r')
+    return callback
+
+
+def parse_datetime(string, fmt=None, *, year=None, latest=None):
     """Parse the string and return a datetime object.
 
-    The default `fmt` is equivalent to '%b %e %H:%M:%S'
+    The default `fmt` is equivalent to '%b %e %H:%M:%S'.  Such timestamps
+    carry no year, so unless `year` is given, the timestamp is taken to be
+    from the latest year in which it is not after `latest`.  Across the turn
+    of the year, the lines logged in December are thus from the previous
+    year.
 
     :param string: string to parse
     :param fmt: format usable by `strptime`
+    :param year: year of the timestamp when using the default `fmt`
+    :param latest: datetime of the latest possible timestamp when using the
+        default `fmt` without `year`; defaults to `CLOCK_SKEW` from now
     :return: datetime object
     """
     if fmt is None:
         match = re.match('(\S+)\s+(\d+)\s+(.*)', string)
+        if match is None:
+            raise ValueError("Unknown timestamp format: {}".format(string))
         new_string = '{} {:0} {}'.format(
             match.group(1), int(match.group(2)), match.group(3))
-        parsed = datetime.datetime.strptime(new_string, '%b %d %H:%M:%S')
-        return datetime.datetime(
-            datetime.datetime.now().year, parsed.month, parsed.day,
-            parsed.hour, parsed.minute, parsed.second)
+        # 1904 is a leap year, so that February 29 parses
+        parsed = datetime.datetime.strptime('1904 ' + new_string,
+                                            '%Y %b %d %H:%M:%S')
+        if year is not None:
+            return parsed.replace(year=year)
+        return latest_datetime(parsed.month, parsed.day, parsed.hour,
+                               parsed.minute, parsed.second, latest=latest)
     else:
         return datetime.datetime.strptime(string, fmt)
 
 
-def parse_log(log_file):
+def latest_datetime(month, day, hour, minute, second, *, latest=None):
+    """Return the datetime of a timestamp without a year, in the latest year
+    in which it is not after `latest`.
+
+    :param month: month of the timestamp
+    :param day: day of the month
+    :param hour: hour of the timestamp
+    :param minute: minute of the timestamp
+    :param second: second of the timestamp
+    :param latest: datetime of the latest possible timestamp; defaults to
+        `CLOCK_SKEW` from now
+    :return: datetime object
+    """
+    if latest is None:
+        latest = datetime.datetime.now() + CLOCK_SKEW
+    # February 29 may be up to 8 years back, across a non-leap century
+    for year in range(latest.year, latest.year - 9, -1):
+        try:
+            dt = datetime.datetime(year, month, day, hour, minute, second)
+        except ValueError:
+            continue
+        if dt <= latest:
+            return dt
+    raise ValueError("Invalid timestamp: {:02}-{:02} {:02}:{:02}:{:02}".format(
+        month, day, hour, minute, second))
+
+
+# Lines reporting attempts, as matched by the original pair of patterns
+LINE_PATTERNS = [
+    re.compile('(?P<datetime>.*) .* sshd\[\d+\]: User (?P<username>\S+) from (?P<ip_address>\S+) not allowed'),
+    re.compile('(?P<datetime>.*) .* sshd\[\d+\]: Invalid user (?P<username>\S+) from (?P<ip_address>\S+)')]
+
+# Both patterns combined into one alternation matching undecoded ASCII lines.
+# For str patterns, \S also excludes the separators \x1c-\x1f, so the same
+# is spelled out here.
+ATTEMPT_PATTERN = re.compile(
+    rb'(?P<datetime>.*) .* sshd\[\d+\]: (?:'
+    rb'User (?P<username>[^\s\x1c-\x1f]+) from (?P<ip_address>[^\s\x1c-\x1f]+) not allowed|'
+    rb'Invalid user (?P<invalid_username>[^\s\x1c-\x1f]+) from (?P<invalid_ip_address>[^\s\x1c-\x1f]+))')
+NOT_ALLOWED_PATTERN = re.compile(
+    rb'(?P<datetime>.*) .* sshd\[\d+\]: '
+    rb'User (?P<username>[^\s\x1c-\x1f]+) from (?P<ip_address>[^\s\x1c-\x1f]+) not allowed')
+
+# Numbers of the month abbreviations of syslog timestamps
+MONTHS = {name: number for number, name in enumerate(
+    ('Jan', 'Feb', 'Mar', 'Apr', 'May', 'Jun', 'Jul', 'Aug', 'Sep', 'Oct',
+     'Nov', 'Dec'), 1)}
+
+# Number of distinct timestamps and addresses remembered while parsing, and
+# the smallest chunk of a log file worth handing to another process
+PARSE_CACHE_SIZE = 1 << 16
+PARSE_CHUNK_SIZE = 1 << 22
+
+
+class LineParser(object):
+
+    def __init__(self, year=None, *, latest=None):
+        """Create a callable parsing log lines into Attempt tuples.
+
+        Timestamps and addresses are memoized, since syslog has at most one
+        distinct timestamp per second and attacks repeat the same addresses.
+
+        :param year: year of the timestamps; by default, each timestamp is
+            taken to be from the latest year in which it is not after
+            `latest` (see `parse_datetime`)
+        :param latest: datetime of the latest possible timestamp; defaults to
+            `CLOCK_SKEW` from now
+        """
+        if year is None and latest is None:
+            latest = datetime.datetime.now() + CLOCK_SKEW
+        self.year = year
+        self.latest = latest
+        self.parse_datetime = functools.lru_cache(PARSE_CACHE_SIZE)(
+            self._parse_datetime)
+        self.parse_timestamp = functools.lru_cache(PARSE_CACHE_SIZE)(
+            self._parse_timestamp)
+        self.ip_address = functools.lru_cache(PARSE_CACHE_SIZE)(
+            self._ip_address)
+
+    def _parse_datetime(self, string):
+        if isinstance(string, bytes):
+            string = string.decode('UTF-8')
+        return parse_datetime(string, year=self.year, latest=self.latest)
+
+    def _parse_timestamp(self, string):
+        # Splitting the fields is much faster than strptime; unusual
+        # spellings are left to `parse_datetime`
+        if isinstance(string, bytes):
+            string = string.decode('UTF-8')
+        try:
+            month, day, clock = string.split()
+            hour, minute, second = clock.split(':')
+            if self.year is None:
+                dt = latest_datetime(MONTHS[month], int(day), int(hour),
+                                     int(minute), int(second),
+                                     latest=self.latest)
+            else:
+                dt = datetime.datetime(self.year, MONTHS[month], int(day),
+                                       int(hour), int(minute), int(second))
+        except (KeyError, ValueError):
+            dt = self._parse_datetime(string)
+        return columns.to_timestamp(dt)
+
+    def line_timestamp(self, line):
+        """Return the timestamp of any syslog line, or None if it has none.
+
+        :param line: line of the log, as bytes
+        :return: time of the line, as returned by `columns.to_timestamp`
+        """
+        fields = line.split(None, 3)
+        if len(fields) < 3:
+            return None
+        try:
+            return self.parse_timestamp(b' '.join(fields[:3]))
+        except ValueError:
+            return None
+
+    @staticmethod
+    def _ip_address(string):
+        if isinstance(string, bytes):
+            string = string.decode('UTF-8')
+        return ipaddress.ip_address(string)
+
+    def __call__(self, line):
+        """Parse `line` of bytes and return an Attempt, or None if no match.
+
+        :param line: line of the log, with or without the trailing newline
+        :return: Attempt tuple or None
+        """
+        fields = self.fields(line)
+        if fields is None:
+            return None
+        timestamp, username, address = fields
+        if isinstance(username, bytes):
+            username = username.decode('UTF-8')
+        return Attempt(self.parse_datetime(timestamp), username,
+                       self.ip_address(address))
+
+    def fields(self, line):
+        """Return the unconverted fields of the attempt reported by `line`.
+
+        :param line: line of the log, with or without the trailing newline
+        :return: tuple of the timestamp, username and address strings, as
+            bytes for ASCII lines and as str otherwise, or None if no match
+        """
+        # Cheap test ruling out nearly all unrelated lines before the regex
+        if b'sshd[' not in line or (b'Invalid user ' not in line and
+                                    b'not allowed' not in line):
+            return None
+        if not line.isascii():
+            # \S means something else for decoded non-ASCII text
+            return self._decoded_fields(line.decode('UTF-8'))
+        match = ATTEMPT_PATTERN.match(line)
+        if match is None:
+            return None
+        if match.group('username') is None:
+            # The original patterns tried "not allowed" first on the whole
+            # line, so it takes precedence if both kinds match
+            not_allowed = None
+            if b'not allowed' in line:
+                not_allowed = NOT_ALLOWED_PATTERN.match(line)
+            if not_allowed is None:
+                return match.group('datetime', 'invalid_username',
+                                   'invalid_ip_address')
+            match = not_allowed
+        return match.group('datetime', 'username', 'ip_address')
+
+    @staticmethod
+    def _decoded_fields(line):
+        for pattern in LINE_PATTERNS:
+            match = pattern.match(line)
+            if match is not None:
+                return match.group('datetime', 'username', 'ip_address')
+        return None
+
+
+def parse_log(log_file, *, year=None):
     """Generate tuples of SSH attempt events from `log_file` file-like object.
 
-    :param log_file: file-like object with contents of ``/var/log/auth.log``
+    :param log_file: file-like object (or LogStream) with contents of
+        ``/var/log/auth.log``
+    :param year: year of the timestamps; by default, it is inferred from the
+        current date (see `parse_datetime`)
     :return: generator of tuples of the form (datetime, username, ip_address)
     """
-    with log_file as f:
-        for line in f:
-            line = line.decode('UTF-8')
-            regexps = ['(?P<datetime>.*) .* sshd\[\d+\]: User (?P<username>\S+) from (?P<ip_address>\S+) not allowed',
-                       '(?P<datetime>.*) .* sshd\[\d+\]: Invalid user (?P<username>\S+) from (?P<ip_address>\S+)']
-            for regexp in regexps:
-                match = re.match(regexp, line)
-                if match is not None:
-                    yield Attempt(parse_datetime(match.groupdict()['datetime']),
-                                  match.groupdict()['username'],
-                                  ipaddress.ip_address(match.groupdict()['ip_address']))
-                    break
+    return stats.timed('parse', _parse_lines(log_file, year))
+
+
+def _parse_lines(log_file, year):
+    parse_line = LineParser(year)
+    lines = 0
+    found = 0
+    try:
+        with log_file as f:
+            for lines, line in enumerate(f, 1):
+                attempt = parse_line(line)
+                if attempt is not None:
+                    found += 1
+                    yield attempt
+    finally:
+        stats.count('parse', lines=lines, attempts=found)
+
+
+def parse_log_batches(log_file, *, year=None, size=columns.BATCH_SIZE):
+    """Generate the SSH attempt events of `log_file` in columnar batches.
+
+    Like `parse_log`, but the attempts are collected into AttemptBatch
+    objects of up to `size` attempts, without creating an object per
+    attempt.
+
+    :param log_file: file-like object (or LogStream) with contents of
+        ``/var/log/auth.log``
+    :param year: year of the timestamps; by default, it is inferred from the
+        current date (see `parse_datetime`)
+    :param size: maximum number of attempts per batch
+    :return: generator of AttemptBatch objects
+    """
+    return stats.timed('parse', _parse_batches(log_file, year, size))
+
+
+def _parse_batches(log_file, year, size):
+    parse_line = LineParser(year)
+    builder = columns.BatchBuilder()
+    lines = 0
+    found = 0
+    try:
+        with log_file as f:
+            for lines, line in enumerate(f, 1):
+                fields = parse_line.fields(line)
+                if fields is None:
+                    continue
+                timestamp, username, address = fields
+                builder.append(parse_line.parse_timestamp(timestamp), username,
+                               parse_line.ip_address(address))
+                if len(builder) >= size:
+                    found += len(builder)
+                    yield builder.build()
+                    builder = columns.BatchBuilder()
+        if len(builder):
+            found += len(builder)
+            yield builder.build()
+    finally:
+        stats.count('parse', lines=lines, attempts=found)
+
+
+def open_local_log(path):
+    """Open a local log for reading, decompressing it if necessary.
+
+    :param path: path of the log; ``-`` reads standard input, and files
+        ending in ``.gz`` are decompressed
+    :return: binary file-like object
+    """
+    if path == '-':
+        # Standard input must stay open when the log is closed
+        return contextlib.nullcontext(sys.stdin.buffer)
+    elif path.endswith('.gz'):
+        return gzip.open(path, 'rb')
+    else:
+        return open(path, 'rb')
+
+
+def parse_local_log_batches(path, *, processes=None, year=None):
+    """Generate the SSH attempt events of a local log in columnar batches.
+
+    Uncompressed files are parsed in parallel by `parse_log_file_batches`.
+
+    :param path: path of the log, as for `open_local_log`
+    :param processes: number of worker processes for uncompressed files
+    :param year: year of the timestamps; by default, it is inferred from the
+        current date (see `parse_datetime`)
+    :return: generator of AttemptBatch objects
+    """
+    if path != '-' and not path.endswith('.gz'):
+        return parse_log_file_batches(path, processes=processes, year=year)
+    return parse_log_batches(open_local_log(path), year=year)
+
+
+def parse_log_file_batches(path, *, processes=None, year=None):
+    """Generate the SSH attempt events of the log file at `path` in columnar
+    batches.
+
+    Large files are split into line-aligned chunks which are parsed by a pool
+    of `processes` worker processes.  The batches are generated in the order
+    of the file.
+
+    :param path: path of a local, uncompressed log file
+    :param processes: number of worker processes; defaults to the number of
+        CPUs, and 1 parses in this process
+    :param year: year of the timestamps; by default, it is inferred from the
+        current date (see `parse_datetime`)
+    :return: generator of AttemptBatch objects
+    """
+    if processes is None:
+        processes = os.cpu_count() or 1
+    size = os.path.getsize(path)
+    if processes <= 1 or size < 2 * PARSE_CHUNK_SIZE:
+        return parse_log_batches(open(path, 'rb'), year=year)
+    return stats.timed('parse', _parse_chunks(path, size, processes, year))
+
+
+def _parse_chunks(path, size, processes, year):
+    bounds = line_aligned_chunks(path, max(PARSE_CHUNK_SIZE,
+                                           size // (4 * processes)))
+    starts, ends = zip(*bounds)
+    with concurrent.futures.ProcessPoolExecutor(processes) as executor:
+        chunks = executor.map(_parse_chunk, [path] * len(bounds), starts, ends,
+                              [year] * len(bounds))
+        for lines, batch in chunks:
+            stats.count('parse', lines=lines, attempts=len(batch))
+            yield batch
+
+
+def line_aligned_chunks(path, chunk_size):
+    """Split the file at `path` into chunks of about `chunk_size` bytes.
+
+    Each chunk ends just after a newline (or at the end of the file).
+
+    :param path: path of the file
+    :param chunk_size: approximate size of the chunks
+    :return: list of (start, end) offsets
+    """
+    bounds = []
+    with open(path, 'rb') as f:
+        size = os.fstat(f.fileno()).st_size
+        start = 0
+        while start < size:
+            f.seek(start + chunk_size)
+            f.readline()
+            end = min(f.tell(), size)
+            bounds.append((start, end))
+            start = end
+    return bounds
+
+
+def _parse_chunk(path, start, end, year):
+    """Return the number of lines and the AttemptBatch of the attempts in
+    bytes `start` to `end` of `path`.
+
+    Batches are much cheaper to pass between processes than attempt tuples.
+    """
+    with open(path, 'rb') as f:
+        f.seek(start)
+        data = f.read(end - start)
+    lines = data.count(b'\n') + (not data.endswith(b'\n'))
+    return lines, columns.AttemptBatch.concatenate(
+        parse_log_batches(io.BytesIO(data), year=year, size=len(data)))
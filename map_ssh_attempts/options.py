@@ -0,0 +1,43 @@
+# Copyright (C) 2014  Jim Turner
+
+# This file is part of map_ssh_attempts.
+
+# map_ssh_attempts is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by the Free
+# Software Foundation, either version 2 of the License, or (at your option) any
+# later version.
+
+# This program is distributed in the hope that it will be useful, but WITHOUT ANY
+# WARRANTY; without even the implied warranty of MERCHANTABILITY or FITNESS FOR A
+# PARTICULAR PURPOSE.  See the GNU General Public License for more details.
+
+# You should have received a copy of the GNU General Public License along with
+# this program.  If not, see <http://www.gnu.org/licenses/>.
+
+# Choices offered by the command line interface, kept apart from the modules
+# implementing them so that --help does not have to import NumPy or pygeoip
+
+# How the GeoIP databases are accessed (see `geoip.GeoIPMultiversion`)
+GEOIP_MODES = ('standard', 'mmap', 'memory')
+
+# How attempt locations are rendered on maps (see `worldmap.LocationLayer`)
+RENDER_MODES = ('points', 'aggregate', 'hexbin', 'density')
+
+# Properties attempts can be grouped by, with their names in figures (see
+# `aggregate.aggregate`)
+KEYS = {'username': 'Username',
+        'country': 'Country',
+        'city': 'City',
+        'ip': 'Source IP',
+        'host': 'Host',
+        'time': 'Time'}
+
+# Widths of the time buckets in seconds; months are calendar months
+BUCKETS = {'minute': 60,
+           'hour': 3600,
+           'day': 86400,
+           'week': 7 * 86400,
+           'month': None}
+
+# Number of series of a chart over time, unless given
+SERIES_TOP = 10
@@ -16,37 +16,139 @@
 
 import operator
 import numpy as np
-from . import geoip
+from . import aggregate
+from . import enrich
+from .options import SERIES_TOP
 
-def bar_plot(ax, prop, attempts):
+
+def bar_plot(ax, prop, attempts, *, enricher=None, bucket='day', top=None):
     """Apply bar plot of `prop` from `attempts` on `ax`.
 
     :param ax: Matplotlib Axes
-    :param prop: property to plot
-    :param attempts: generator of Attempt tuples
+    :param prop: key or keys to group the attempts by (see
+        `aggregate.parse_keys`)
+    :param attempts: AttemptBatch object, or iterable of Attempt tuples
+    :param enricher: Enricher object to look addresses up
+    :param bucket: width of the time buckets; one of `aggregate.BUCKETS`
+    :param top: number of bars, or of series of a chart over time, to show
+        (see `LiveBarPlot`)
     """
-    data = {}
-    if prop != 'username':
-        geoipmv = geoip.GeoIPMultiversion()
-    for attempt in attempts:
-        if prop == 'username':
-            data[attempt.username] = data.get(attempt.username, 0) + 1
-        elif prop == 'country':
-            try:
-                country = geoipmv.country_name_by_addr(attempt.ip_address)
-            except AttributeError:
-                print("Warning: unable to find country for {}".format(
-                    attempt.ip_address))
-                continue
-            data[country] = data.get(country, 0) + 1
-        else:
-            raise ValueError("Unknown `prop` value: {}".format(prop))
+    LiveBarPlot(ax, prop, enricher=enricher, bucket=bucket, top=top).add(
+        attempts)
+
 
+def draw_bars(ax, prop, data):
+    """Draw horizontal bars of the counts in `data` on `ax`, largest on top.
+
+    :param ax: Matplotlib Axes
+    :param prop: key or keys that were counted
+    :param data: dict mapping tuples of values of the keys to numbers of
+        attempts
+    :return: BarContainer of the bars
+    """
     labels, values = zip(*sorted(data.items(), key=operator.itemgetter(1)))
     bottoms = np.arange(len(labels)) + 0.5
-    ax.barh(bottoms, values, align='center', color='lightgreen')
+    bars = ax.barh(bottoms, values, align='center', color='lightgreen')
     ax.grid(axis='x')
-    ax.set_ylabel(prop.capitalize())
+    ax.set_ylabel(axis_label(prop))
     ax.set_xlabel('Number of attempts')
     ax.set_yticks(bottoms)
-    ax.set_yticklabels(labels)
+    ax.set_yticklabels([aggregate.format_label(label) for label in labels])
+    return bars
+
+
+def draw_series(ax, counts, *, bucket='day', top=SERIES_TOP):
+    """Draw stacked bars of the attempts in each time bucket on `ax`.
+
+    The attempts are split into series of the values of the keys other than
+    ``'time'``, with the `top` most frequent values stacked first and the
+    rest on top of them.
+
+    :param ax: Matplotlib Axes
+    :param counts: Aggregation object with a ``'time'`` key
+    :param bucket: width of the time buckets; one of `aggregate.BUCKETS`
+    :param top: number of series to show, or None for all of them
+    """
+    times, names, matrix = counts.series('time', top=top)
+    # Months vary in length, and matplotlib measures dates in days
+    width = (aggregate.BUCKETS[bucket] or 28 * 86400) / 86400 * 0.9
+    bottom = np.zeros(len(times), dtype=np.int64)
+    for name, heights in zip(names, matrix):
+        ax.bar(times, heights, width=width, bottom=bottom, align='edge',
+               label=aggregate.format_label(name),
+               color='lightgrey' if name is None else None)
+        bottom += heights
+    others = tuple(key for key in counts.keys if key != 'time')
+    if others:
+        ax.legend(title=axis_label(others), fontsize='small')
+    ax.grid(axis='y')
+    ax.set_xlabel('Time')
+    ax.set_ylabel('Attempts per {}'.format(bucket))
+    for label in ax.get_xticklabels():
+        label.set_rotation(30)
+        label.set_horizontalalignment('right')
+
+
+def axis_label(prop):
+    """Return the axis label of key or keys `prop`."""
+    return ' / '.join(aggregate.KEYS[key] for key in aggregate.parse_keys(prop))
+
+
+class LiveBarPlot(object):
+
+    def __init__(self, ax, prop, *, enricher=None, bucket='day', top=None):
+        """Create a bar plot of `prop` on `ax` that attempts can be added to.
+
+        Each call to `add` counts only the added attempts.  The bars are
+        resized in place while the ranking of the values stays the same, and
+        redrawn when it changes.  If `prop` includes ``'time'``, the attempts
+        in each time bucket are drawn as stacked bars instead (see
+        `draw_series`), which are redrawn on each update.
+
+        :param ax: Matplotlib Axes
+        :param prop: key or keys to group the attempts by (see
+            `aggregate.parse_keys`)
+        :param enricher: Enricher object to look addresses up
+        :param bucket: width of the time buckets; one of `aggregate.BUCKETS`
+        :param top: number of bars of the most frequent values to show, or
+            None for all of them; of series for a chart over time, where it
+            defaults to `SERIES_TOP`
+        """
+        self.ax = ax
+        self.prop = aggregate.parse_keys(prop)
+        self.enricher = enricher if enricher is not None else enrich.Enricher()
+        self.bucket = bucket
+        self.top = top
+        self.counts = None
+        self.labels = None
+        self.bars = None
+
+    def add(self, attempts):
+        """Count `attempts` and update the plot.
+
+        :param attempts: iterable of Attempt tuples, or AttemptBatch object
+        """
+        counts = aggregate.aggregate(attempts, self.prop,
+                                     enricher=self.enricher,
+                                     bucket=self.bucket)
+        if self.counts is not None:
+            counts = self.counts.merge(counts)
+        self.counts = counts
+        if not len(counts):
+            return
+        if 'time' in self.prop:
+            self.ax.cla()
+            draw_series(self.ax, counts, bucket=self.bucket,
+                        top=self.top if self.top is not None else SERIES_TOP)
+            return
+        data = dict(iter(counts.top(self.top)))
+        labels, values = zip(*sorted(data.items(), key=operator.itemgetter(1)))
+        if labels == self.labels:
+            for bar, value in zip(self.bars, values):
+                bar.set_width(value)
+            self.ax.relim()
+            self.ax.autoscale_view()
+        else:
+            self.ax.cla()
+            self.bars = draw_bars(self.ax, self.prop, data)
+            self.labels = labels
@@ -0,0 +1,307 @@
+# Copyright (C) 2014  Jim Turner
+
+# This file is part of map_ssh_attempts.
+
+# map_ssh_attempts is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by the Free
+# Software Foundation, either version 2 of the License, or (at your option) any
+# later version.
+
+# This program is distributed in the hope that it will be useful, but WITHOUT ANY
+# WARRANTY; without even the implied warranty of MERCHANTABILITY or FITNESS FOR A
+# PARTICULAR PURPOSE.  See the GNU General Public License for more details.
+
+# You should have received a copy of the GNU General Public License along with
+# this program.  If not, see <http://www.gnu.org/licenses/>.
+
+import collections
+import threading
+import time
+
+
+# Stages of a run, in the order they are reported
+STAGES = ('connect', 'download', 'parse', 'store', 'query', 'load_geoip',
+          'load_index', 'load_tor', 'load_map', 'lookup', 'aggregate', 'plot',
+          'render')
+
+
+class Stage(object):
+
+    def __init__(self, name):
+        """Create the metrics of stage `name`.
+
+        :param name: name of the stage
+        """
+        self.name = name
+        self.wall = 0.0
+        self.cpu = 0.0
+        self.counts = collections.Counter()
+
+
+class Stats(object):
+
+    def __init__(self):
+        """Create a collector of the time spent and work done in each stage.
+
+        Collection is disabled until `enable` is called, and then costs
+        nothing.  Time spent in a stage nested in another is only counted in
+        the inner stage.  Wall time is summed over the threads running a
+        stage, and CPU time is that of those threads, so work done in other
+        processes is not included.
+        """
+        self.enabled = False
+        self.stages = {}
+        self.lock = threading.Lock()
+        self.local = threading.local()
+        self.start_wall = None
+        self.start_cpu = None
+        self.profiler = None
+        self.profile_stage = None
+
+    def enable(self, *, profile=False, profile_stage=None):
+        """Start collecting metrics.
+
+        :param profile: also profile the run with cProfile
+        :param profile_stage: only profile while this stage runs, rather
+            than the whole run
+        """
+        self.enabled = True
+        self.start_wall = time.perf_counter()
+        self.start_cpu = time.process_time()
+        if profile:
+            import cProfile
+            self.profiler = cProfile.Profile()
+            self.profile_stage = profile_stage
+            if profile_stage is None:
+                self.profiler.enable()
+
+    def dump_profile(self, path):
+        """Stop profiling and write the profile to `path`.
+
+        The profile can be read with the `pstats` module.
+
+        :param path: path of the file to write
+        """
+        self.profiler.disable()
+        self.profiler.dump_stats(path)
+
+    def _stack(self):
+        """Return the stack of stages running in this thread."""
+        try:
+            return self.local.stack
+        except AttributeError:
+            self.local.stack = []
+            return self.local.stack
+
+    def _profiling(self, stack):
+        """Check if the profiler should run with the stages of `stack`."""
+        if self.profile_stage is None:
+            return True
+        return bool(stack) and stack[-1][0] == self.profile_stage
+
+    def _switch_profiler(self, before, after):
+        """Enable or disable the profiler when the stage stack changes.
+
+        The profiler only follows the main thread.
+        """
+        if (self.profiler is None or before == after or
+                threading.current_thread() is not threading.main_thread()):
+            return
+        if after:
+            self.profiler.enable()
+        else:
+            self.profiler.disable()
+
+    def _enter(self, name):
+        stack = self._stack()
+        before = self._profiling(stack)
+        stack.append([name, time.perf_counter(), time.thread_time(), 0.0, 0.0])
+        self._switch_profiler(before, self._profiling(stack))
+
+    def _exit(self):
+        stack = self._stack()
+        wall = time.perf_counter()
+        cpu = time.thread_time()
+        before = self._profiling(stack)
+        name, start_wall, start_cpu, child_wall, child_cpu = stack.pop()
+        self._switch_profiler(before, self._profiling(stack))
+        wall -= start_wall
+        cpu -= start_cpu
+        if stack:
+            stack[-1][3] += wall
+            stack[-1][4] += cpu
+        with self.lock:
+            stage = self.stages.get(name)
+            if stage is None:
+                stage = self.stages[name] = Stage(name)
+            stage.wall += wall - child_wall
+            stage.cpu += cpu - child_cpu
+
+    def stage(self, name):
+        """Return a context manager timing its block as part of stage `name`.
+
+        :param name: name of the stage
+        :return: context manager
+        """
+        return _StageContext(self, name)
+
+    def timed(self, name, iterable):
+        """Time the iteration over `iterable` as part of stage `name`.
+
+        Only the time spent producing the items is counted, not the time
+        spent by the consumer between items.
+
+        :param name: name of the stage
+        :param iterable: iterable to time
+        :return: iterable of the same items; `iterable` itself if collection
+            is disabled
+        """
+        if not self.enabled:
+            return iterable
+        return self._timed(name, iterable)
+
+    def _timed(self, name, iterable):
+        iterator = iter(iterable)
+        try:
+            while True:
+                self._enter(name)
+                try:
+                    item = next(iterator)
+                except StopIteration:
+                    return
+                finally:
+                    self._exit()
+                yield item
+        finally:
+            if hasattr(iterator, 'close'):
+                iterator.close()
+
+    def count(self, name, **counts):
+        """Add to the counts of the work done by stage `name`.
+
+        :param name: name of the stage
+        :param counts: numbers to add to the counts of the same names
+        """
+        if not self.enabled:
+            return
+        with self.lock:
+            stage = self.stages.get(name)
+            if stage is None:
+                stage = self.stages[name] = Stage(name)
+            stage.counts.update(counts)
+
+    def summary(self):
+        """Return the metrics collected so far.
+
+        Rates are derived from the counts: ``bytes_per_second`` and
+        ``lines_per_second`` over the wall time of the stage, and
+        ``cache_hit_rate`` as the fraction of ``lookups`` that were
+        ``cache_hits``.
+
+        :return: dict with the ``elapsed`` wall time and ``cpu`` time of
+            the process and a ``stages`` dict of the metrics of each stage,
+            in the order of `STAGES`
+        """
+        with self.lock:
+            stages = sorted(self.stages.values(), key=_stage_order)
+            summary = collections.OrderedDict()
+            for stage in stages:
+                metrics = collections.OrderedDict(
+                    [('wall', stage.wall), ('cpu', stage.cpu)])
+                metrics.update(sorted(stage.counts.items()))
+                if stage.wall > 0:
+                    for unit in ('bytes', 'lines'):
+                        if unit in stage.counts:
+                            metrics['{}_per_second'.format(unit)] = (
+                                stage.counts[unit] / stage.wall)
+                if stage.counts['lookups'] and 'cache_hits' in stage.counts:
+                    metrics['cache_hit_rate'] = (stage.counts['cache_hits'] /
+                                                 stage.counts['lookups'])
+                summary[stage.name] = metrics
+        return collections.OrderedDict(
+            [('elapsed', time.perf_counter() - self.start_wall),
+             ('cpu', time.process_time() - self.start_cpu),
+             ('stages', summary)])
+
+
+class _StageContext(object):
+
+    def __init__(self, stats, name):
+        self.stats = stats
+        self.name = name
+
+    def __enter__(self):
+        if self.stats.enabled:
+            self.stats._enter(self.name)
+        return self
+
+    def __exit__(self, *exc_info):
+        if self.stats.enabled:
+            self.stats._exit()
+
+
+def _stage_order(stage):
+    """Sort key of Stage objects, in the order of `STAGES`."""
+    if stage.name in STAGES:
+        return (STAGES.index(stage.name), stage.name)
+    return (len(STAGES), stage.name)
+
+
+def format_summary(summary):
+    """Format the metrics returned by `Stats.summary` as a table.
+
+    :param summary: dict returned by `Stats.summary`
+    :return: string of lines
+    """
+    lines = ['{:<12} {:>9} {:>9}  {}'.format('stage', 'wall (s)', 'cpu (s)',
+                                             'work')]
+    for name, metrics in summary['stages'].items():
+        lines.append('{:<12} {:>9.3f} {:>9.3f}  {}'.format(
+            name, metrics['wall'], metrics['cpu'],
+            ', '.join(_describe_work(metrics))))
+    lines.append('{:<12} {:>9.3f} {:>9.3f}'.format(
+        'total', summary['elapsed'], summary['cpu']))
+    return '\n'.join(lines)
+
+
+def _describe_work(metrics):
+    """Generate descriptions of the counts and rates in `metrics`."""
+    if 'bytes' in metrics:
+        text = '{:.1f} MB'.format(metrics['bytes'] / 1e6)
+        if 'bytes_per_second' in metrics:
+            text += ' ({:.1f} MB/s)'.format(metrics['bytes_per_second'] / 1e6)
+        yield text
+    if 'lines' in metrics:
+        text = '{} lines'.format(metrics['lines'])
+        if 'lines_per_second' in metrics:
+            text += ' ({:.0f} lines/s)'.format(metrics['lines_per_second'])
+        yield text
+    if 'attempts' in metrics:
+        yield '{} attempts'.format(metrics['attempts'])
+    if 'lookups' in metrics:
+        text = '{} lookups'.format(metrics['lookups'])
+        if 'cache_hit_rate' in metrics:
+            text += ' ({:.0%} cache hits)'.format(metrics['cache_hit_rate'])
+        yield text
+    if 'tor_lookups' in metrics:
+        yield '{} Tor lookups'.format(metrics['tor_lookups'])
+
+
+# Collector of the metrics of this process
+collector = Stats()
+
+
+def stage(name):
+    """Time a block as part of stage `name` (see `Stats.stage`)."""
+    return collector.stage(name)
+
+
+def timed(name, iterable):
+    """Time the iteration over `iterable` as part of stage `name` (see
+    `Stats.timed`)."""
+    return collector.timed(name, iterable)
+
+
+def count(name, **counts):
+    """Add to the counts of stage `name` (see `Stats.count`)."""
+    collector.count(name, **counts)
@@ -0,0 +1,199 @@
+# Copyright (C) 2014  Jim Turner
+
+# This file is part of map_ssh_attempts.
+
+# map_ssh_attempts is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by the Free
+# Software Foundation, either version 2 of the License, or (at your option) any
+# later version.
+
+# This program is distributed in the hope that it will be useful, but WITHOUT ANY
+# WARRANTY; without even the implied warranty of MERCHANTABILITY or FITNESS FOR A
+# PARTICULAR PURPOSE.  See the GNU General Public License for more details.
+
+# You should have received a copy of the GNU General Public License along with
+# this program.  If not, see <http://www.gnu.org/licenses/>.
+
+import functools
+import itertools
+import ipaddress
+import json
+import os
+import os.path
+import sqlite3
+from . import columns
+from . import fetchstate
+from .columns import to_timestamp
+
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS attempts (
+    host TEXT NOT NULL,
+    timestamp INTEGER NOT NULL,
+    username TEXT NOT NULL,
+    ip_address TEXT NOT NULL
+);
+CREATE INDEX IF NOT EXISTS attempts_host_timestamp ON attempts (host, timestamp);
+CREATE INDEX IF NOT EXISTS attempts_timestamp ON attempts (timestamp);
+CREATE INDEX IF NOT EXISTS attempts_username ON attempts (username);
+CREATE TABLE IF NOT EXISTS fetch_state (
+    host TEXT PRIMARY KEY,
+    state TEXT NOT NULL
+);
+"""
+
+
+class AttemptStore(object):
+
+    db_name = 'attempts.sqlite'
+
+    def __init__(self, cache_dir='~/.cache/map_ssh_attempts'):
+        """Create an object storing parsed attempts in a local database.
+
+        :param cache_dir: directory in which to place the database
+        """
+        self.cache_dir = os.path.expanduser(cache_dir)
+        self.db = None
+
+    def __enter__(self):
+        self.open()
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+    def open(self):
+        """Open the database, creating it if necessary."""
+        if not os.path.isdir(self.cache_dir):
+            if os.path.lexists(self.cache_dir):
+                raise NotADirectoryError('Store location exists but is not a directory.')
+            else:
+                os.makedirs(self.cache_dir)
+        self.db = sqlite3.connect(os.path.join(self.cache_dir, AttemptStore.db_name))
+        self.db.executescript(SCHEMA)
+
+    def close(self):
+        """Close the database."""
+        if self.db is not None:
+            self.db.close()
+            self.db = None
+
+    def check_open(self):
+        """Check if the database has been opened."""
+        return self.db is not None
+
+    def add(self, hostname, attempts, *, state=None):
+        """Add `attempts` of `hostname` to the store.
+
+        If `state` is given, it is saved in the same transaction, so that
+        the attempts are stored if and only if the fetch is recorded, and an
+        interrupted update never stores them twice.
+
+        :param hostname: the server the attempts were logged on
+        :param attempts: iterable of Attempt tuples, or AttemptBatch object
+        :param state: FetchState object of `hostname` after fetching
+            `attempts`
+        :return: number of attempts added
+        """
+        if not self.check_open():
+            self.open()
+        if isinstance(attempts, columns.AttemptBatch):
+            rows = zip(itertools.repeat(hostname), attempts.timestamps.tolist(),
+                       attempts.attempt_usernames(),
+                       map(str, attempts.addresses()))
+        else:
+            rows = ((hostname, to_timestamp(attempt.datetime), attempt.username,
+                     str(attempt.ip_address)) for attempt in attempts)
+        with self.db:
+            cursor = self.db.executemany(
+                'INSERT INTO attempts VALUES (?, ?, ?, ?)', rows)
+            if state is not None:
+                self.db.execute(
+                    'INSERT OR REPLACE INTO fetch_state VALUES (?, ?)',
+                    (hostname, json.dumps(state.to_dict())))
+        return cursor.rowcount
+
+    def load_fetch_state(self, hostname):
+        """Return the fetch state of `hostname` saved by `add`.
+
+        Hosts without a saved state get the one of the state file of
+        `fetchstate.FetchState`, if any, as saved before the states were
+        kept in the store.
+
+        :param hostname: the server the state belongs to
+        :return: FetchState object
+        """
+        if not self.check_open():
+            self.open()
+        state = fetchstate.FetchState(hostname, cache_dir=self.cache_dir)
+        row = self.db.execute('SELECT state FROM fetch_state WHERE host = ?',
+                              (hostname,)).fetchone()
+        if row is None:
+            state.load()
+        else:
+            state.restore(json.loads(row[0]))
+        return state
+
+    def hostnames(self):
+        """Return the sorted list of hosts with stored attempts."""
+        if not self.check_open():
+            self.open()
+        return [row[0] for row in self.db.execute(
+            'SELECT DISTINCT host FROM attempts ORDER BY host')]
+
+    def query_batches(self, *, hostnames=None, since=None, until=None,
+                      usernames=None, size=columns.BATCH_SIZE):
+        """Generate the stored attempts matching the filters in batches,
+        oldest first.
+
+        Filters that are None are not applied.  The attempts are generated as
+        AttemptBatch objects (with hostnames) of up to `size` attempts.
+
+        :param hostnames: iterable of hosts to include
+        :param since: datetime of the earliest attempt to include
+        :param until: datetime after the latest attempt to include
+        :param usernames: iterable of usernames to include
+        :param size: maximum number of attempts per batch
+        :return: generator of AttemptBatch objects
+        """
+        cursor = self._select(hostnames, since, until, usernames)
+        while True:
+            rows = cursor.fetchmany(size)
+            if not rows:
+                return
+            builder = columns.BatchBuilder()
+            for host, timestamp, username, ip_address in rows:
+                builder.append(timestamp, username, _ip_address(ip_address),
+                               host)
+            yield builder.build()
+
+    def _select(self, hostnames, since, until, usernames):
+        """Return a cursor over the rows matching the filters of `query_batches`."""
+        if not self.check_open():
+            self.open()
+        clauses = []
+        params = []
+        if hostnames is not None:
+            hostnames = list(hostnames)
+            clauses.append('host IN ({})'.format(', '.join('?' * len(hostnames))))
+            params.extend(hostnames)
+        if since is not None:
+            clauses.append('timestamp >= ?')
+            params.append(to_timestamp(since))
+        if until is not None:
+            clauses.append('timestamp < ?')
+            params.append(to_timestamp(until))
+        if usernames is not None:
+            usernames = list(usernames)
+            clauses.append('username IN ({})'.format(', '.join('?' * len(usernames))))
+            params.extend(usernames)
+        sql = 'SELECT host, timestamp, username, ip_address FROM attempts'
+        if clauses:
+            sql += ' WHERE ' + ' AND '.join(clauses)
+        sql += ' ORDER BY timestamp'
+        return self.db.execute(sql, params)
+
+
+@functools.lru_cache(1 << 16)
+def _ip_address(string):
+    return ipaddress.ip_address(string)
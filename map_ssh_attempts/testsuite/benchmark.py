@@ -0,0 +1,429 @@
+# Copyright (C) 2014  Jim Turner
+
+# This file is part of map_ssh_attempts.
+
+# map_ssh_attempts is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by the Free
+# Software Foundation, either version 2 of the License, or (at your option) any
+# later version.
+
+# This program is distributed in the hope that it will be useful, but WITHOUT ANY
+# WARRANTY; without even the implied warranty of MERCHANTABILITY or FITNESS FOR A
+# PARTICULAR PURPOSE.  See the GNU General Public License for more details.
+
+# You should have received a copy of the GNU General Public License along with
+# this program.  If not, see <http://www.gnu.org/licenses/>.
+
+import argparse
+import collections
+import json
+import multiprocessing
+import operator
+import os
+import os.path
+import resource
+import sys
+import tempfile
+import time
+from .. import aggregate
+from .. import columns
+from .. import enrich
+from .. import geoindex
+from .. import geoip
+from .. import getdata
+from .. import tor
+from . import sftpserver
+from . import synthlog
+
+
+Result = collections.namedtuple(
+    'Result', ('name', 'seconds', 'count', 'unit', 'peak_growth'))
+
+# Benchmarks by name, as (setup function, needs GeoIP databases) tuples
+BENCHMARKS = collections.OrderedDict()
+
+
+def benchmark(name, *, needs_geoip=False):
+    """Register a benchmark.
+
+    The decorated function sets the benchmark up in an `Environment` and
+    returns the function to time, which returns the number of units
+    processed and the name of the unit.
+
+    :param name: name of the benchmark
+    :param needs_geoip: the benchmark needs the GeoIP databases in cache
+    """
+    def register(setup):
+        BENCHMARKS[name] = (setup, needs_geoip)
+        return setup
+    return register
+
+
+class Environment(object):
+
+    def __init__(self, directory, *, size, ipv6=0.1, tor_fraction=0.05,
+                 cache_dir='~/.cache/map_ssh_attempts'):
+        """Create the data the benchmarks run on in `directory`.
+
+        A synthetic log is generated as ``/var/log/auth.log`` of a
+        `sftpserver.LocalSFTPServer`, along with a list of its Tor exit
+        nodes.  The GeoIP databases and the map are taken from `cache_dir`.
+
+        :param directory: empty directory to place the data in
+        :param size: size of the log in bytes
+        :param ipv6: fraction of IPv6 source addresses
+        :param tor_fraction: fraction of source addresses that are Tor exit
+            nodes
+        :param cache_dir: cache directory of the GeoIP databases and the map
+        """
+        self.cache_dir = os.path.expanduser(cache_dir)
+        root = os.path.join(directory, 'root')
+        self.log_path = root + getdata.AUTH_LOG
+        os.makedirs(os.path.dirname(self.log_path))
+        print("Generating auth.log... ", end='')
+        sys.stdout.flush()
+        with open(self.log_path, 'wb') as f:
+            self.log = synthlog.generate_log(f, size, ipv6=ipv6,
+                                              tor=tor_fraction)
+        self.size = os.path.getsize(self.log_path)
+        self.tor_dir = os.path.join(directory, 'tor')
+        os.makedirs(self.tor_dir)
+        synthlog.write_tor_list(
+            os.path.join(self.tor_dir, tor.TorExitNodeDatabase.db_name),
+            self.log.tor_addresses)
+        print("100%")
+        self.server = sftpserver.LocalSFTPServer(root)
+
+    def close(self):
+        """Stop the SFTP server."""
+        self.server.close()
+
+    def attempts(self):
+        """Return the list of attempts in the log."""
+        return list(getdata.parse_log(open(self.log_path, 'rb')))
+
+    def batch(self):
+        """Return the attempts in the log as an AttemptBatch."""
+        return columns.AttemptBatch.concatenate(
+            getdata.parse_log_batches(open(self.log_path, 'rb')))
+
+    def time_at(self, fraction):
+        """Return the datetime at `fraction` of the time spanned by the log."""
+        parse_line = getdata.LineParser()
+        with open(self.log_path, 'rb') as f:
+            lines = f.readlines()
+        first = parse_line.line_timestamp(lines[0])
+        last = parse_line.line_timestamp(lines[-1])
+        return columns.from_timestamp(round(first + fraction * (last - first)))
+
+    def addresses(self):
+        """Return the list of distinct addresses of the attempts."""
+        return list({attempt.ip_address for attempt in self.attempts()})
+
+    def check_geoip(self):
+        """Check if the GeoIP databases are in cache."""
+        return geoip.GeoIPMultiversion(self.cache_dir).check_cache()
+
+    def enricher(self, *, tor_lookup=False):
+        """Return an Enricher with loaded databases and an empty cache."""
+        geoipmv = geoip.GeoIPMultiversion(self.cache_dir, mode='memory')
+        geoipmv.load_dbs()
+        tordb = None
+        if tor_lookup:
+            tordb = tor.TorExitNodeDatabase(self.tor_dir)
+            tordb.load_dbs()
+        return enrich.Enricher(geoipmv, tordb, tor_lookup=tor_lookup)
+
+
+@benchmark('open_auth_log')
+def bench_open_auth_log(env):
+    pool = env.server.pool()
+
+    def run():
+        with getdata.open_auth_log('localhost', pool=pool, progress=False) as f:
+            f.seek(0, os.SEEK_END)
+            return f.tell(), 'bytes'
+    return run
+
+
+@benchmark('stream_auth_log')
+def bench_stream_auth_log(env):
+    pool = env.server.pool()
+
+    def run():
+        count = sum(len(line) + 1 for line in getdata.stream_auth_log(
+            'localhost', pool=pool, progress=False))
+        return count, 'bytes'
+    return run
+
+
+@benchmark('stream_auth_log_window')
+def bench_stream_auth_log_window(env):
+    pool = env.server.pool()
+    since = env.time_at(0.9)
+
+    def run():
+        count = sum(len(line) + 1 for line in getdata.stream_auth_log(
+            'localhost', since=since, pool=pool, progress=False))
+        return count, 'bytes'
+    return run
+
+
+@benchmark('parse_log')
+def bench_parse_log(env):
+    def run():
+        for attempt in getdata.parse_log(open(env.log_path, 'rb')):
+            pass
+        return env.log.lines, 'lines'
+    return run
+
+
+@benchmark('parse_log_batches')
+def bench_parse_log_batches(env):
+    def run():
+        for batch in getdata.parse_log_batches(open(env.log_path, 'rb')):
+            pass
+        return env.log.lines, 'lines'
+    return run
+
+
+@benchmark('parse_log_file_batches')
+def bench_parse_log_file_batches(env):
+    def run():
+        for batch in getdata.parse_log_file_batches(env.log_path):
+            pass
+        return env.log.lines, 'lines'
+    return run
+
+
+@benchmark('geoip_lookups', needs_geoip=True)
+def bench_geoip_lookups(env):
+    enricher = env.enricher()
+    addrs = env.addresses()
+
+    def run():
+        for addr in addrs:
+            enricher.locate(addr)
+        return len(addrs), 'lookups'
+    return run
+
+
+@benchmark('geoip_bulk_lookups', needs_geoip=True)
+def bench_geoip_bulk_lookups(env):
+    index = geoindex.GeoIPIndex(env.cache_dir)
+    index.load()
+    addrs = env.addresses()
+
+    def run():
+        index.lookup_addresses(addrs)
+        return len(addrs), 'lookups'
+    return run
+
+
+@benchmark('tor_lookups')
+def bench_tor_lookups(env):
+    tordb = tor.TorExitNodeDatabase(env.tor_dir)
+    tordb.load_dbs()
+    addrs = [attempt.ip_address for attempt in env.attempts()]
+
+    def run():
+        tordb.are_tor_exit_nodes(addrs)
+        return len(addrs), 'lookups'
+    return run
+
+
+@benchmark('bar_username')
+def bench_bar_username(env):
+    attempts = env.batch()
+
+    def run():
+        aggregate.aggregate(attempts, 'username')
+        return len(attempts), 'attempts'
+    return run
+
+
+@benchmark('bar_country', needs_geoip=True)
+def bench_bar_country(env):
+    attempts = env.batch()
+    enricher = env.enricher()
+
+    def run():
+        aggregate.aggregate(attempts, 'country', enricher=enricher)
+        return len(attempts), 'attempts'
+    return run
+
+
+@benchmark('aggregate_hourly')
+def bench_aggregate_hourly(env):
+    attempts = env.batch()
+
+    def run():
+        aggregate.aggregate(attempts, ('time', 'username'), bucket='hour')
+        return len(attempts), 'attempts'
+    return run
+
+
+@benchmark('map_render', needs_geoip=True)
+def bench_map_render(env):
+    import matplotlib
+    matplotlib.use('Agg')
+    import matplotlib.pyplot as plt
+    from .. import worldmap
+    attempts = env.attempts()
+    enricher = env.enricher(tor_lookup=True)
+    basemap, background = worldmap.load_map(worldmap.map_params(),
+                                            cache_dir=env.cache_dir)
+
+    def run():
+        fig = plt.figure()
+        worldmap.plot_attempt_locations(
+            worldmap.show_map(basemap, background), attempts,
+            highlight_tor=True, enricher=enricher, mode='aggregate')
+        fig.canvas.draw()
+        plt.close(fig)
+        return len(attempts), 'attempts'
+    return run
+
+
+def peak_rss():
+    """Return the peak resident memory of this process in bytes.
+
+    On Linux, this is the peak since the last `reset_peak_rss`.
+    """
+    try:
+        with open('/proc/self/status') as f:
+            for line in f:
+                if line.startswith('VmHWM:'):
+                    return int(line.split()[1]) * 1024
+    except OSError:
+        pass
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # Reported in kilobytes, except on macOS
+    return peak if sys.platform == 'darwin' else peak * 1024
+
+
+def reset_peak_rss():
+    """Reset the peak resident memory of this process to its current size,
+    where the system allows it (Linux)."""
+    try:
+        with open('/proc/self/clear_refs', 'w') as f:
+            f.write('5')
+    except OSError:
+        pass
+
+
+def run_benchmark(env, name, *, repeat=1):
+    """Run benchmark `name` in fresh processes and return the fastest run.
+
+    Each run forks a process, so that the peak memory use is that of the
+    benchmark alone.  It is measured from the end of the setup of the
+    benchmark, so that it is the growth of the memory use during the timed
+    stage.  Where the peak cannot be reset, the growth is measured from the
+    peak of the setup instead, and stages using less memory than their
+    setup report none.
+
+    :param env: Environment object
+    :param name: name of the benchmark
+    :param repeat: number of runs
+    :return: Result tuple, with the largest peak memory growth of the runs
+    """
+    context = multiprocessing.get_context('fork')
+    results = []
+    for i in range(repeat):
+        receiver, sender = context.Pipe(duplex=False)
+        process = context.Process(target=_measure, args=(env, name, sender))
+        process.start()
+        sender.close()
+        try:
+            outcome = receiver.recv()
+        except EOFError:
+            outcome = RuntimeError("benchmark process died")
+        process.join()
+        if isinstance(outcome, Exception):
+            raise outcome
+        results.append(Result(name, *outcome))
+    fastest = min(results, key=operator.attrgetter('seconds'))
+    return fastest._replace(
+        peak_growth=max(result.peak_growth for result in results))
+
+
+def _measure(env, name, sender):
+    try:
+        run = BENCHMARKS[name][0](env)
+        reset_peak_rss()
+        baseline = peak_rss()
+        start = time.perf_counter()
+        count, unit = run()
+        seconds = time.perf_counter() - start
+        sender.send((seconds, count, unit, peak_rss() - baseline))
+    except Exception as e:
+        sender.send(RuntimeError("{}: {}".format(type(e).__name__, e)))
+
+
+def format_result(result):
+    """Return a line of the table of results."""
+    rate = result.count / result.seconds if result.seconds else float('inf')
+    if result.unit == 'bytes':
+        throughput = '{:.1f} MB/s'.format(rate / 1e6)
+    else:
+        throughput = '{:.0f} {}/s'.format(rate, result.unit)
+    return '{:<24} {:>9.3f} {:>20} {:>10.1f}'.format(
+        result.name, result.seconds, throughput,
+        result.peak_growth / (1 << 20))
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description="Benchmark the stages of map_ssh_attempts on a synthetic "
+        "log served by a local SFTP server.")
+    parser.add_argument('--size', type=synthlog.parse_size,
+                        default=synthlog.parse_size('20M'),
+                        help="approximate size of the log, e.g. 100M "
+                        "(default: 20M)")
+    parser.add_argument('--ipv6', type=float, default=0.1,
+                        help="fraction of IPv6 source addresses")
+    parser.add_argument('--tor', type=float, default=0.05,
+                        help="fraction of source addresses that are Tor "
+                        "exit nodes")
+    parser.add_argument('--repeat', type=int, default=1,
+                        help="number of runs of each benchmark; the fastest "
+                        "is reported")
+    parser.add_argument('--cache-dir', type=str,
+                        default='~/.cache/map_ssh_attempts',
+                        help="cache directory of the GeoIP databases")
+    parser.add_argument('--json', type=str, metavar='PATH',
+                        help="also write the results to this file as JSON")
+    parser.add_argument('names', type=str, nargs='*', metavar='benchmark',
+                        help="benchmark to run (default: all); one of {}"
+                        .format(', '.join(BENCHMARKS)))
+    args = parser.parse_args()
+    for name in args.names:
+        if name not in BENCHMARKS:
+            parser.error("unknown benchmark: {}".format(name))
+
+    results = []
+    with tempfile.TemporaryDirectory() as directory:
+        env = Environment(directory, size=args.size, ipv6=args.ipv6,
+                          tor_fraction=args.tor, cache_dir=args.cache_dir)
+        try:
+            print('{:<24} {:>9} {:>20} {:>10}'.format(
+                'benchmark', 'seconds', 'throughput', '+peak MiB'))
+            for name, (setup, needs_geoip) in BENCHMARKS.items():
+                if args.names and name not in args.names:
+                    continue
+                if needs_geoip and not env.check_geoip():
+                    print("{:<24} skipped: GeoIP databases not in cache "
+                          "(run `map_ssh_attempts update`)".format(name))
+                    continue
+                result = run_benchmark(env, name, repeat=args.repeat)
+                results.append(result)
+                print(format_result(result))
+        finally:
+            env.close()
+    if args.json is not None:
+        with open(args.json, 'w') as f:
+            json.dump([result._asdict() for result in results], f, indent=2)
+
+
+if __name__ == '__main__':
+    main()
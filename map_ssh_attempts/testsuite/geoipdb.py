@@ -0,0 +1,128 @@
+# Copyright (C) 2014  Jim Turner
+
+# This file is part of map_ssh_attempts.
+
+# map_ssh_attempts is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by the Free
+# Software Foundation, either version 2 of the License, or (at your option) any
+# later version.
+
+# This program is distributed in the hope that it will be useful, but WITHOUT ANY
+# WARRANTY; without even the implied warranty of MERCHANTABILITY or FITNESS FOR A
+# PARTICULAR PURPOSE.  See the GNU General Public License for more details.
+
+# You should have received a copy of the GNU General Public License along with
+# this program.  If not, see <http://www.gnu.org/licenses/>.
+
+import collections
+import ipaddress
+import os.path
+import pygeoip.const
+from .. import geoip
+
+
+CityRecord = collections.namedtuple(
+    'CityRecord', ('country_code', 'city', 'latitude', 'longitude'))
+
+# Database types written for each IP version
+DATABASE_TYPES = {4: pygeoip.const.CITY_EDITION_REV1,
+                  6: pygeoip.const.CITY_EDITION_REV1_V6}
+
+# Number of bytes of each pointer of the search tree
+RECORD_LENGTH = pygeoip.const.STANDARD_RECORD_LENGTH
+
+# Networks of the sample databases, with their records.  The IPv6 networks
+# include ones on either side of /64 boundaries, and one smaller than /64,
+# which the index folds into its /64.
+SAMPLE_NETWORKS = {
+    4: [('0.0.0.0/8', CityRecord('US', None, 37.751, -97.822)),
+        ('192.0.2.0/24', CityRecord('FR', 'Paris', 48.8582, 2.3387)),
+        ('192.0.2.128/25', CityRecord('DE', 'Berlin', 52.5167, 13.4)),
+        ('198.51.100.0/23', CityRecord('JP', 'Tokyo', 35.685, 139.7514)),
+        ('203.0.113.7/32', CityRecord('BR', None, -10.0, -55.0)),
+        ('255.255.255.0/24', CityRecord('AU', 'Sydney', -33.8615, 151.2055))],
+    6: [('2001:db8::/48', CityRecord('NL', 'Amsterdam', 52.35, 4.9167)),
+        ('2001:db8:0:1::/64', CityRecord('SE', None, 62.0, 15.0)),
+        ('2001:db8:1::/63', CityRecord('IT', 'Rome', 41.9, 12.4833)),
+        ('2001:db8:2:5::/80', CityRecord('ES', None, 40.0, -4.0)),
+        ('2a00::/12', CityRecord('GB', 'London', 51.5142, -0.0931))]}
+
+
+def write_city_db(f, networks, version):
+    """Write a GeoIP City database in the legacy format read by pygeoip.
+
+    The search tree is a binary trie of the address bits, in which every
+    node holds two pointers of `RECORD_LENGTH` bytes: to a node, or past the
+    last node to a record, or to just past the last node for no record.
+    Records follow the tree, and the structure info ends the file.
+
+    :param f: binary file-like object to write to
+    :param networks: list of (network string, CityRecord tuple) tuples;
+        where networks nest, the smaller ones must come later
+    :param version: IP version of the networks
+    """
+    bits = 32 if version == 4 else 128
+    # Children of the nodes: None, ('node', index) or ('record', index)
+    nodes = [[None, None]]
+    records = []
+    for network, record in networks:
+        network = ipaddress.ip_network(network)
+        value = int(network.network_address)
+        node = 0
+        for depth in range(network.prefixlen):
+            bit = (value >> (bits - 1 - depth)) & 1
+            if depth == network.prefixlen - 1:
+                nodes[node][bit] = ('record', len(records))
+                break
+            child = nodes[node][bit]
+            if child is None or child[0] == 'record':
+                # A record covering the subtree stays on the other branches
+                nodes.append([child, child])
+                child = nodes[node][bit] = ('node', len(nodes) - 1)
+            node = child[1]
+        records.append(record)
+
+    segments = len(nodes)
+    # Offset 0 would be the pointer to no record
+    data = bytearray(b'\0')
+    offsets = []
+    for record in records:
+        offsets.append(len(data))
+        data.append(pygeoip.const.COUNTRY_CODES.index(record.country_code))
+        for field in (None, record.city, None):
+            data += (field or '').encode('iso-8859-1') + b'\0'
+        for degrees in (record.latitude, record.longitude):
+            data += int(round((degrees + 180) * 10000)).to_bytes(3, 'little')
+        if record.country_code == 'US':
+            # DMA and area code
+            data += bytes(3)
+
+    def pointer(child):
+        if child is None:
+            return segments
+        elif child[0] == 'node':
+            return child[1]
+        else:
+            return segments + offsets[child[1]]
+
+    for children in nodes:
+        for child in children:
+            f.write(pointer(child).to_bytes(RECORD_LENGTH, 'little'))
+    # pygeoip reads the record of pointer p at p + (2 * RECORD_LENGTH - 1) *
+    # segments, which is offset p - segments of the data after the tree
+    f.write(bytes(data))
+    f.write(b'\xff\xff\xff' + bytes([DATABASE_TYPES[version]]) +
+            segments.to_bytes(pygeoip.const.SEGMENT_RECORD_LENGTH, 'little'))
+
+
+def write_sample_dbs(cache_dir):
+    """Write the databases of `SAMPLE_NETWORKS` where GeoIPMultiversion
+    looks for them.
+
+    :param cache_dir: directory of the databases
+    """
+    for version, networks in SAMPLE_NETWORKS.items():
+        path = os.path.join(cache_dir,
+                            geoip.GeoIPMultiversion.db_names[version])
+        with open(path, 'wb') as f:
+            write_city_db(f, networks, version)
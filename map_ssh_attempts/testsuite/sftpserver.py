@@ -0,0 +1,156 @@
+# Copyright (C) 2014  Jim Turner
+
+# This file is part of map_ssh_attempts.
+
+# map_ssh_attempts is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by the Free
+# Software Foundation, either version 2 of the License, or (at your option) any
+# later version.
+
+# This program is distributed in the hope that it will be useful, but WITHOUT ANY
+# WARRANTY; without even the implied warranty of MERCHANTABILITY or FITNESS FOR A
+# PARTICULAR PURPOSE.  See the GNU General Public License for more details.
+
+# You should have received a copy of the GNU General Public License along with
+# this program.  If not, see <http://www.gnu.org/licenses/>.
+
+import os
+import os.path
+import paramiko
+import socket
+import threading
+from .. import connection
+
+
+class LocalSFTPServer(object):
+
+    def __init__(self, root):
+        """Serve the files under directory `root` over SFTP on localhost.
+
+        The server stands in for a remote host: remote paths are taken
+        relative to `root`, files can only be read, and any username and
+        password are accepted.  It runs in a background thread until closed.
+
+        :param root: directory to serve as the root of the remote filesystem
+        """
+        self.root = os.path.abspath(root)
+        self.host_key = paramiko.RSAKey.generate(2048)
+        self.socket = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        self.socket.bind(('127.0.0.1', 0))
+        self.socket.listen(16)
+        self.port = self.socket.getsockname()[1]
+        self.transports = []
+        self.thread = threading.Thread(target=self._serve, daemon=True)
+        self.thread.start()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+    def _serve(self):
+        while True:
+            try:
+                sock, address = self.socket.accept()
+            except OSError:
+                return
+            transport = paramiko.Transport(sock)
+            transport.add_server_key(self.host_key)
+            transport.set_subsystem_handler('sftp', paramiko.SFTPServer,
+                                            _SFTPInterface, root=self.root)
+            transport.start_server(server=_Server())
+            self.transports.append(transport)
+
+    def connect(self):
+        """Open an SSH connection to the server, as `connection.connect` does.
+
+        :return: connected SSHClient object
+        """
+        client = paramiko.SSHClient()
+        client.get_host_keys().add('[127.0.0.1]:{}'.format(self.port),
+                                   self.host_key.get_name(), self.host_key)
+        client.connect('127.0.0.1', port=self.port, username='benchmark',
+                       password='benchmark', look_for_keys=False,
+                       allow_agent=False, compress=True)
+        return client
+
+    def pool(self, hostname='localhost'):
+        """Return an SSHConnectionPool connecting `hostname` to the server.
+
+        :param hostname: name under which the server is used
+        :return: SSHConnectionPool object
+        """
+        pool = connection.SSHConnectionPool()
+        pool.add(hostname, self.connect())
+        return pool
+
+    def close(self):
+        """Stop the server and close its connections."""
+        self.socket.close()
+        for transport in self.transports:
+            transport.close()
+
+
+class _Server(paramiko.ServerInterface):
+
+    def get_allowed_auths(self, username):
+        return 'password'
+
+    def check_auth_password(self, username, password):
+        return paramiko.AUTH_SUCCESSFUL
+
+    def check_channel_request(self, kind, chanid):
+        if kind == 'session':
+            return paramiko.OPEN_SUCCEEDED
+        return paramiko.OPEN_FAILED_ADMINISTRATIVELY_PROHIBITED
+
+
+class _SFTPHandle(paramiko.SFTPHandle):
+
+    def stat(self):
+        try:
+            return paramiko.SFTPAttributes.from_stat(
+                os.fstat(self.readfile.fileno()))
+        except OSError as e:
+            return paramiko.SFTPServer.convert_errno(e.errno)
+
+
+class _SFTPInterface(paramiko.SFTPServerInterface):
+
+    def __init__(self, server, *args, root, **kwargs):
+        super().__init__(server, *args, **kwargs)
+        self.root = root
+
+    def _local_path(self, path):
+        return self.root + self.canonicalize(path)
+
+    def stat(self, path):
+        try:
+            return paramiko.SFTPAttributes.from_stat(
+                os.stat(self._local_path(path)))
+        except OSError as e:
+            return paramiko.SFTPServer.convert_errno(e.errno)
+
+    lstat = stat
+
+    def list_folder(self, path):
+        local_path = self._local_path(path)
+        try:
+            return [paramiko.SFTPAttributes.from_stat(
+                        os.stat(os.path.join(local_path, name)), name)
+                    for name in os.listdir(local_path)]
+        except OSError as e:
+            return paramiko.SFTPServer.convert_errno(e.errno)
+
+    def open(self, path, flags, attr):
+        if flags & (os.O_WRONLY | os.O_RDWR):
+            return paramiko.SFTP_PERMISSION_DENIED
+        try:
+            f = open(self._local_path(path), 'rb')
+        except OSError as e:
+            return paramiko.SFTPServer.convert_errno(e.errno)
+        handle = _SFTPHandle(flags)
+        handle.filename = self._local_path(path)
+        handle.readfile = f
+        return handle
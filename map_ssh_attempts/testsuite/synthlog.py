@@ -0,0 +1,209 @@
+# Copyright (C) 2014  Jim Turner
+
+# This file is part of map_ssh_attempts.
+
+# map_ssh_attempts is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by the Free
+# Software Foundation, either version 2 of the License, or (at your option) any
+# later version.
+
+# This program is distributed in the hope that it will be useful, but WITHOUT ANY
+# WARRANTY; without even the implied warranty of MERCHANTABILITY or FITNESS FOR A
+# PARTICULAR PURPOSE.  See the GNU General Public License for more details.
+
+# You should have received a copy of the GNU General Public License along with
+# this program.  If not, see <http://www.gnu.org/licenses/>.
+
+import argparse
+import collections
+import datetime
+import ipaddress
+import itertools
+import random
+
+
+SyntheticLog = collections.namedtuple(
+    'SyntheticLog', ('lines', 'attempts', 'tor_addresses'))
+
+# Messages of lines reporting attempts, with their relative frequencies
+ATTEMPT_MESSAGES = [
+    (8, 'sshd[{pid}]: Invalid user {user} from {ip} port {port}'),
+    (1, 'sshd[{pid}]: Invalid user {user} from {ip}'),
+    (1, 'sshd[{pid}]: User {user} from {ip} not allowed because not listed '
+        'in AllowUsers')]
+
+# Messages of other lines, with their relative frequencies
+OTHER_MESSAGES = [
+    (20, 'sshd[{pid}]: Failed password for invalid user {user} from {ip} '
+         'port {port} ssh2'),
+    (15, 'sshd[{pid}]: input_userauth_request: invalid user {user} [preauth]'),
+    (15, 'sshd[{pid}]: Received disconnect from {ip} port {port}:11: '
+         'Bye Bye [preauth]'),
+    (10, 'sshd[{pid}]: Connection closed by {ip} port {port} [preauth]'),
+    (10, 'sshd[{pid}]: pam_unix(sshd:auth): authentication failure; '
+         'logname= uid=0 euid=0 tty=ssh ruser= rhost={ip}'),
+    (2, 'sshd[{pid}]: Accepted publickey for admin from {ip} port {port} '
+        'ssh2: RSA SHA256:n8BdW2LHfF0yZ4xXh6lQmJ1zkmU4gS8bZmQ3t1pXrXk'),
+    (2, 'sshd[{pid}]: pam_unix(sshd:session): session opened for user admin '
+        'by (uid=0)'),
+    (12, 'CRON[{pid}]: pam_unix(cron:session): session opened for user root '
+         'by (uid=0)'),
+    (12, 'CRON[{pid}]: pam_unix(cron:session): session closed for user root'),
+    (1, 'systemd-logind[{pid}]: New session {port} of user admin.'),
+    (1, 'sudo:    admin : TTY=pts/0 ; PWD=/home/admin ; USER=root ; '
+        'COMMAND=/usr/bin/apt-get update')]
+
+# Usernames tried by attackers, most common first
+USERNAMES = ['admin', 'test', 'user', 'ubuntu', 'oracle', 'postgres', 'git',
+             'guest', 'ftpuser', 'pi', 'support', 'info', 'mysql', 'deploy',
+             'jenkins', 'hadoop', 'nagios', 'tomcat', 'www', 'ftp', 'backup',
+             'teamspeak', 'minecraft', 'ts3', 'student', 'demo', 'web',
+             'server', 'operator', 'steam']
+
+# Mean number of seconds between lines
+LINE_INTERVAL = 2.0
+
+
+def make_addresses(count, *, ipv6=0.1, tor=0.05, rng=random):
+    """Create `count` random global addresses of attack sources.
+
+    :param count: number of addresses
+    :param ipv6: fraction of IPv6 addresses
+    :param tor: fraction of addresses that are Tor exit nodes
+    :param rng: random.Random object to draw from
+    :return: tuple of (list of addresses, list of those that are Tor exit
+        nodes)
+    """
+    addresses = []
+    for i in range(count):
+        if rng.random() < ipv6:
+            # Global unicast, 2000::/3
+            addresses.append(ipaddress.IPv6Address(
+                (1 << 125) | rng.getrandbits(125)))
+        else:
+            # Unicast, 1.0.0.0 to 223.255.255.255
+            addresses.append(ipaddress.IPv4Address(
+                rng.randrange(0x01000000, 0xe0000000)))
+    tor_addresses = [addr for addr in addresses if rng.random() < tor]
+    return addresses, tor_addresses
+
+
+def generate_log(f, size, *, ipv6=0.1, tor=0.05, attempts=0.3, sources=5000,
+                 start=None, seed=0):
+    """Write about `size` bytes of synthetic ``auth.log`` lines to `f`.
+
+    The lines are a mix of attempts (as parsed by `getdata.parse_log`) and
+    other sshd, cron, logind and sudo messages, with increasing timestamps.
+    Attempts come from `sources` addresses, a few of which are much more
+    active than the rest, as in real attacks.
+
+    :param f: binary file-like object to write to
+    :param size: number of bytes to write, rounded up to a whole line
+    :param ipv6: fraction of the source addresses that are IPv6
+    :param tor: fraction of the source addresses that are Tor exit nodes
+    :param attempts: fraction of the lines that report attempts
+    :param sources: number of distinct source addresses
+    :param start: datetime of the first line; defaults to the start of the
+        current year
+    :param seed: seed of the random numbers, so that logs can be reproduced
+    :return: SyntheticLog tuple with the numbers of lines and attempts
+        written and the list of Tor exit node addresses
+    """
+    rng = random.Random(seed)
+    if start is None:
+        start = datetime.datetime(datetime.datetime.now().year, 1, 1)
+    addresses, tor_addresses = make_addresses(sources, ipv6=ipv6, tor=tor,
+                                              rng=rng)
+    ips = [str(addr) for addr in addresses]
+    # Zipf-like activity of sources and usernames
+    ip_weights = list(itertools.accumulate(1 / (rank + 1)
+                                           for rank in range(len(ips))))
+    user_weights = list(itertools.accumulate(1 / (rank + 1)
+                                             for rank in range(len(USERNAMES))))
+    attempt_weights = list(itertools.accumulate(
+        weight for weight, message in ATTEMPT_MESSAGES))
+    other_weights = list(itertools.accumulate(
+        weight for weight, message in OTHER_MESSAGES))
+    timestamp = start
+    written = 0
+    lines = 0
+    attempt_count = 0
+    while written < size:
+        timestamp += datetime.timedelta(
+            seconds=round(rng.expovariate(1 / LINE_INTERVAL)))
+        if rng.random() < attempts:
+            message, = rng.choices(ATTEMPT_MESSAGES, cum_weights=attempt_weights)
+            attempt_count += 1
+        else:
+            message, = rng.choices(OTHER_MESSAGES, cum_weights=other_weights)
+        ip, = rng.choices(ips, cum_weights=ip_weights)
+        user, = rng.choices(USERNAMES, cum_weights=user_weights)
+        line = '{:%b} {:2d} {:%H:%M:%S} server {}\n'.format(
+            timestamp, timestamp.day, timestamp,
+            message[1].format(pid=rng.randrange(1000, 65536), user=user,
+                              ip=ip, port=rng.randrange(1024, 65536)))
+        data = line.encode('UTF-8')
+        f.write(data)
+        written += len(data)
+        lines += 1
+    return SyntheticLog(lines, attempt_count, tor_addresses)
+
+
+def write_tor_list(path, addresses):
+    """Write `addresses` as a Tor exit node list, as read by
+    `tor.TorExitNodeDatabase`.
+
+    :param path: path of the list
+    :param addresses: iterable of address objects
+    """
+    with open(path, 'w') as f:
+        for addr in addresses:
+            f.write('{}\n'.format(addr))
+
+
+def parse_size(string):
+    """Parse a number of bytes with an optional K, M or G suffix.
+
+    :param string: size such as ``512``, ``64K`` or ``1G``
+    :return: int
+    """
+    units = {'K': 1 << 10, 'M': 1 << 20, 'G': 1 << 30}
+    string = string.strip().upper()
+    if string and string[-1] in units:
+        return int(float(string[:-1]) * units[string[-1]])
+    return int(string)
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description="Generate a synthetic auth.log.")
+    parser.add_argument('--size', type=parse_size, default=parse_size('10M'),
+                        help="approximate size of the log, e.g. 100M "
+                        "(default: 10M)")
+    parser.add_argument('--ipv6', type=float, default=0.1,
+                        help="fraction of IPv6 source addresses")
+    parser.add_argument('--tor', type=float, default=0.05,
+                        help="fraction of source addresses that are Tor "
+                        "exit nodes")
+    parser.add_argument('--attempts', type=float, default=0.3,
+                        help="fraction of lines reporting attempts")
+    parser.add_argument('--sources', type=int, default=5000,
+                        help="number of distinct source addresses")
+    parser.add_argument('--seed', type=int, default=0,
+                        help="seed of the random numbers")
+    parser.add_argument('--tor-list', type=str, metavar='PATH',
+                        help="also write the Tor exit nodes to this file")
+    parser.add_argument('path', type=str, help="path of the log to write")
+    args = parser.parse_args()
+
+    with open(args.path, 'wb') as f:
+        log = generate_log(f, args.size, ipv6=args.ipv6, tor=args.tor,
+                           attempts=args.attempts, sources=args.sources,
+                           seed=args.seed)
+    if args.tor_list is not None:
+        write_tor_list(args.tor_list, log.tor_addresses)
+    print("Wrote {} lines with {} attempts".format(log.lines, log.attempts))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,230 @@
+# Copyright (C) 2014  Jim Turner
+
+# This file is part of map_ssh_attempts.
+
+# map_ssh_attempts is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by the Free
+# Software Foundation, either version 2 of the License, or (at your option) any
+# later version.
+
+# This program is distributed in the hope that it will be useful, but WITHOUT ANY
+# WARRANTY; without even the implied warranty of MERCHANTABILITY or FITNESS FOR A
+# PARTICULAR PURPOSE.  See the GNU General Public License for more details.
+
+# You should have received a copy of the GNU General Public License along with
+# this program.  If not, see <http://www.gnu.org/licenses/>.
+
+import collections
+import contextlib
+import datetime
+import io
+import ipaddress
+import random
+import tempfile
+import unittest
+import numpy as np
+from .. import aggregate
+from .. import columns
+from .. import enrich
+from .. import geoip
+from . import geoipdb
+
+
+# Addresses of the attempts, in and out of the sample GeoIP networks
+ADDRESSES = ['192.0.2.1', '192.0.2.200', '198.51.100.7', '203.0.113.7',
+             '203.0.113.8', '2001:db8::1', '2001:db8:1::5', '2a00:1450::1']
+
+USERNAMES = ['root', 'admin', 'test', 'élève', 'oracle']
+
+HOSTNAMES = ['alpha', 'beta', 'gamma']
+
+
+def make_attempts(count=2000, seed=1):
+    """Return random HostAttempt tuples spread over three months."""
+    rng = random.Random(seed)
+    start = datetime.datetime(2020, 11, 20)
+    return [columns.HostAttempt(
+        rng.choice(HOSTNAMES),
+        start + datetime.timedelta(seconds=rng.randrange(90 * 86400)),
+        rng.choice(USERNAMES),
+        ipaddress.ip_address(rng.choice(ADDRESSES)))
+        for i in range(count)]
+
+
+def bucket_start(dt, bucket):
+    """Return the start of the time bucket of `dt`, computed with datetime."""
+    if bucket == 'minute':
+        return dt.replace(second=0)
+    elif bucket == 'hour':
+        return dt.replace(minute=0, second=0)
+    elif bucket == 'week':
+        day = dt.replace(hour=0, minute=0, second=0)
+        return day - datetime.timedelta(days=day.weekday())
+    elif bucket == 'month':
+        return dt.replace(day=1, hour=0, minute=0, second=0)
+    return dt.replace(hour=0, minute=0, second=0)
+
+
+class AggregateTest(unittest.TestCase):
+
+    @classmethod
+    def setUpClass(cls):
+        cls.directory = tempfile.TemporaryDirectory()
+        geoipdb.write_sample_dbs(cls.directory.name)
+        cls.geoipmv = geoip.GeoIPMultiversion(cls.directory.name,
+                                              mode='memory')
+        with contextlib.redirect_stdout(io.StringIO()):
+            cls.geoipmv.load_dbs()
+        cls.attempts = make_attempts()
+        cls.batch = columns.AttemptBatch.from_attempts(cls.attempts)
+
+    @classmethod
+    def tearDownClass(cls):
+        cls.directory.cleanup()
+
+    def enricher(self):
+        """Return an Enricher using the sample databases."""
+        return enrich.Enricher(self.geoipmv)
+
+    def value(self, attempt, key, bucket='day'):
+        """Return the value of `key` of `attempt`, as the old bar plots
+        counted it."""
+        if key == 'username':
+            return attempt.username
+        elif key == 'host':
+            return attempt.hostname
+        elif key == 'ip':
+            return attempt.ip_address
+        elif key == 'time':
+            return bucket_start(attempt.datetime, bucket)
+        record = self.geoipmv.record_by_addr(attempt.ip_address)
+        if key == 'country':
+            return record['country_name'] if record else None
+        return (record.get('city') or None) if record else None
+
+    def reference(self, keys, bucket='day'):
+        """Count the attempts one at a time, as the old `count_property`
+        did."""
+        counts = collections.Counter(
+            tuple(self.value(attempt, key, bucket) for key in keys)
+            for attempt in self.attempts)
+        if len(keys) == 1:
+            return {values[0]: count for values, count in counts.items()}
+        return dict(counts)
+
+    def test_matches_reference(self):
+        for keys in (('username',), ('country',), ('city',), ('ip',),
+                     ('host',), ('time',), ('country', 'username'),
+                     ('host', 'ip', 'username'), ('time', 'city')):
+            for attempts in (self.batch, self.attempts):
+                with self.subTest(keys=keys, batch=attempts is self.batch):
+                    counts = aggregate.aggregate(attempts, keys,
+                                                 enricher=self.enricher())
+                    self.assertEqual(counts.to_dict(), self.reference(keys))
+                    self.assertEqual(counts.counts.sum(), len(self.attempts))
+
+    def test_buckets(self):
+        for bucket in aggregate.BUCKETS:
+            with self.subTest(bucket=bucket):
+                counts = aggregate.aggregate(self.batch, 'time',
+                                             bucket=bucket)
+                self.assertEqual(counts.to_dict(),
+                                 self.reference(('time',), bucket))
+
+    def test_time_buckets(self):
+        # Around the turn of the year and the start of a week
+        times = [datetime.datetime(2021, 1, 4),
+                 datetime.datetime(2021, 1, 3, 23),
+                 datetime.datetime(2020, 12, 31, 23, 59, 59),
+                 datetime.datetime(2021, 1, 4, 0, 0, 1)]
+        timestamps = np.array([columns.to_timestamp(dt) for dt in times],
+                              dtype=np.int64)
+        for bucket in aggregate.BUCKETS:
+            with self.subTest(bucket=bucket):
+                starts, ids = aggregate.time_buckets(timestamps, bucket)
+                self.assertEqual(starts, sorted(set(starts)))
+                self.assertEqual([starts[i] for i in ids.tolist()],
+                                 [bucket_start(dt, bucket) for dt in times])
+
+    def test_merge(self):
+        keys = ('country', 'username')
+        half = len(self.attempts) // 2
+        first = aggregate.aggregate(self.attempts[:half], keys,
+                                    enricher=self.enricher())
+        second = aggregate.aggregate(self.attempts[half:], keys,
+                                     enricher=self.enricher())
+        self.assertEqual(first.merge(second).to_dict(), self.reference(keys))
+
+    def test_totals(self):
+        counts = aggregate.aggregate(self.batch, ('host', 'username'))
+        self.assertEqual(counts.totals('username').to_dict(),
+                         self.reference(('username',)))
+
+    def test_top(self):
+        counts = aggregate.aggregate(self.batch, 'ip')
+        top = list(counts.top(3))
+        expected = self.reference(('ip',))
+        self.assertEqual([count for values, count in top],
+                         sorted(expected.values(), reverse=True)[:3])
+        for values, count in top:
+            self.assertEqual(expected[values[0]], count)
+        self.assertEqual(len(counts.top()), len(counts))
+
+    def test_series(self):
+        counts = aggregate.aggregate(self.batch, ('time', 'username'),
+                                     bucket='week')
+        x_labels, names, matrix = counts.series('time', top=2)
+        totals = self.reference(('username',))
+        ranked = sorted(totals, key=lambda username: -totals[username])
+        self.assertEqual(names, [(ranked[0],), (ranked[1],), None])
+        self.assertEqual(matrix.shape, (3, len(x_labels)))
+        expected = self.reference(('time', 'username'), 'week')
+        for row, name in enumerate(names[:2]):
+            self.assertEqual(matrix[row].tolist(),
+                             [expected.get((x, name[0]), 0)
+                              for x in x_labels])
+        self.assertEqual(matrix.sum(axis=0).tolist(),
+                         [sum(count for (x, username), count
+                              in expected.items() if x == label)
+                          for label in x_labels])
+
+    def test_empty(self):
+        counts = aggregate.aggregate(columns.AttemptBatch.empty(),
+                                     ('host', 'username'))
+        self.assertEqual(len(counts), 0)
+        self.assertEqual(counts.to_dict(), {})
+
+
+class GroupTest(unittest.TestCase):
+
+    def check(self, sizes, length=5000, weights=None):
+        """Check `aggregate.group` on random codes of keys of `sizes`."""
+        rng = np.random.default_rng(sum(sizes))
+        # Few distinct values, so that combinations repeat
+        codes = [rng.choice(rng.integers(0, size, 20), length).astype(np.int64)
+                 for size in sizes]
+        combinations, counts, inverse = aggregate.group(codes, sizes, weights)
+        expected = collections.Counter()
+        for i, key in enumerate(zip(*[ids.tolist() for ids in codes])):
+            expected[key] += 1 if weights is None else int(weights[i])
+        self.assertEqual(
+            dict(zip(zip(*[ids.tolist() for ids in combinations]),
+                     counts.tolist())), dict(expected))
+        for ids, combination in zip(codes, combinations):
+            self.assertTrue((combination[inverse] == ids).all())
+
+    def test_dense(self):
+        self.check([5, 7])
+        self.check([5, 7], weights=np.arange(5000, dtype=np.int64))
+
+    def test_sorted(self):
+        self.check([1 << 20, 1 << 20])
+        self.check([1 << 20, 1 << 20], weights=np.arange(5000, dtype=np.int64))
+
+    def test_wide(self):
+        # Too many combinations to number in an int64
+        self.check([1 << 40, 1 << 40, 3])
+
+
+if __name__ == '__main__':
+    unittest.main()
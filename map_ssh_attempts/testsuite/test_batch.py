@@ -0,0 +1,73 @@
+# Copyright (C) 2014  Jim Turner
+
+# This file is part of map_ssh_attempts.
+
+# map_ssh_attempts is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by the Free
+# Software Foundation, either version 2 of the License, or (at your option) any
+# later version.
+
+# This program is distributed in the hope that it will be useful, but WITHOUT ANY
+# WARRANTY; without even the implied warranty of MERCHANTABILITY or FITNESS FOR A
+# PARTICULAR PURPOSE.  See the GNU General Public License for more details.
+
+# You should have received a copy of the GNU General Public License along with
+# this program.  If not, see <http://www.gnu.org/licenses/>.
+
+import contextlib
+import io
+import os.path
+import tempfile
+import unittest
+import matplotlib
+matplotlib.use('Agg')
+from .. import batch
+from .. import columns
+from .. import enrich
+from .. import geoip
+from .. import store
+from . import geoipdb
+from .test_columns import make_attempts
+
+
+class RenderHostsTest(unittest.TestCase):
+
+    def setUp(self):
+        self.directory = tempfile.TemporaryDirectory()
+        self.addCleanup(self.directory.cleanup)
+        geoipdb.write_sample_dbs(self.directory.name)
+        attempts = make_attempts(['a', 'b'])
+        with store.AttemptStore(self.directory.name) as attempt_store:
+            for hostname in ('a', 'b'):
+                attempt_store.add(hostname, columns.AttemptBatch.from_attempts(
+                    [columns.Attempt(*attempt[1:]) for attempt in attempts
+                     if attempt.hostname == hostname]))
+        self.enricher = enrich.Enricher(
+            geoip.GeoIPMultiversion(self.directory.name))
+
+    def test_load_resources(self):
+        with contextlib.redirect_stdout(io.StringIO()):
+            resources = batch.load_resources(self.enricher)
+        # The enricher of the caller is left reading the database files
+        self.assertEqual(self.enricher.geoipmv.mode, 'standard')
+        self.assertEqual(self.enricher.geoipmv.dbs, {})
+        self.assertEqual(resources.enricher.geoipmv.mode, 'mmap')
+        self.assertEqual(sorted(resources.enricher.geoipmv.dbs), [4, 6])
+
+    def test_render_bar(self):
+        output = os.path.join(self.directory.name, '{host}.png')
+        with contextlib.redirect_stdout(io.StringIO()):
+            resources = batch.load_resources(self.enricher)
+            paths = batch.render_hosts(
+                batch.render_bar, ['a', 'b'], output, resources=resources,
+                max_workers=2, cache_dir=self.directory.name,
+                prop='country')
+        self.assertEqual(sorted(paths), [output.format(host=hostname)
+                                         for hostname in ('a', 'b')])
+        for path in paths:
+            with open(path, 'rb') as f:
+                self.assertEqual(f.read(8), b'\x89PNG\r\n\x1a\n')
+
+
+if __name__ == '__main__':
+    unittest.main()
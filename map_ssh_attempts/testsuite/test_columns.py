@@ -0,0 +1,129 @@
+# Copyright (C) 2014  Jim Turner
+
+# This file is part of map_ssh_attempts.
+
+# map_ssh_attempts is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by the Free
+# Software Foundation, either version 2 of the License, or (at your option) any
+# later version.
+
+# This program is distributed in the hope that it will be useful, but WITHOUT ANY
+# WARRANTY; without even the implied warranty of MERCHANTABILITY or FITNESS FOR A
+# PARTICULAR PURPOSE.  See the GNU General Public License for more details.
+
+# You should have received a copy of the GNU General Public License along with
+# this program.  If not, see <http://www.gnu.org/licenses/>.
+
+import datetime
+import ipaddress
+import unittest
+import numpy as np
+from .. import columns
+
+
+def make_attempts(hostnames=None):
+    """Return a list of attempts mixing IP versions, usernames and hosts.
+
+    :param hostnames: list of hostnames to cycle through, or None for
+        Attempt tuples without hostnames
+    :return: list of Attempt or HostAttempt tuples
+    """
+    start = datetime.datetime(2020, 12, 31, 23, 59)
+    addresses = [ipaddress.ip_address('192.0.2.1'),
+                 ipaddress.ip_address('2001:db8::1'),
+                 ipaddress.ip_address('198.51.100.200'),
+                 # Trailing zero bytes, which bytes arrays drop
+                 ipaddress.ip_address('2001:db8::'),
+                 ipaddress.ip_address('0.0.0.0')]
+    usernames = ['root', 'admin', 'élève', 'test']
+    attempts = []
+    for i in range(50):
+        attempt = columns.Attempt(start + datetime.timedelta(seconds=7 * i),
+                                  usernames[i % len(usernames)],
+                                  addresses[i * 3 % len(addresses)])
+        if hostnames is not None:
+            attempt = columns.HostAttempt(hostnames[i % len(hostnames)],
+                                          *attempt)
+        attempts.append(attempt)
+    return attempts
+
+
+class AttemptBatchTest(unittest.TestCase):
+
+    def test_round_trip(self):
+        for hostnames in (None, ['a', 'b', 'c']):
+            with self.subTest(hostnames=hostnames):
+                attempts = make_attempts(hostnames)
+                batch = columns.AttemptBatch.from_attempts(attempts)
+                self.assertEqual(len(batch), len(attempts))
+                self.assertEqual(list(batch), attempts)
+
+    def test_bytes_usernames(self):
+        builder = columns.BatchBuilder()
+        address = ipaddress.ip_address('192.0.2.1')
+        builder.append(0, 'élève', address)
+        builder.append(1, 'élève'.encode('UTF-8'), address)
+        batch = builder.build()
+        self.assertEqual(batch.usernames, ['élève'])
+        self.assertEqual(batch.attempt_usernames(), ['élève', 'élève'])
+
+    def test_timestamps(self):
+        dt = datetime.datetime(2020, 2, 29, 12, 30, 45)
+        self.assertEqual(columns.from_timestamp(columns.to_timestamp(dt)), dt)
+
+    def test_empty(self):
+        batch = columns.AttemptBatch.empty()
+        self.assertEqual(len(batch), 0)
+        self.assertEqual(list(batch), [])
+        self.assertEqual(list(columns.AttemptBatch.concatenate([])), [])
+
+    def test_concatenate(self):
+        attempts = make_attempts(['a', 'b'])
+        batches = [columns.AttemptBatch.from_attempts(attempts[:10]),
+                   columns.AttemptBatch.from_attempts(attempts[10:11]),
+                   columns.AttemptBatch.from_attempts(attempts[11:])]
+        batch = columns.AttemptBatch.concatenate(batches)
+        self.assertEqual(list(batch), attempts)
+        self.assertEqual(len(batch.usernames), len(set(batch.usernames)))
+
+    def test_filter(self):
+        attempts = make_attempts(['a', 'b'])
+        batch = columns.AttemptBatch.from_attempts(attempts)
+        since = attempts[5].datetime
+        until = attempts[40].datetime
+        usernames = {'root', 'élève'}
+        self.assertEqual(
+            list(batch.filter(since=since, until=until, usernames=usernames)),
+            [attempt for attempt in attempts
+             if since <= attempt.datetime < until and
+             attempt.username in usernames])
+        self.assertEqual(list(batch.filter()), attempts)
+
+    def test_with_hostname(self):
+        attempts = make_attempts()
+        batch = columns.AttemptBatch.from_attempts(attempts).with_hostname('h')
+        self.assertEqual(list(batch), [columns.HostAttempt('h', *attempt)
+                                       for attempt in attempts])
+
+    def test_address_ids(self):
+        attempts = make_attempts()
+        addresses, ids = columns.AttemptBatch.from_attempts(
+            attempts).address_ids()
+        self.assertEqual(len(addresses), len(set(addresses)))
+        self.assertEqual([addresses[i] for i in ids.tolist()],
+                         [attempt.ip_address for attempt in attempts])
+
+    def test_address_counts(self):
+        attempts = make_attempts()
+        addresses, counts = columns.AttemptBatch.from_attempts(
+            attempts).address_counts()
+        expected = {}
+        for attempt in attempts:
+            expected[attempt.ip_address] = expected.get(attempt.ip_address,
+                                                        0) + 1
+        self.assertEqual(dict(zip(addresses, counts.tolist())), expected)
+        self.assertEqual(counts.dtype, np.int64)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,133 @@
+# Copyright (C) 2014  Jim Turner
+
+# This file is part of map_ssh_attempts.
+
+# map_ssh_attempts is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by the Free
+# Software Foundation, either version 2 of the License, or (at your option) any
+# later version.
+
+# This program is distributed in the hope that it will be useful, but WITHOUT ANY
+# WARRANTY; without even the implied warranty of MERCHANTABILITY or FITNESS FOR A
+# PARTICULAR PURPOSE.  See the GNU General Public License for more details.
+
+# You should have received a copy of the GNU General Public License along with
+# this program.  If not, see <http://www.gnu.org/licenses/>.
+
+import contextlib
+import gzip
+import http.server
+import io
+import os
+import os.path
+import stat
+import tempfile
+import threading
+import unittest
+from .. import download
+
+
+class FileHandler(http.server.BaseHTTPRequestHandler):
+
+    def do_GET(self):
+        self.server.requests.append((self.path, dict(self.headers)))
+        if self.path not in self.server.files:
+            self.send_error(404)
+            return
+        data, etag = self.server.files[self.path]
+        if self.headers.get('If-None-Match') == etag:
+            self.send_response(304)
+            self.end_headers()
+            return
+        self.send_response(200)
+        self.send_header('ETag', etag)
+        self.send_header('Content-Length', str(len(data)))
+        self.end_headers()
+        self.wfile.write(data)
+
+    def log_message(self, *args):
+        pass
+
+
+class DownloadTest(unittest.TestCase):
+
+    def setUp(self):
+        self.directory = tempfile.TemporaryDirectory()
+        self.addCleanup(self.directory.cleanup)
+        self.server = http.server.HTTPServer(('127.0.0.1', 0), FileHandler)
+        self.server.files = {}
+        self.server.requests = []
+        self.addCleanup(self.server.server_close)
+        thread = threading.Thread(target=self.server.serve_forever)
+        thread.start()
+        self.addCleanup(thread.join)
+        self.addCleanup(self.server.shutdown)
+
+    def source(self, name, gzipped=False):
+        """Return the Source of the served file `name`."""
+        return download.Source(
+            'http://127.0.0.1:{}/{}'.format(self.server.server_port, name),
+            os.path.join(self.directory.name, 'cache', name), gzipped)
+
+    def read(self, source):
+        """Return the contents of the downloaded file of `source`."""
+        with open(source.path, 'rb') as f:
+            return f.read()
+
+    def test_conditional(self):
+        source = self.source('tor.csv')
+        self.server.files['/tor.csv'] = (b'first', '"1"')
+        self.assertTrue(download.download(source))
+        self.assertEqual(self.read(source), b'first')
+        self.assertFalse(download.download(source))
+        self.assertEqual(self.server.requests[-1][1].get('If-None-Match'),
+                         '"1"')
+        self.assertEqual(self.read(source), b'first')
+        self.server.files['/tor.csv'] = (b'second', '"2"')
+        self.assertTrue(download.download(source))
+        self.assertEqual(self.read(source), b'second')
+
+    def test_missing_file_not_conditional(self):
+        source = self.source('tor.csv')
+        self.server.files['/tor.csv'] = (b'first', '"1"')
+        download.download(source)
+        os.unlink(source.path)
+        self.assertTrue(download.download(source))
+        self.assertNotIn('If-None-Match', self.server.requests[-1][1])
+        self.assertEqual(self.read(source), b'first')
+
+    def test_gunzip(self):
+        source = self.source('GeoLiteCity.dat', gzipped=True)
+        data = os.urandom(3 * download.BLOCK_SIZE // 2)
+        f = io.BytesIO()
+        with gzip.GzipFile(fileobj=f, mode='wb') as g:
+            g.write(data)
+        self.server.files['/GeoLiteCity.dat'] = (f.getvalue(), '"1"')
+        self.assertTrue(download.download(source))
+        self.assertEqual(self.read(source), data)
+
+    def test_permissions(self):
+        source = self.source('tor.csv')
+        self.server.files['/tor.csv'] = (b'first', '"1"')
+        download.download(source)
+        for path in (source.path, source.path + '.meta'):
+            with self.subTest(path=path):
+                self.assertEqual(stat.S_IMODE(os.stat(path).st_mode),
+                                 download.FILE_MODE)
+
+    def test_partial_failure(self):
+        good = self.source('tor.csv')
+        bad = self.source('missing.dat')
+        self.server.files['/tor.csv'] = (b'first', '"1"')
+        with contextlib.redirect_stdout(io.StringIO()):
+            with self.assertRaises(download.DownloadError) as raised:
+                download.download_all([bad, good])
+        self.assertEqual(raised.exception.updated, {good.path})
+        self.assertEqual(list(raised.exception.failed), [bad.path])
+        self.assertEqual(self.read(good), b'first')
+        self.assertEqual(sorted(os.listdir(os.path.dirname(good.path))),
+                         ['tor.csv', 'tor.csv.meta'])
+
+
+if __name__ == '__main__':
+    unittest.main()
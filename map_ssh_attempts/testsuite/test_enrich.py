@@ -0,0 +1,109 @@
+# Copyright (C) 2014  Jim Turner
+
+# This file is part of map_ssh_attempts.
+
+# map_ssh_attempts is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by the Free
+# Software Foundation, either version 2 of the License, or (at your option) any
+# later version.
+
+# This program is distributed in the hope that it will be useful, but WITHOUT ANY
+# WARRANTY; without even the implied warranty of MERCHANTABILITY or FITNESS FOR A
+# PARTICULAR PURPOSE.  See the GNU General Public License for more details.
+
+# You should have received a copy of the GNU General Public License along with
+# this program.  If not, see <http://www.gnu.org/licenses/>.
+
+import contextlib
+import io
+import ipaddress
+import tempfile
+import unittest
+from .. import columns
+from .. import enrich
+from .. import geoindex
+from .. import geoip
+from .. import tor
+from . import geoipdb
+
+
+# Addresses in and out of the sample GeoIP networks, none of them in a /64
+# network that the index folds
+ADDRESSES = ['0.0.0.1', '192.0.2.1', '192.0.2.127', '192.0.2.128',
+             '198.51.100.7', '198.51.101.255', '198.51.102.0', '203.0.113.7',
+             '203.0.113.8', '255.255.255.255', '2001:db8::1',
+             '2001:db8:0:1::5', '2001:db8:0:2::', '2001:db8:1:1:ffff::',
+             '2001:db8:2::', '2a00:1450::1', '2c00::1']
+
+# Tor exit nodes among them
+TOR_ENTRIES = ['192.0.2.1', '203.0.113.0/24', '2001:db8:0:1::/64']
+
+
+class EnricherTest(unittest.TestCase):
+
+    @classmethod
+    def setUpClass(cls):
+        cls.directory = tempfile.TemporaryDirectory()
+        geoipdb.write_sample_dbs(cls.directory.name)
+        cls.geoipmv = geoip.GeoIPMultiversion(cls.directory.name,
+                                              mode='memory')
+        cls.index = geoindex.GeoIPIndex(cls.directory.name)
+        with contextlib.redirect_stdout(io.StringIO()):
+            cls.geoipmv.load_dbs()
+            cls.index.build(cls.geoipmv)
+        cls.index.load()
+        cls.tordb = tor.TorExitNodeDatabase(cls.directory.name)
+        cls.tordb.db = tor.build_index(TOR_ENTRIES)
+        cls.addrs = [ipaddress.ip_address(addr) for addr in ADDRESSES]
+
+    @classmethod
+    def tearDownClass(cls):
+        cls.index.arrays = {}
+        cls.directory.cleanup()
+
+    def enricher(self, index=None):
+        """Return an Enricher using the sample databases."""
+        return enrich.Enricher(self.geoipmv, self.tordb, index=index,
+                               tor_lookup=True)
+
+    def test_bulk_matches_single(self):
+        single = self.enricher().locate_addresses(self.addrs)
+        bulk = self.enricher(self.index).locate_addresses(self.addrs)
+        self.assertEqual(sum(location.coordinate is not None
+                             for location in single), 13)
+        self.assertEqual(sum(location.is_tor for location in single), 4)
+        for addr, expected, location in zip(self.addrs, single, bulk):
+            with self.subTest(addr=str(addr)):
+                # The index has no cities
+                self.assertEqual(location, expected._replace(city=None))
+
+    def test_bulk_cities(self):
+        single = self.enricher().locate_addresses(self.addrs, city=True)
+        bulk = self.enricher(self.index).locate_addresses(self.addrs,
+                                                          city=True)
+        self.assertEqual(bulk, single)
+        self.assertIn('Paris', [location.city for location in bulk])
+
+    def test_locate_counts(self):
+        attempts = [columns.Attempt(columns.from_timestamp(i), 'root',
+                                    self.addrs[i * 7 % len(self.addrs)])
+                    for i in range(100)]
+        for index in (None, self.index):
+            for source in (attempts,
+                           columns.AttemptBatch.from_attempts(attempts)):
+                with self.subTest(index=index is not None,
+                                  batch=source is not attempts):
+                    enricher = self.enricher(index)
+                    counts = enricher.locate_counts(source)
+                    self.assertEqual(sum(count for addr, location, count
+                                         in counts), len(attempts))
+                    for addr, location, count in counts:
+                        self.assertEqual(
+                            count, sum(attempt.ip_address == addr
+                                       for attempt in attempts))
+                        self.assertEqual(location, enricher.locate_addresses(
+                            [addr])[0])
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,216 @@
+# Copyright (C) 2014  Jim Turner
+
+# This file is part of map_ssh_attempts.
+
+# map_ssh_attempts is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by the Free
+# Software Foundation, either version 2 of the License, or (at your option) any
+# later version.
+
+# This program is distributed in the hope that it will be useful, but WITHOUT ANY
+# WARRANTY; without even the implied warranty of MERCHANTABILITY or FITNESS FOR A
+# PARTICULAR PURPOSE.  See the GNU General Public License for more details.
+
+# You should have received a copy of the GNU General Public License along with
+# this program.  If not, see <http://www.gnu.org/licenses/>.
+
+import datetime
+import gzip
+import io
+import os
+import os.path
+import tempfile
+import unittest
+from .. import columns
+from .. import fetchstate
+from .. import getdata
+from . import sftpserver
+from . import synthlog
+
+
+def make_lines(count, start):
+    """Return `count` lines of a synthetic log starting at `start`.
+
+    :param count: number of lines
+    :param start: datetime of the first line
+    :return: list of lines as bytes, with their newlines
+    """
+    f = io.BytesIO()
+    synthlog.generate_log(f, count * 200, start=start)
+    return io.BytesIO(f.getvalue()).readlines()[:count]
+
+
+class RemoteLogTest(unittest.TestCase):
+
+    def setUp(self):
+        self.directory = tempfile.TemporaryDirectory()
+        self.addCleanup(self.directory.cleanup)
+        root = os.path.join(self.directory.name, 'root')
+        self.log_path = root + getdata.AUTH_LOG
+        os.makedirs(os.path.dirname(self.log_path))
+        self.server = sftpserver.LocalSFTPServer(root)
+        self.addCleanup(self.server.close)
+        self.pool = self.server.pool()
+        self.addCleanup(self.pool.close)
+        self.sftp = self.pool.open_sftp('localhost')
+
+    def write_log(self, name, lines, mode='wb'):
+        """Write `lines` to the log `name` next to the live log."""
+        path = os.path.join(os.path.dirname(self.log_path), name)
+        opener = gzip.open if name.endswith('.gz') else open
+        with opener(path, mode) as f:
+            f.write(b''.join(lines))
+
+    def rotate(self, name):
+        """Move the live log to rotated log `name`, compressing it if named
+        ``.gz``."""
+        path = os.path.join(os.path.dirname(self.log_path), name)
+        if name.endswith('.gz'):
+            with open(self.log_path, 'rb') as f, gzip.open(path, 'wb') as g:
+                g.write(f.read())
+            os.unlink(self.log_path)
+        else:
+            os.rename(self.log_path, path)
+
+
+class FetchStateTest(RemoteLogTest):
+
+    def setUp(self):
+        super().setUp()
+        self.state = fetchstate.FetchState(
+            'localhost', cache_dir=os.path.join(self.directory.name, 'cache'))
+        start = datetime.datetime.now() - datetime.timedelta(days=1)
+        self.lines = make_lines(400, start)
+
+    def fetch(self):
+        """Return the data not fetched yet, saving the fetch state."""
+        data = b''.join(getdata.read_log_blocks(self.sftp, self.state,
+                                                progress=False))
+        self.state.save()
+        self.state = fetchstate.FetchState('localhost',
+                                           cache_dir=self.state.cache_dir)
+        self.state.load()
+        return data
+
+    def test_appended(self):
+        self.write_log('auth.log', self.lines[:100])
+        self.assertEqual(self.fetch(), b''.join(self.lines[:100]))
+        self.write_log('auth.log', self.lines[100:150], 'ab')
+        self.assertEqual(self.fetch(), b''.join(self.lines[100:150]))
+        self.assertEqual(self.fetch(), b'')
+
+    def test_partial_line(self):
+        self.write_log('auth.log', self.lines[:10] + [self.lines[10][:20]])
+        self.assertEqual(self.fetch(), b''.join(self.lines[:10]))
+        self.write_log('auth.log', [self.lines[10][20:]], 'ab')
+        self.assertEqual(self.fetch(), self.lines[10])
+
+    def test_rotated(self):
+        self.write_log('auth.log', self.lines[:100])
+        self.fetch()
+        self.write_log('auth.log', self.lines[100:150], 'ab')
+        self.rotate('auth.log.1')
+        self.write_log('auth.log', self.lines[150:200])
+        self.assertEqual(self.fetch(), b''.join(self.lines[100:200]))
+
+    def test_rotated_twice_compressed(self):
+        self.write_log('auth.log', self.lines[:100])
+        self.fetch()
+        self.write_log('auth.log', self.lines[100:150], 'ab')
+        self.rotate('auth.log.2.gz')
+        self.write_log('auth.log.1', self.lines[150:200])
+        self.write_log('auth.log', self.lines[200:250])
+        self.assertEqual(self.fetch(), b''.join(self.lines[100:250]))
+
+    def test_unknown_log(self):
+        self.write_log('auth.log', self.lines[:100])
+        self.fetch()
+        self.write_log('auth.log', self.lines[200:250])
+        self.assertEqual(self.fetch(), b''.join(self.lines[200:250]))
+
+
+class WindowTest(RemoteLogTest):
+
+    def setUp(self):
+        super().setUp()
+        # The logs span the turn of the last year, which the timestamps
+        # without year must not disorder
+        self.year = datetime.datetime.now().year
+        start = datetime.datetime(self.year - 1, 12, 31, 21)
+        lines = make_lines(6000, start)
+        self.write_log('auth.log.2.gz', lines[:2000])
+        self.write_log('auth.log.1', lines[2000:4000])
+        self.write_log('auth.log', lines[4000:])
+        self.attempts = list(getdata.parse_log(io.BytesIO(b''.join(lines))))
+        parse_line = getdata.LineParser()
+        self.starts = [columns.from_timestamp(parse_line.line_timestamp(
+            lines[i])) for i in (0, 2000, 4000)]
+
+    def fetch(self, since, until):
+        """Return the attempts read between `since` and `until`."""
+        return list(getdata.parse_log(io.BytesIO(b''.join(
+            getdata.read_log_blocks(self.sftp, since=since, until=until,
+                                    progress=False)))))
+
+    def expected(self, since, until):
+        """Return the attempts of the logs between `since` and `until`."""
+        return [attempt for attempt in self.attempts
+                if (since is None or attempt.datetime >= since) and
+                (until is None or attempt.datetime < until)]
+
+    def test_year_order(self):
+        times = [attempt.datetime for attempt in self.attempts]
+        self.assertEqual(times, sorted(times))
+        self.assertEqual(times[0].year, self.year - 1)
+        self.assertEqual(times[-1].year, self.year)
+
+    def test_bisected(self):
+        # Windows within the uncompressed logs are read exactly
+        new_year = datetime.datetime(self.year, 1, 1)
+        minute = datetime.timedelta(minutes=1)
+        for since, until in ((self.starts[2] + minute, None),
+                             (new_year - 10 * minute, new_year + 10 * minute),
+                             (self.starts[1] + minute,
+                              self.starts[2] + 20 * minute),
+                             (self.starts[2] + 5 * minute,
+                              self.starts[2] + 5 * minute)):
+            with self.subTest(since=since, until=until):
+                self.assertEqual(self.fetch(since, until),
+                                 self.expected(since, until))
+
+    def test_compressed(self):
+        # Windows within the compressed log are scanned for exactly
+        minute = datetime.timedelta(minutes=1)
+        for since, until in ((self.starts[0] + 10 * minute, None),
+                             (self.starts[0] + 10 * minute,
+                              self.starts[0] + 20 * minute),
+                             (self.starts[0] + 10 * minute,
+                              self.starts[2] + 20 * minute)):
+            with self.subTest(since=since, until=until):
+                self.assertEqual(self.fetch(since, until),
+                                 self.expected(since, until))
+
+    def test_resumed_at_until(self):
+        # A first fetch ending within the compressed log leaves the rest of
+        # it to the next fetch
+        state = fetchstate.FetchState(
+            'localhost', cache_dir=os.path.join(self.directory.name, 'cache'))
+        minute = datetime.timedelta(minutes=1)
+        since = self.starts[0] + 10 * minute
+        until = self.starts[0] + 20 * minute
+        data = b''.join(getdata.read_log_blocks(
+            self.sftp, state, since=since, until=until, progress=False))
+        data += b''.join(getdata.read_log_blocks(self.sftp, state,
+                                                 progress=False))
+        attempts = list(getdata.parse_log(io.BytesIO(data)))
+        self.assertEqual(attempts, self.expected(since, None))
+
+    def test_outside(self):
+        later = self.attempts[-1].datetime + datetime.timedelta(hours=1)
+        self.assertEqual(self.fetch(later, None), [])
+        earlier = self.starts[0] - datetime.timedelta(hours=1)
+        self.assertEqual(self.fetch(earlier, None), self.attempts)
+
+
+if __name__ == '__main__':
+    unittest.main()
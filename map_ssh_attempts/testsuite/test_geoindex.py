@@ -0,0 +1,119 @@
+# Copyright (C) 2014  Jim Turner
+
+# This file is part of map_ssh_attempts.
+
+# map_ssh_attempts is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by the Free
+# Software Foundation, either version 2 of the License, or (at your option) any
+# later version.
+
+# This program is distributed in the hope that it will be useful, but WITHOUT ANY
+# WARRANTY; without even the implied warranty of MERCHANTABILITY or FITNESS FOR A
+# PARTICULAR PURPOSE.  See the GNU General Public License for more details.
+
+# You should have received a copy of the GNU General Public License along with
+# this program.  If not, see <http://www.gnu.org/licenses/>.
+
+import contextlib
+import io
+import ipaddress
+import os.path
+import tempfile
+import unittest
+from .. import geoindex
+from .. import geoip
+from . import geoipdb
+
+
+def sample_addresses(version):
+    """Return addresses at and around the edges of the sample networks.
+
+    :param version: IP version
+    :return: list of IPv4Address or IPv6Address objects
+    """
+    bits = 32 if version == 4 else 128
+    addrs = set()
+    for network, record in geoipdb.SAMPLE_NETWORKS[version]:
+        network = ipaddress.ip_network(network)
+        first = int(network.network_address)
+        last = int(network.broadcast_address)
+        for value in (first - 1, first, first + 1, (first + last) // 2,
+                      last - 1, last, last + 1):
+            if 0 <= value < 1 << bits:
+                addrs.add(ipaddress.ip_address(value) if version == 4
+                          else ipaddress.IPv6Address(value))
+        if version == 6:
+            # The edges of the /64 networks around the network
+            for value in (first >> 64, last >> 64):
+                for prefix in (value - 1, value, value + 1):
+                    for low in (0, (1 << 64) - 1):
+                        addrs.add(ipaddress.IPv6Address((prefix << 64) | low))
+    return sorted(addrs)
+
+
+class GeoIPIndexTest(unittest.TestCase):
+
+    @classmethod
+    def setUpClass(cls):
+        cls.directory = tempfile.TemporaryDirectory()
+        geoipdb.write_sample_dbs(cls.directory.name)
+        cls.geoipmv = geoip.GeoIPMultiversion(cls.directory.name,
+                                              mode='memory')
+        cls.index = geoindex.GeoIPIndex(cls.directory.name)
+        with contextlib.redirect_stdout(io.StringIO()):
+            cls.geoipmv.load_dbs()
+            cls.index.build(cls.geoipmv)
+        cls.index.load()
+
+    @classmethod
+    def tearDownClass(cls):
+        cls.index.arrays = {}
+        cls.directory.cleanup()
+
+    def check_lookups(self, addrs, reference):
+        """Check the index lookups of `addrs` against the databases.
+
+        :param addrs: list of address objects
+        :param reference: function returning the address whose database
+            record an address must have in the index
+        """
+        result = self.index.lookup_addresses(addrs)
+        for i, addr in enumerate(addrs):
+            with self.subTest(addr=str(addr)):
+                record = self.geoipmv.record_by_addr(reference(addr))
+                self.assertEqual(bool(result.found[i]), bool(record))
+                if record:
+                    self.assertEqual(result.longitude[i], record['longitude'])
+                    self.assertEqual(result.latitude[i], record['latitude'])
+                    self.assertEqual(result.country_code[i].decode('ascii'),
+                                     record['country_code'])
+
+    def test_ipv4(self):
+        self.check_lookups(sample_addresses(4), lambda addr: addr)
+
+    def test_ipv6(self):
+        # Addresses are indexed by their /64 network, with the record of its
+        # lowest address
+        self.check_lookups(
+            sample_addresses(6),
+            lambda addr: ipaddress.IPv6Address(int(addr) >> 64 << 64))
+
+    def test_folded_network(self):
+        addr = ipaddress.IPv6Address('2001:db8:2:5:1::')
+        self.assertIsNone(self.geoipmv.record_by_addr(addr))
+        result = self.index.lookup_addresses([addr])
+        self.assertEqual(result.country_code[0], b'ES')
+
+    def test_country_name(self):
+        self.assertEqual(geoindex.country_name(b'FR'), 'France')
+        self.assertIsNone(geoindex.country_name(b''))
+
+    def test_unknown_layout(self):
+        path = os.path.join(self.directory.name,
+                            geoip.GeoIPMultiversion.db_names[4])
+        with self.assertRaises(geoip.GeoIPError):
+            geoindex.build_arrays(object(), path, 4)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,124 @@
+# Copyright (C) 2014  Jim Turner
+
+# This file is part of map_ssh_attempts.
+
+# map_ssh_attempts is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by the Free
+# Software Foundation, either version 2 of the License, or (at your option) any
+# later version.
+
+# This program is distributed in the hope that it will be useful, but WITHOUT ANY
+# WARRANTY; without even the implied warranty of MERCHANTABILITY or FITNESS FOR A
+# PARTICULAR PURPOSE.  See the GNU General Public License for more details.
+
+# You should have received a copy of the GNU General Public License along with
+# this program.  If not, see <http://www.gnu.org/licenses/>.
+
+import datetime
+import io
+import ipaddress
+import os
+import re
+import tempfile
+import unittest
+from .. import columns
+from .. import getdata
+from . import synthlog
+
+
+# Patterns of the attempt lines, as originally matched line by line
+REFERENCE_PATTERNS = (
+    r'(?P<datetime>.*) .* sshd\[\d+\]: User (?P<username>\S+) from '
+    r'(?P<ip_address>\S+) not allowed',
+    r'(?P<datetime>.*) .* sshd\[\d+\]: Invalid user (?P<username>\S+) from '
+    r'(?P<ip_address>\S+)')
+
+# Year the timestamps of the test logs are taken to be from
+YEAR = 2020
+
+# Lines on which the parsers could disagree
+EDGE_LINES = [
+    'Feb 29 12:00:00 server sshd[1]: Invalid user leap from 1.2.3.4',
+    'Mar  1 00:00:01 server sshd[22]: Invalid user a from 2001:db8::1 port 22',
+    'Mar 10 10:10:10 server sshd[333]: User root from 10.0.0.1 not allowed '
+    'because not listed in AllowUsers',
+    'Mar 10 10:10:11 server sshd[4444]: Invalid user élève from '
+    '192.0.2.7 port 50000',
+    'Mar 10 10:10:12 server sshd[1]: Failed password for invalid user x from '
+    '192.0.2.8 port 22 ssh2',
+    'Mar 10 10:10:13 server sudo: Invalid user y from 192.0.2.9',
+    'Mar 10 10:10:14 server CRON[5]: pam_unix(cron:session): session opened',
+    'Dec 31 23:59:59 server sshd[9]: Invalid user last from ::ffff:1.2.3.4',
+]
+
+
+def reference_parse(data, year):
+    """Parse the attempts of log `data` as originally done.
+
+    :param data: contents of the log, as bytes
+    :param year: year of the timestamps
+    :return: list of Attempt tuples
+    """
+    attempts = []
+    for line in io.BytesIO(data):
+        line = line.decode('UTF-8')
+        for pattern in REFERENCE_PATTERNS:
+            match = re.match(pattern, line)
+            if match is not None:
+                parsed = datetime.datetime.strptime(
+                    '{} {}'.format(year, ' '.join(
+                        match.group('datetime').split())),
+                    '%Y %b %d %H:%M:%S')
+                attempts.append(columns.Attempt(
+                    parsed, match.group('username'),
+                    ipaddress.ip_address(match.group('ip_address'))))
+                break
+    return attempts
+
+
+class ParseTest(unittest.TestCase):
+
+    @classmethod
+    def setUpClass(cls):
+        f = io.BytesIO()
+        synthlog.generate_log(f, 1 << 20, start=datetime.datetime(YEAR, 1, 1))
+        cls.data = (f.getvalue() +
+                    '\n'.join(EDGE_LINES).encode('UTF-8') + b'\n')
+        cls.expected = reference_parse(cls.data, YEAR)
+
+    def test_reference_finds_attempts(self):
+        self.assertGreater(len(self.expected), 1000)
+
+    def test_parse_log(self):
+        attempts = list(getdata.parse_log(io.BytesIO(self.data), year=YEAR))
+        self.assertEqual(attempts, self.expected)
+
+    def test_parse_log_batches(self):
+        batches = list(getdata.parse_log_batches(io.BytesIO(self.data),
+                                                 year=YEAR, size=1000))
+        self.assertGreater(len(batches), 1)
+        attempts = [attempt for batch in batches for attempt in batch]
+        self.assertEqual(attempts, self.expected)
+
+    def test_parse_log_file_batches(self):
+        with tempfile.TemporaryDirectory() as directory:
+            path = os.path.join(directory, 'auth.log')
+            with open(path, 'wb') as f:
+                f.write(self.data)
+            for processes in (1, 2):
+                with self.subTest(processes=processes):
+                    attempts = [attempt for batch
+                                in getdata.parse_log_file_batches(
+                                    path, processes=processes, year=YEAR)
+                                for attempt in batch]
+                    self.assertEqual(attempts, self.expected)
+
+    def test_line_parser(self):
+        parse_line = getdata.LineParser(YEAR)
+        attempts = [parse_line(line) for line in io.BytesIO(self.data)]
+        self.assertEqual([attempt for attempt in attempts
+                          if attempt is not None], self.expected)
+
+
+if __name__ == '__main__':
+    unittest.main()
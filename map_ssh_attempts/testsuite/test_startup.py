@@ -0,0 +1,79 @@
+# Copyright (C) 2014  Jim Turner
+
+# This file is part of map_ssh_attempts.
+
+# map_ssh_attempts is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by the Free
+# Software Foundation, either version 2 of the License, or (at your option) any
+# later version.
+
+# This program is distributed in the hope that it will be useful, but WITHOUT ANY
+# WARRANTY; without even the implied warranty of MERCHANTABILITY or FITNESS FOR A
+# PARTICULAR PURPOSE.  See the GNU General Public License for more details.
+
+# You should have received a copy of the GNU General Public License along with
+# this program.  If not, see <http://www.gnu.org/licenses/>.
+
+import os.path
+import subprocess
+import sys
+import unittest
+
+
+# Packages that take long to import and must only be imported by the
+# subcommands using them
+HEAVY_PACKAGES = ('matplotlib', 'mpl_toolkits', 'numpy', 'paramiko', 'pygeoip')
+
+# Standard library modules that take long to import, with the same rule
+HEAVY_MODULES = ('http.client', 'urllib.request')
+
+# Command lines that must start without the heavy packages
+LIGHT_COMMANDS = (['--help'],
+                  ['update', '--help'],
+                  ['fetch', '--help'],
+                  ['map', '--help'],
+                  ['bar', '--help'])
+
+# Directory containing the package, so that it is imported from this tree
+SOURCE_DIR = os.path.dirname(os.path.dirname(os.path.dirname(
+    os.path.abspath(__file__))))
+
+
+def import_times(argv):
+    """Run the command line interface with `argv` and time its imports.
+
+    :param argv: list of command line arguments
+    :return: dict mapping names of imported modules to their cumulative
+        import time in seconds
+    """
+    code = ("import sys; sys.argv = {!r}; import map_ssh_attempts; "
+            "map_ssh_attempts.main()".format(['map_ssh_attempts'] + argv))
+    result = subprocess.run([sys.executable, '-X', 'importtime', '-c', code],
+                            cwd=SOURCE_DIR, stdout=subprocess.DEVNULL,
+                            stderr=subprocess.PIPE, universal_newlines=True)
+    times = {}
+    for line in result.stderr.splitlines():
+        if not line.startswith('import time:'):
+            continue
+        self_time, cumulative, name = line[len('import time:'):].split('|')
+        try:
+            times[name.strip()] = int(cumulative) / 1e6
+        except ValueError:
+            # Header line
+            continue
+    return times
+
+
+class StartupTest(unittest.TestCase):
+
+    def test_no_heavy_imports(self):
+        for argv in LIGHT_COMMANDS:
+            with self.subTest(argv=argv):
+                heavy = sorted(name for name in import_times(argv)
+                               if name.split('.')[0] in HEAVY_PACKAGES or
+                               name in HEAVY_MODULES)
+                self.assertEqual(heavy, [])
+
+
+if __name__ == '__main__':
+    unittest.main()
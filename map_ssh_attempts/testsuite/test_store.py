@@ -0,0 +1,117 @@
+# Copyright (C) 2014  Jim Turner
+
+# This file is part of map_ssh_attempts.
+
+# map_ssh_attempts is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by the Free
+# Software Foundation, either version 2 of the License, or (at your option) any
+# later version.
+
+# This program is distributed in the hope that it will be useful, but WITHOUT ANY
+# WARRANTY; without even the implied warranty of MERCHANTABILITY or FITNESS FOR A
+# PARTICULAR PURPOSE.  See the GNU General Public License for more details.
+
+# You should have received a copy of the GNU General Public License along with
+# this program.  If not, see <http://www.gnu.org/licenses/>.
+
+import datetime
+import tempfile
+import unittest
+from .. import columns
+from .. import fetchstate
+from .. import store
+from .test_columns import make_attempts
+
+
+class FailingState(fetchstate.FetchState):
+
+    def to_dict(self):
+        raise RuntimeError("interrupted")
+
+
+class AttemptStoreTest(unittest.TestCase):
+
+    def setUp(self):
+        self.directory = tempfile.TemporaryDirectory()
+        self.addCleanup(self.directory.cleanup)
+        self.store = store.AttemptStore(self.directory.name)
+        self.addCleanup(self.store.close)
+        self.attempts = make_attempts(['a', 'b'])
+        for hostname in ('a', 'b'):
+            batch = columns.AttemptBatch.from_attempts(
+                [columns.Attempt(*attempt[1:]) for attempt in self.attempts
+                 if attempt.hostname == hostname])
+            added = self.store.add(hostname, batch)
+            self.assertEqual(added, len(self.attempts) // 2)
+
+    def query(self, **kwargs):
+        """Return the stored attempts matching the filters as tuples."""
+        return [attempt for batch in self.store.query_batches(size=7, **kwargs)
+                for attempt in batch]
+
+    def test_round_trip(self):
+        self.assertEqual(self.query(), self.attempts)
+        self.assertEqual(self.store.hostnames(), ['a', 'b'])
+
+    def test_tuples(self):
+        self.store.add('c', [columns.Attempt(*attempt[1:])
+                             for attempt in self.attempts[:3]])
+        self.assertEqual(self.query(hostnames=['c']),
+                         [columns.HostAttempt('c', *attempt[1:])
+                          for attempt in self.attempts[:3]])
+
+    def test_filters(self):
+        since = self.attempts[10].datetime
+        until = self.attempts[30].datetime
+        for kwargs in ({'hostnames': ['b']},
+                       {'hostnames': []},
+                       {'since': since},
+                       {'until': until},
+                       {'since': since, 'until': until},
+                       {'usernames': ['élève', 'root']},
+                       {'hostnames': ['a'], 'since': since, 'until': until,
+                        'usernames': ['root']}):
+            with self.subTest(**kwargs):
+                hostnames = kwargs.get('hostnames')
+                first = kwargs.get('since', datetime.datetime.min)
+                after = kwargs.get('until', datetime.datetime.max)
+                usernames = kwargs.get('usernames')
+                expected = [
+                    attempt for attempt in self.attempts
+                    if (hostnames is None or attempt.hostname in hostnames) and
+                    first <= attempt.datetime < after and
+                    (usernames is None or attempt.username in usernames)]
+                self.assertEqual(self.query(**kwargs), expected)
+
+    def test_fetch_state(self):
+        state = self.store.load_fetch_state('c')
+        self.assertFalse(state.check_fetched())
+        state.offset = 1234
+        state.size = 2000
+        state.mtime = 1600000000
+        state.head_hash = 'head'
+        state.tail_hash = 'tail'
+        self.store.add('c', self.attempts[:3], state=state)
+        self.store.close()
+        with store.AttemptStore(self.directory.name) as reopened:
+            saved = reopened.load_fetch_state('c')
+        self.assertEqual(saved.to_dict(), state.to_dict())
+
+    def test_fetch_state_atomic(self):
+        # Attempts are not stored unless their fetch state is
+        state = FailingState('c', cache_dir=self.directory.name)
+        with self.assertRaises(RuntimeError):
+            self.store.add('c', self.attempts[:3], state=state)
+        self.assertEqual(self.query(hostnames=['c']), [])
+
+    def test_legacy_fetch_state(self):
+        state = fetchstate.FetchState('c', cache_dir=self.directory.name)
+        state.offset = 10
+        state.head_hash = state.tail_hash = 'hash'
+        state.save()
+        loaded = self.store.load_fetch_state('c')
+        self.assertEqual(loaded.to_dict(), state.to_dict())
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,142 @@
+# Copyright (C) 2014  Jim Turner
+
+# This file is part of map_ssh_attempts.
+
+# map_ssh_attempts is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by the Free
+# Software Foundation, either version 2 of the License, or (at your option) any
+# later version.
+
+# This program is distributed in the hope that it will be useful, but WITHOUT ANY
+# WARRANTY; without even the implied warranty of MERCHANTABILITY or FITNESS FOR A
+# PARTICULAR PURPOSE.  See the GNU General Public License for more details.
+
+# You should have received a copy of the GNU General Public License along with
+# this program.  If not, see <http://www.gnu.org/licenses/>.
+
+import contextlib
+import io
+import ipaddress
+import os
+import os.path
+import tempfile
+import unittest
+from .. import tor
+
+
+# Exit node entries, with overlapping and adjacent ranges to merge
+ENTRIES = ['192.0.2.1', '192.0.2.0/30', '192.0.2.4/30', '198.51.100.200',
+           '10.0.0.0/8', '10.1.0.0/16', '255.255.255.255',
+           '::', '2001:db8::', '2001:db8::2', '2001:db8:1::/48',
+           '2001:db8:1:1::/64', 'ffff:ffff:ffff:ffff:ffff:ffff:ffff:ffff']
+
+
+def is_listed(addr, entries):
+    """Return if `addr` is in one of the networks of `entries`."""
+    return any(addr in ipaddress.ip_network(entry, strict=False)
+               for entry in entries)
+
+
+def edge_addresses(entries):
+    """Return the addresses at and around the edges of the networks of
+    `entries`."""
+    addrs = set()
+    for entry in entries:
+        network = ipaddress.ip_network(entry, strict=False)
+        bits = network.max_prefixlen
+        for value in (int(network.network_address) - 1,
+                      int(network.network_address),
+                      int(network.broadcast_address),
+                      int(network.broadcast_address) + 1):
+            if 0 <= value < 1 << bits:
+                addrs.add(ipaddress.IPv4Address(value) if bits == 32
+                          else ipaddress.IPv6Address(value))
+    return sorted(addrs, key=lambda addr: (addr.version, addr))
+
+
+class BuildIndexTest(unittest.TestCase):
+
+    def setUp(self):
+        self.db = tor.TorExitNodeDatabase()
+        self.db.db = tor.build_index(ENTRIES)
+
+    def test_merged(self):
+        starts, ends = self.db.db[4]
+        self.assertEqual(len(starts), 4)
+        self.assertEqual([str(ipaddress.IPv4Address(int(end)))
+                          for end in ends],
+                         ['10.255.255.255', '192.0.2.7', '198.51.100.200',
+                          '255.255.255.255'])
+
+    def test_edges(self):
+        addrs = edge_addresses(ENTRIES)
+        result = self.db.are_tor_exit_nodes(addrs)
+        for addr, member in zip(addrs, result.tolist()):
+            with self.subTest(addr=str(addr)):
+                self.assertEqual(member, is_listed(addr, ENTRIES))
+                self.assertEqual(self.db.is_tor_exit_node(addr), member)
+
+    def test_trailing_zero_bytes(self):
+        # Packed addresses ending in zero bytes must not compare equal to
+        # shorter ones
+        self.db.db = tor.build_index(['2001:db8::1'])
+        for addr, member in (('2001:db8::', False), ('2001:db8::1', True),
+                             ('2001:db8::100', False), ('::', False)):
+            with self.subTest(addr=addr):
+                self.assertEqual(self.db.is_tor_exit_node(
+                    ipaddress.ip_address(addr)), member)
+
+    def test_empty(self):
+        self.db.db = tor.build_index([])
+        addrs = [ipaddress.ip_address('192.0.2.1'), ipaddress.ip_address('::')]
+        self.assertEqual(self.db.are_tor_exit_nodes(addrs).tolist(),
+                         [False, False])
+
+
+class LoadTest(unittest.TestCase):
+
+    def setUp(self):
+        self.directory = tempfile.TemporaryDirectory()
+        self.addCleanup(self.directory.cleanup)
+        self.csv_path = os.path.join(self.directory.name,
+                                     tor.TorExitNodeDatabase.db_name)
+
+    def write_csv(self, entries, mtime):
+        """Write the database file listing `entries`, modified at `mtime`."""
+        with open(self.csv_path, 'w') as f:
+            f.write('\n'.join(entries) + '\n')
+        os.utime(self.csv_path, (mtime, mtime))
+
+    def load(self):
+        """Return a database loaded from the cache directory."""
+        db = tor.TorExitNodeDatabase(self.directory.name)
+        with contextlib.redirect_stdout(io.StringIO()):
+            db.load_dbs()
+        return db
+
+    def check(self, db, entries):
+        """Check that `db` lists the addresses of `entries`."""
+        addrs = edge_addresses(ENTRIES)
+        self.assertEqual(db.are_tor_exit_nodes(addrs).tolist(),
+                         [is_listed(addr, entries) for addr in addrs])
+
+    def test_saved_index(self):
+        self.write_csv(ENTRIES, 1000000000)
+        self.check(self.load(), ENTRIES)
+        self.assertTrue(os.path.isfile(self.load().index_path()))
+        self.check(self.load(), ENTRIES)
+
+    def test_rebuilt_when_newer(self):
+        self.write_csv(ENTRIES, 1000000000)
+        index_path = self.load().index_path()
+        os.utime(index_path, (1000000010, 1000000010))
+        # An older database file is not read again
+        self.write_csv(ENTRIES[:3], 1000000005)
+        self.check(self.load(), ENTRIES)
+        # A newer one replaces the index
+        self.write_csv(ENTRIES[:3], 1000000020)
+        self.check(self.load(), ENTRIES[:3])
+
+
+if __name__ == '__main__':
+    unittest.main()
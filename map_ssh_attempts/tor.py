@@ -15,14 +15,17 @@
 # this program.  If not, see <http://www.gnu.org/licenses/>.
 
 import ipaddress
+import numpy as np
 import os.path
-import urllib.request
+from . import download
+from . import stats
 
 
 class TorExitNodeDatabase(object):
 
     db_name = 'Tor_ip_list_EXIT.csv'
     db_source = 'http://torstatus.blutmagie.de/ip_list_exit.php/Tor_ip_list_EXIT.csv'
+    index_name = 'Tor_ip_list_EXIT.npz'
 
     def __init__(self, cache_dir='~/.cache/map_ssh_attempts'):
         """Create an object to lookup Tor exit nodes.
@@ -32,19 +35,19 @@ class TorExitNodeDatabase(object):
         self.cache_dir = os.path.expanduser(cache_dir)
         self.db = None
 
+    def cache_sources(self):
+        """Return the list of download Sources of the Tor database."""
+        return [download.Source(TorExitNodeDatabase.db_source,
+                                os.path.join(self.cache_dir,
+                                             TorExitNodeDatabase.db_name),
+                                False)]
+
     def update_cache(self):
-        """Update Tor exit node cache."""
-        if not os.path.isdir(self.cache_dir):
-            if os.path.lexists(self.cache_dir):
-                raise NotADirectoryError('Download location exists but is not a directory.')
-            else:
-                os.makedirs(self.cache_dir)
-        name = TorExitNodeDatabase.db_name
-        url = TorExitNodeDatabase.db_source
-        with open(os.path.join(self.cache_dir, name), 'wb') as f:
-            print("Updating {}... ".format(name), end='')
-            f.write(urllib.request.urlopen(url).read())
-            print("100%")
+        """Update Tor exit node cache.
+
+        :return: if the database was updated
+        """
+        return bool(download.download_all(self.cache_sources()))
 
     def check_cache(self):
         """Check if Tor database file exists in cache."""
@@ -55,14 +58,33 @@ class TorExitNodeDatabase(object):
         """Check if Tor database has been loaded."""
         return self.db is not None
 
+    def index_path(self):
+        """Return the path of the binary index built from the database file."""
+        return os.path.join(self.cache_dir, TorExitNodeDatabase.index_name)
+
     def load_dbs(self):
-        """Load Tor info from database file."""
+        """Load Tor info, rebuilding the binary index if it is out of date."""
         if not self.check_cache():
             self.update_cache()
         name = TorExitNodeDatabase.db_name
+        path = os.path.join(self.cache_dir, name)
         print("Loading {}... ".format(name), end='')
-        with open(os.path.join(self.cache_dir, name), 'r') as f:
-            self.db = {ipaddress.ip_address(address) for address in f.read().split()}
+        with stats.stage('load_tor'):
+            index_path = self.index_path()
+            if (not os.path.isfile(index_path) or
+                    os.path.getmtime(index_path) < os.path.getmtime(path)):
+                with open(path, 'r') as f:
+                    self.db = build_index(f.read().split())
+                with download.atomic_write(index_path) as f:
+                    np.savez(f, **{'v{}_{}'.format(version, bound): array
+                                   for version, arrays in self.db.items()
+                                   for bound, array in zip(('starts', 'ends'),
+                                                           arrays)})
+            else:
+                with np.load(index_path) as saved:
+                    self.db = {version: (saved['v{}_starts'.format(version)],
+                                         saved['v{}_ends'.format(version)])
+                               for version in ADDRESS_DTYPES}
         print("100%")
 
     def is_tor_exit_node(self, addr):
@@ -71,6 +93,78 @@ class TorExitNodeDatabase(object):
         :param addr: IPv4Address or IPv6Address object with address of host
         :return: if the address for a Tor exit node
         """
+        return bool(self.lookup(addr.version, address_array([addr], addr.version))[0])
+
+    def are_tor_exit_nodes(self, addrs):
+        """Given a sequence of addresses, return which are Tor exit nodes.
+
+        :param addrs: sequence of IPv4Address or IPv6Address objects
+        :return: boolean array parallel to `addrs`
+        """
+        result = np.zeros(len(addrs), dtype=bool)
+        for version in ADDRESS_DTYPES:
+            positions = np.array([i for i, addr in enumerate(addrs)
+                                  if addr.version == version], dtype=np.intp)
+            if len(positions):
+                result[positions] = self.lookup(
+                    version, address_array([addrs[i] for i in positions], version))
+        return result
+
+    def lookup(self, version, values):
+        """Test an array of addresses for membership in the exit node ranges.
+
+        :param version: IP version of the addresses
+        :param values: array of addresses as returned by `address_array`
+        :return: boolean array parallel to `values`
+        """
         if not self.check_loaded():
             self.load_dbs()
-        return addr in self.db
+        starts, ends = self.db[version]
+        values = np.asarray(values, dtype=ADDRESS_DTYPES[version])
+        ranges = np.searchsorted(starts, values, side='right') - 1
+        member = ranges >= 0
+        if not len(ends):
+            return member
+        member &= values <= ends[np.maximum(ranges, 0)]
+        return member
+
+
+# Array types of addresses in the index.  IPv6 addresses are stored as packed
+# big-endian bytes, which sort in the same order as the addresses.
+ADDRESS_DTYPES = {4: np.uint64, 6: 'S16'}
+
+
+def address_array(addrs, version):
+    """Convert address objects of IP `version` to an array for `lookup`.
+
+    :param addrs: iterable of IPv4Address or IPv6Address objects
+    :param version: IP version of the addresses
+    :return: array of ADDRESS_DTYPES[version]
+    """
+    if version == 4:
+        return np.fromiter((int(addr) for addr in addrs), dtype=np.uint64)
+    return np.array([addr.packed for addr in addrs], dtype='S16')
+
+
+def build_index(entries):
+    """Build sorted, non-overlapping address ranges from exit node entries.
+
+    :param entries: iterable of addresses or CIDR networks as strings
+    :return: dict mapping each IP version to a tuple of (starts, ends) arrays
+    """
+    ranges = {version: [] for version in ADDRESS_DTYPES}
+    for entry in entries:
+        network = ipaddress.ip_network(entry, strict=False)
+        ranges[network.version].append(
+            (network.network_address, network.broadcast_address))
+    index = {}
+    for version, version_ranges in ranges.items():
+        merged = []
+        for start, end in sorted(version_ranges):
+            if merged and int(start) <= int(merged[-1][1]) + 1:
+                merged[-1] = (merged[-1][0], max(merged[-1][1], end))
+            else:
+                merged.append((start, end))
+        index[version] = (address_array([start for start, end in merged], version),
+                          address_array([end for start, end in merged], version))
+    return index
@@ -14,55 +14,420 @@
 # You should have received a copy of the GNU General Public License along with
 # this program.  If not, see <http://www.gnu.org/licenses/>.
 
-import mpl_toolkits.basemap
+import collections
+import copy
+import hashlib
+import json
 import numpy as np
-from . import geoip
-from . import tor
+import os
+import os.path
+import pickle
+from . import download
+from . import enrich
+from . import options
+from . import stats
 
+# Matplotlib and Basemap are imported by the functions using them: importing
+# them takes about a second.
 
-def plot_attempt_locations(basemap, attempts, *, highlight_tor=False):
+
+LocationCounts = collections.namedtuple(
+    'LocationCounts', ('longitude', 'latitude', 'count', 'is_tor'))
+
+# Colors and graticule spacing (in degrees) of the map background
+MAP_STYLE = {'land_color': 'lightgreen',
+             'water_color': 'lightblue',
+             'parallels': 30,
+             'meridians': 60}
+
+# Width in inches at which line widths of the cached background image are
+# drawn, and its width in pixels
+BACKGROUND_INCHES = 6.4
+BACKGROUND_WIDTH = 2400
+
+
+def plot_attempt_locations(basemap, attempts, *, highlight_tor=False,
+                           enricher=None, mode='points', bins=100):
     """Plot the attempt locations on `basemap`.
 
+    Attempts are reduced to their distinct locations before anything is
+    drawn, so the cost of rendering depends on the number of locations (or
+    bins), not on the number of attempts.  `mode` is one of:
+
+    * ``'points'``: a dot at every location
+    * ``'aggregate'``: a marker at every location, sized and colored by the
+      number of attempts
+    * ``'hexbin'``: hexagonal bins colored by the number of attempts
+    * ``'density'``: a 2-D histogram of the number of attempts
+
     :param basemap: Basemap object
     :param attempts: list of Attempt objects
     :param highlight_tor: highlight Tor exit nodes in a different color
+    :param enricher: Enricher object (with Tor lookups) to look addresses up
+    :param mode: how to render the locations; one of `options.RENDER_MODES`
+    :param bins: number of bins across the map for ``'hexbin'`` and
+        ``'density'``
+    :return: the artist colored by attempt count, if any
     """
-    normal_lons = []
-    normal_lats = []
-    tor_lons = []
-    tor_lats = []
-    geoipmv = geoip.GeoIPMultiversion()
-    tordb = tor.TorExitNodeDatabase()
-    for attempt in attempts:
-        try:
-            coord = geoipmv.coord_by_addr(attempt.ip_address)
-        except geoip.GeoIPError:
-            print("Warning: unable to find coordinates for {}".format(
-                attempt.ip_address))
-            continue
-        if tordb.is_tor_exit_node(attempt.ip_address):
-            tor_lons.append(coord.longitude)
-            tor_lats.append(coord.latitude)
+    if enricher is None:
+        enricher = enrich.Enricher(tor_lookup=True)
+    layer = LocationLayer(basemap, enricher, highlight_tor=highlight_tor,
+                          mode=mode, bins=bins)
+    layer.add(attempts)
+    return layer.mappable
+
+
+class LocationLayer(object):
+
+    def __init__(self, basemap, enricher, *, highlight_tor=False,
+                 mode='points', bins=100):
+        """Create a layer of attempt locations on `basemap`.
+
+        Attempts are added with `add`, which updates the artists of the layer
+        in place (except hexbins, which are redrawn), so that the map can be
+        kept up to date without redrawing its background.  Each call looks up
+        only the added attempts.  See `plot_attempt_locations` for the
+        parameters.
+        """
+        if mode not in options.RENDER_MODES:
+            raise ValueError("Unknown `mode` value: {}".format(mode))
+        self.basemap = basemap
+        self.enricher = enricher
+        self.highlight_tor = highlight_tor
+        self.mode = mode
+        self.bins = bins
+        # Distinct locations so far, as positions in parallel arrays
+        self.positions = {}
+        self.x = np.zeros(0)
+        self.y = np.zeros(0)
+        self.count = np.zeros(0, dtype=np.int64)
+        self.is_tor = np.zeros(0, dtype=bool)
+        self.artists = {}
+        self.mappable = None
+        self.colorbar = None
+        if mode == 'density':
+            ny = max(1, int(round(bins * (basemap.ymax - basemap.ymin) /
+                                  (basemap.xmax - basemap.xmin))))
+            self.xedges = np.linspace(basemap.xmin, basemap.xmax, bins + 1)
+            self.yedges = np.linspace(basemap.ymin, basemap.ymax, ny + 1)
+            self.density = np.zeros((bins, ny))
+
+    def add(self, attempts):
+        """Add the locations of `attempts` to the layer and update it.
+
+        :param attempts: iterable of Attempt objects, or AttemptBatch object
+        """
+        locations = count_locations(attempts, self.enricher,
+                                    separate_tor=self.highlight_tor)
+        x, y = self.basemap(locations.longitude, locations.latitude)
+        x = np.asarray(x)
+        y = np.asarray(y)
+        new = []
+        for i, key in enumerate(zip(locations.longitude.tolist(),
+                                    locations.latitude.tolist(),
+                                    locations.is_tor.tolist())):
+            position = self.positions.get(key)
+            if position is None:
+                self.positions[key] = len(self.positions)
+                new.append(i)
+            else:
+                self.count[position] += locations.count[i]
+        new = np.array(new, dtype=np.intp)
+        self.x = np.concatenate((self.x, x[new]))
+        self.y = np.concatenate((self.y, y[new]))
+        self.count = np.concatenate((self.count, locations.count[new]))
+        self.is_tor = np.concatenate((self.is_tor, locations.is_tor[new]))
+        self.draw(x, y, locations.count)
+
+    def draw(self, x, y, count):
+        """Update the artists after attempts at (`x`, `y`) were added.
+
+        :param x: array of the projected x coordinates of the added locations
+        :param y: array of the projected y coordinates of the added locations
+        :param count: array of the number of attempts added at each location
+        """
+        import matplotlib.colors
+        x_all, y_all, tor = self.x, self.y, self.is_tor
+        if self.mode == 'points':
+            self._set_points('points', x_all[~tor], y_all[~tor], 'ro')
+            self._set_points('tor', x_all[tor], y_all[tor], 'bo')
+            return
+        elif not len(self.count):
+            return
+        elif self.mode == 'aggregate':
+            # Marker area grows with the logarithm of the number of attempts
+            sizes = 10 + 20 * np.log10(self.count)
+            if 'tor' not in self.artists:
+                self.artists['tor'] = self.basemap.scatter(
+                    x_all[tor], y_all[tor], s=sizes[tor], c='blue',
+                    edgecolors='darkblue', linewidths=0.5, zorder=4)
+            else:
+                self.artists['tor'].set_offsets(np.column_stack((x_all[tor],
+                                                                 y_all[tor])))
+                self.artists['tor'].set_sizes(sizes[tor])
+            if tor.all():
+                # The color scale cannot be set up without other locations
+                return
+            if self.mappable is None:
+                self.mappable = self.basemap.scatter(
+                    x_all[~tor], y_all[~tor], s=sizes[~tor],
+                    c=self.count[~tor], cmap='autumn_r', norm=matplotlib.colors.LogNorm(),
+                    edgecolors='darkred', linewidths=0.5, zorder=3)
+            else:
+                self.mappable.set_offsets(np.column_stack((x_all[~tor],
+                                                           y_all[~tor])))
+                self.mappable.set_sizes(sizes[~tor])
+                self.mappable.set_array(self.count[~tor])
+                self.mappable.autoscale()
+        elif self.mode == 'hexbin':
+            if self.mappable is not None:
+                self.mappable.remove()
+            self.mappable = self.basemap.hexbin(
+                x_all, y_all, C=self.count, reduce_C_function=np.sum,
+                gridsize=self.bins, bins='log', mincnt=1, cmap='autumn_r', alpha=0.8, zorder=3)
         else:
-            normal_lons.append(coord.longitude)
-            normal_lats.append(coord.latitude)
-    normal_x, normal_y = basemap(normal_lons, normal_lats)
-    tor_x, tor_y = basemap(tor_lons, tor_lats)
-    basemap.plot(normal_x, normal_y, 'ro')
-    tor_color = 'bo' if highlight_tor else 'ro'
-    basemap.plot(tor_x, tor_y, tor_color)
+            # Only the added attempts are binned
+            self.density += np.histogram2d(
+                x, y, bins=(self.xedges, self.yedges), weights=count)[0]
+            density = np.ma.masked_equal(self.density, 0).T
+            if self.mappable is None:
+                self.mappable = self.basemap.pcolormesh(
+                    *np.meshgrid(self.xedges, self.yedges), density,
+                    cmap='autumn_r', norm=matplotlib.colors.LogNorm(), alpha=0.8, zorder=3)
+            else:
+                self.mappable.set_array(density)
+                self.mappable.autoscale()
+        if self.mode in ('hexbin', 'density') and self.highlight_tor:
+            self._set_points('tor', x_all[tor], y_all[tor], 'bo', zorder=4)
+        if self.colorbar is None:
+            self.colorbar = self.basemap.colorbar(self.mappable,
+                                                  label='Number of attempts')
+        else:
+            self.colorbar.update_normal(self.mappable)
+
+    def _set_points(self, name, x, y, fmt, **kwargs):
+        if name in self.artists:
+            self.artists[name].set_data(x, y)
+        else:
+            self.artists[name], = self.basemap.plot(x, y, fmt, **kwargs)
+
+
+def count_locations(attempts, enricher, *, separate_tor=True):
+    """Count the attempts at each distinct location.
+
+    :param attempts: iterable of Attempt objects, or AttemptBatch object
+    :param enricher: Enricher object (with Tor lookups) to look addresses up
+    :param separate_tor: count attempts from Tor exit nodes separately from
+        other attempts at the same location
+    :return: LocationCounts of parallel arrays
+    """
+    lons = []
+    lats = []
+    counts = []
+    tor = []
+    unlocated = 0
+    for addr, location, count in enricher.locate_counts(attempts):
+        coord = location.coordinate
+        if coord is None:
+            unlocated += 1
+            continue
+        lons.append(coord.longitude)
+        lats.append(coord.latitude)
+        counts.append(count)
+        tor.append(bool(location.is_tor) and separate_tor)
+    if unlocated:
+        print("Warning: unable to find coordinates for {} addresses".format(
+            unlocated))
+    keys = np.array([lons, lats, tor], dtype=float).reshape(3, -1).T
+    keys, inverse = np.unique(keys, axis=0, return_inverse=True)
+    counts = np.bincount(inverse.ravel(), weights=counts,
+                         minlength=len(keys)).astype(np.int64)
+    return LocationCounts(keys[:, 0], keys[:, 1], counts,
+                          keys[:, 2].astype(bool))
 
 
-def setup_map():
+def setup_map(*, projection='kav7', lon_0=0, resolution='l', style=None,
+              cache_dir='~/.cache/map_ssh_attempts', use_cache=True):
     """Setup the projections and background image for the map and return it.
 
+    Building the projection and drawing the coastlines and borders takes
+    seconds, so both are cached in `cache_dir` the first time and later only
+    loaded: the background is then shown as an image under the attempts.
+
+    :param projection: Basemap projection name
+    :param lon_0: central longitude of the projection
+    :param resolution: resolution of the coastline and border data
+    :param style: dict overriding entries of `MAP_STYLE`
+    :param cache_dir: directory in which to cache the map
+    :param use_cache: use (and fill) the cache; otherwise draw the map from
+        scratch, as vector graphics
+    :return: Basemap object
+    """
+    params = map_params(projection=projection, lon_0=lon_0,
+                        resolution=resolution, style=style)
+    if not use_cache:
+        basemap = make_basemap(params)
+        draw_background(basemap, params)
+        return basemap
+    return show_map(*load_map(params, cache_dir=cache_dir))
+
+
+def map_params(*, projection='kav7', lon_0=0, resolution='l', style=None):
+    """Return the dict of map parameters used by the functions below.
+
+    :param projection: Basemap projection name
+    :param lon_0: central longitude of the projection
+    :param resolution: resolution of the coastline and border data
+    :param style: dict overriding entries of `MAP_STYLE`
+    :return: dict of the projection parameters and style of the map
+    """
+    params = {'projection': projection, 'lon_0': lon_0,
+              'resolution': resolution}
+    params.update(MAP_STYLE)
+    if style is not None:
+        params.update(style)
+    return params
+
+
+def load_map(params, *, cache_dir='~/.cache/map_ssh_attempts'):
+    """Load the map with parameters `params` from cache, caching it first if
+    necessary.
+
+    The result can be shown on any number of figures with `show_map`.
+
+    :param params: dict of the projection parameters and style of the map
+    :param cache_dir: directory in which to cache the map
+    :return: (Basemap object, RGBA image array of the background)
+    """
+    cache = MapCache(cache_dir)
+    with stats.stage('load_map'):
+        if not cache.check_cache(params):
+            cache.build(params)
+        return cache.load(params)
+
+
+def show_map(basemap, background):
+    """Show a map loaded by `load_map` on the current axes.
+
+    :param basemap: Basemap object
+    :param background: RGBA image array of the background
+    :return: copy of `basemap` for drawing on the current axes
+    """
+    # Drawing attaches artists of the axes to the Basemap, so each axes gets
+    # its own copy.
+    basemap = copy.copy(basemap)
+    basemap.imshow(background, origin='upper', interpolation='antialiased',
+                   zorder=0)
+    return basemap
+
+
+def make_basemap(params):
+    """Create the Basemap object for map parameters `params`.
+
+    :param params: dict of the projection parameters and style of the map
     :return: Basemap object
     """
-    m = mpl_toolkits.basemap.Basemap(projection='kav7', lon_0=0, resolution='l')
-    m.drawcoastlines()
-    m.drawcountries()
-    m.fillcontinents(color='lightgreen', lake_color='lightblue')
-    m.drawparallels(np.arange(-90, 120, 30))
-    m.drawmeridians(np.arange(0, 360, 60))
-    m.drawmapboundary(fill_color='lightblue')
-    return m
+    import mpl_toolkits.basemap
+    return mpl_toolkits.basemap.Basemap(projection=params['projection'],
+                                        lon_0=params['lon_0'],
+                                        resolution=params['resolution'])
+
+
+def draw_background(basemap, params, ax=None):
+    """Draw the coastlines, borders and graticule of the map.
+
+    :param basemap: Basemap object
+    :param params: dict of the projection parameters and style of the map
+    :param ax: axes to draw on, or None for the current axes
+    """
+    basemap.drawcoastlines(ax=ax)
+    basemap.drawcountries(ax=ax)
+    basemap.fillcontinents(color=params['land_color'],
+                           lake_color=params['water_color'], ax=ax)
+    basemap.drawparallels(np.arange(-90, 120, params['parallels']), ax=ax)
+    basemap.drawmeridians(np.arange(0, 360, params['meridians']), ax=ax)
+    basemap.drawmapboundary(fill_color=params['water_color'], ax=ax)
+
+
+class MapCache(object):
+
+    cache_subdir = 'map_cache'
+
+    def __init__(self, cache_dir='~/.cache/map_ssh_attempts'):
+        """Create an object caching map projections and background images.
+
+        Each map is cached as a pickled Basemap object and a PNG image of its
+        background, named by a hash of the map parameters and of the
+        Basemap and Matplotlib versions (since pickles and rendering are
+        specific to them).
+
+        :param cache_dir: directory in which to place the cache
+        """
+        self.cache_dir = os.path.expanduser(cache_dir)
+
+    def key(self, params):
+        """Return the name of the cache entry for map parameters `params`."""
+        import matplotlib
+        import mpl_toolkits.basemap
+        versions = {'basemap': mpl_toolkits.basemap.__version__,
+                    'matplotlib': matplotlib.__version__,
+                    'size': [BACKGROUND_INCHES, BACKGROUND_WIDTH]}
+        data = json.dumps([params, versions], sort_keys=True)
+        return hashlib.sha1(data.encode('utf-8')).hexdigest()
+
+    def paths(self, params):
+        """Return the paths of the Basemap pickle and background image."""
+        base = os.path.join(self.cache_dir, MapCache.cache_subdir,
+                            self.key(params))
+        return base + '.pickle', base + '.png'
+
+    def check_cache(self, params):
+        """Check if the map with parameters `params` exists in cache."""
+        return all(os.path.isfile(path) for path in self.paths(params))
+
+    def build(self, params):
+        """Create and draw the map with parameters `params` and cache it.
+
+        :param params: dict of the projection parameters and style of the map
+        """
+        import matplotlib.backends.backend_agg
+        import matplotlib.figure
+        directory = os.path.join(self.cache_dir, MapCache.cache_subdir)
+        if not os.path.isdir(directory):
+            if os.path.lexists(directory):
+                raise NotADirectoryError('Cache location exists but is not a directory.')
+            else:
+                os.makedirs(directory)
+        pickle_path, image_path = self.paths(params)
+        print("Drawing map background... ", end='')
+        basemap = make_basemap(params)
+        # Pickle the Basemap before drawing, which attaches artists to it.
+        with download.atomic_write(pickle_path) as f:
+            pickle.dump(basemap, f, pickle.HIGHEST_PROTOCOL)
+        width = basemap.urcrnrx - basemap.llcrnrx
+        height = basemap.urcrnry - basemap.llcrnry
+        dpi = BACKGROUND_WIDTH / BACKGROUND_INCHES
+        fig = matplotlib.figure.Figure(
+            figsize=(BACKGROUND_INCHES, BACKGROUND_INCHES * height / width),
+            dpi=dpi)
+        matplotlib.backends.backend_agg.FigureCanvasAgg(fig)
+        ax = fig.add_axes((0, 0, 1, 1))
+        ax.set_axis_off()
+        draw_background(basemap, params, ax=ax)
+        ax.set_xlim(basemap.llcrnrx, basemap.urcrnrx)
+        ax.set_ylim(basemap.llcrnry, basemap.urcrnry)
+        with download.atomic_write(image_path) as f:
+            fig.savefig(f, format='png', dpi=dpi, transparent=True)
+        print("100%")
+
+    def load(self, params):
+        """Load the cached map with parameters `params`.
+
+        :param params: dict of the projection parameters and style of the map
+        :return: (Basemap object, RGBA image array of the background)
+        """
+        import matplotlib.image
+        pickle_path, image_path = self.paths(params)
+        with open(pickle_path, 'rb') as f:
+            basemap = pickle.load(f)
+        return basemap, matplotlib.image.imread(image_path)